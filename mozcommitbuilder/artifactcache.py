@@ -0,0 +1,108 @@
+# artifactcache.py
+#
+# Persistent store of built dist/ directories, keyed by the full changeset
+# node and a fingerprint of the mozconfig used to build it. Only the most
+# recently used builds are kept.
+
+import hashlib
+import os
+import re
+import tarfile
+import tempfile
+
+import trash
+
+#mozconfig lines that don't change what ends up in dist/ (parallelism etc.)
+ignoredMozconfigLines = [
+    re.compile(r'^\s*mk_add_options\s+MOZ_MAKE_FLAGS'),
+    re.compile(r'^\s*ac_add_options\s+--with-ccache'),
+]
+
+def mozconfigFingerprint(mozconfigPath):
+    #Hash of the mozconfig contents, minus lines that don't affect the build output
+    sha = hashlib.sha1()
+    if mozconfigPath and os.path.exists(mozconfigPath):
+        f = open(mozconfigPath, 'r')
+        for line in f:
+            if any(pattern.match(line) for pattern in ignoredMozconfigLines):
+                continue
+            sha.update(line.strip() + "\n")
+        f.close()
+    return sha.hexdigest()
+
+class ArtifactCache():
+    def __init__(self, cacheDir, keep=20):
+        #keep: how many builds to hold on to, least recently used go first
+        self.cacheDir = cacheDir
+        self.keep = keep
+        if not os.path.exists(self.cacheDir):
+            os.makedirs(self.cacheDir)
+
+    def key(self, node, fingerprint):
+        #Full 40 char node so short hashes can never collide
+        return str(node) + "-" + str(fingerprint)[:12]
+
+    def path(self, node, fingerprint):
+        return os.path.join(self.cacheDir, self.key(node, fingerprint) + ".tar.gz")
+
+    def has(self, node, fingerprint):
+        return os.path.exists(self.path(node, fingerprint))
+
+    def store(self, node, fingerprint, distDir):
+        #Pack distDir into the cache. Returns the artifact path.
+        if not os.path.isdir(distDir):
+            return None
+
+        #Write to a temporary file first so a crash never leaves a partial artifact
+        fd, tmpPath = tempfile.mkstemp(suffix=".tar.gz.part", dir=self.cacheDir)
+        os.close(fd)
+        try:
+            #dist/bin is mostly symlinks into the objdir, so store the real files
+            tar = tarfile.open(tmpPath, "w:gz", dereference=True)
+            tar.add(distDir, arcname="dist")
+            tar.close()
+            os.rename(tmpPath, self.path(node, fingerprint))
+        except:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+        self.prune()
+        return self.path(node, fingerprint)
+
+    def prune(self):
+        #Drop all but the self.keep most recently stored or restored builds
+        artifacts = [os.path.join(self.cacheDir, name) for name in os.listdir(self.cacheDir)
+                     if name.endswith(".tar.gz")]
+        for path in sorted(artifacts, key=os.path.getmtime, reverse=True)[self.keep:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def restore(self, node, fingerprint, objdir):
+        #Replace objdir/dist with the cached one. Returns True on success.
+        artifact = self.path(node, fingerprint)
+        if not os.path.exists(artifact):
+            return False
+
+        distDir = os.path.join(objdir, "dist")
+        if os.path.islink(distDir) or os.path.isfile(distDir):
+            os.remove(distDir)
+        elif os.path.exists(distDir):
+            trash.discard(distDir)
+        if not os.path.exists(objdir):
+            os.makedirs(objdir)
+
+        tar = tarfile.open(artifact, "r:gz")
+        try:
+            tar.extractall(objdir)
+        finally:
+            tar.close()
+        #Recently used, see prune()
+        os.utime(artifact, None)
+        return True
+
+    def remove(self, node, fingerprint):
+        artifact = self.path(node, fingerprint)
+        if os.path.exists(artifact):
+            os.remove(artifact)
@@ -0,0 +1,282 @@
+# binaryarchive.py
+#
+# Finds prebuilt binaries (and their tests) of a changeset in an archive, so
+# bisection can skip compiling it. An archive is a location template with
+# {node}, {short} (12 character hash) and {platform} in it. It can point at
+# an HTTP server or a local mirror directory, for example:
+#     http://archive.example.com/firefox/{short}/
+#     /srv/mirror/{platform}/{node}/
+# A template ending in "/" names a directory, which is searched for this
+# platform's binary and tests. Anything else names the binary itself.
+#
+# Check what an archive has for a changeset with:
+#     python binaryarchive.py [template] [changeset] [platform]
+# or check the lookups against a local mirror and a stand-in server with:
+#     python binaryarchive.py --check
+
+import os
+import re
+import sys
+import urllib
+import urlparse
+
+import httpclient
+import listing
+from download import fetchManifest, streamInstall
+from extract import compression
+from utils import download_url, get_platform, urlLinks
+
+#Archive file names per platform, the same names getTestUrl looks for
+binaryPatterns = {"linux-x86_64": r".*\.linux-x86_64\.tar\.(bz2|gz)$",
+                  "linux-i686": r".*\.linux-i686\.tar\.(bz2|gz)$",
+                  "mac": r".*\.mac(64)?\.dmg$",
+                  "win32": r".*\.win32\.zip$"}
+testsPattern = r".*\.tests\.zip$"
+checksumsPattern = r".*\.checksums$"
+
+def archivePlatform():
+    #Platform name as used in archive file names
+    platform = get_platform()
+    if platform["name"] == "Linux":
+        if platform["bits"] == "64":
+            return "linux-x86_64"
+        return "linux-i686"
+    elif platform["name"] == "Mac":
+        return "mac"
+    return "win32"
+
+class ArchivedBuild():
+    def __init__(self, node, binary, tests=None, checksums=None):
+        self.node = node
+        self.binary = binary
+        self.tests = tests
+        #Location of a .checksums manifest for the files, if the archive has one
+        self.checksums = checksums
+
+class BinaryArchive():
+    #Shared lookup logic, subclasses say how to list and fetch
+    def __init__(self, template, platform=None):
+        self.template = template
+        self.platform = platform or archivePlatform()
+        self.binaryPattern = re.compile(binaryPatterns.get(self.platform, r".*\.(tar\.(bz2|gz)|zip|dmg)$"))
+        self.testsPattern = re.compile(testsPattern)
+        self.checksumsPattern = re.compile(checksumsPattern)
+
+    def location(self, node):
+        return self.template.format(node=node, short=node[:12], platform=self.platform)
+
+    def find(self, node):
+        #ArchivedBuild of node for this platform, or None if there isn't one
+        location = self.location(node)
+        if not location.endswith("/"):
+            if self.exists(location):
+                return ArchivedBuild(node, location)
+            return None
+
+        binary = None
+        tests = []
+        checksums = None
+        for name in self.list(location):
+            if binary == None and self.binaryPattern.match(name):
+                binary = self.join(location, name)
+            elif self.testsPattern.match(name):
+                tests.append(name)
+            elif checksums == None and self.checksumsPattern.match(name) and self.platform in name:
+                checksums = self.join(location, name)
+        if binary == None:
+            return None
+        return ArchivedBuild(node, binary, self.pickTests(location, tests), checksums)
+
+    def pickTests(self, location, names):
+        #This platform's tests.zip. A directory with a single one that doesn't
+        #name a platform (a local mirror) gets that one.
+        for name in names:
+            if self.platform in name:
+                return self.join(location, name)
+        if len(names) == 1 and not [platform for platform in binaryPatterns if platform in names[0]]:
+            return self.join(location, names[0])
+        return None
+
+    def join(self, location, name):
+        return location + name
+
+class HttpArchive(BinaryArchive):
+    def list(self, location):
+        #Names in the listing, from the shared listing index when there is one
+        try:
+            if listing.sharedIndex() != None:
+                return listing.sharedIndex().names(location)
+            return [link["name"] for link in urlLinks(location)]
+        except httpclient.HttpError, e:
+            if e.status != 404:
+                print "Couldn't list " + location + ": " + str(e)
+            return []
+        except Exception, e:
+            print "Couldn't list " + location + ": " + str(e)
+            return []
+
+    def exists(self, location):
+        #The binary itself is named, look for it in its directory listing
+        directory, name = location.rsplit("/", 1)
+        return name in self.list(directory + "/")
+
+    def expected(self, location, checksums):
+        #(size, (algorithm, digest)) of location from the checksums manifest
+        if checksums:
+            entry = fetchManifest(checksums).get(os.path.basename(location))
+            if entry:
+                (algorithm, digest, size) = entry
+                return (size, (algorithm, digest))
+        return (None, None)
+
+    def fetch(self, location, destDir, checksums=None):
+        #Downloads location into destDir, returns the local path. Size and
+        #checksum are verified when the checksums manifest lists the file.
+        (size, checksum) = self.expected(location, checksums)
+        return download_url(location, dest=os.path.join(destDir, os.path.basename(location)),
+                            size=size, checksum=checksum)
+
+    def streamInstall(self, location, destDir, installDir, checksums=None, store=None):
+        #Tarballs are unpacked into installDir as they download (through the
+        #install store if given), with a copy kept in destDir. Returns False
+        #for anything that has to be fetched first.
+        if not compression(location):
+            return False
+        (size, checksum) = self.expected(location, checksums)
+        streamInstall(location, installDir, dest=os.path.join(destDir, os.path.basename(location)),
+                      size=size, checksum=checksum, store=store)
+        return True
+
+class LocalArchive(BinaryArchive):
+    def __init__(self, template, platform=None):
+        if template.startswith("file://"):
+            template = urllib.url2pathname(urlparse.urlparse(template).path)
+        BinaryArchive.__init__(self, os.path.expanduser(template), platform)
+
+    def list(self, location):
+        if not os.path.isdir(location):
+            return []
+        return sorted(os.listdir(location))
+
+    def exists(self, location):
+        return os.path.isfile(location)
+
+    def join(self, location, name):
+        return os.path.join(location, name)
+
+    def fetch(self, location, destDir, checksums=None):
+        #Already on disk, use it in place
+        return location
+
+    def streamInstall(self, location, destDir, installDir, checksums=None, store=None):
+        #Nothing to overlap with a local file, install it from fetch()
+        return False
+
+def openArchive(template, platform=None):
+    #Pick the backend from the template: http(s) URLs or local paths
+    scheme = urlparse.urlparse(template).scheme
+    if scheme in ("http", "https"):
+        return HttpArchive(template, platform)
+    return LocalArchive(template, platform)
+
+def parseTemplates(specs, platform=None):
+    #--archive values are either a template for every platform or
+    #"platform=template". Returns the archive for this platform, or None.
+    platform = platform or archivePlatform()
+    templates = {}
+    for spec in specs or []:
+        match = re.match(r"^([\w-]+)=(.*)$", spec)
+        if match and match.group(1) in binaryPatterns:
+            templates[match.group(1)] = match.group(2)
+        else:
+            templates.setdefault(None, spec)
+    template = templates.get(platform, templates.get(None))
+    if template == None:
+        return None
+    return openArchive(template, platform)
+
+def selfCheck():
+    #Lookups against a throwaway mirror directory, served both as a local
+    #archive and through a stand-in HTTP server. Returns the number of failures.
+    import BaseHTTPServer
+    import hashlib
+    import shutil
+    import SimpleHTTPServer
+    import tempfile
+    import threading
+
+    node = "0123456789ab" + "c" * 28
+    root = tempfile.mkdtemp(prefix="archivecheck")
+    failures = []
+    def check(what, got, expected):
+        if got != expected:
+            failures.append(what)
+            print "FAIL %s: got %r, expected %r" % (what, got, expected)
+        else:
+            print "ok   " + what
+
+    server = None
+    try:
+        directory = os.path.join(root, node[:12])
+        os.makedirs(directory)
+        sums = []
+        for platform, ext in (("linux-x86_64", "tar.bz2"), ("linux-i686", "tar.bz2"), ("mac", "dmg"),
+                              ("win32", "zip")):
+            for name in ("firefox-9.0a1.en-US.%s.%s" % (platform, ext), "firefox-9.0a1.en-US.%s.tests.zip" % platform):
+                data = name * 100
+                f = open(os.path.join(directory, name), "wb")
+                f.write(data)
+                f.close()
+                sums.append("%s sha512 %d %s" % (hashlib.sha512(data).hexdigest(), len(data), name))
+        f = open(os.path.join(directory, "firefox-9.0a1.en-US.linux-x86_64.checksums"), "w")
+        f.write("\n".join(sums) + "\n")
+        f.close()
+
+        handler = SimpleHTTPServer.SimpleHTTPRequestHandler
+        handler.log_message = lambda self, *args: None
+        cwd = os.getcwd()
+        os.chdir(root)
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        httpclient.configure(os.path.join(root, "http-cache"))
+        baseUrl = "http://127.0.0.1:%d/" % server.server_address[1]
+
+        for template in (root + "/{short}/", "file://" + root + "/{short}/", baseUrl + "{short}/"):
+            kind = template.split(":")[0] if "://" in template else "path"
+            for platform in ("linux-x86_64", "linux-i686", "mac", "win32"):
+                archived = openArchive(template, platform).find(node)
+                check("%s %s binary" % (kind, platform), archived and os.path.basename(archived.binary).split(".")[3],
+                      platform)
+                check("%s %s tests" % (kind, platform), archived and os.path.basename(str(archived.tests)),
+                      "firefox-9.0a1.en-US.%s.tests.zip" % platform)
+            check(kind + " missing changeset", openArchive(template, "win32").find("f" * 40), None)
+
+        archive = openArchive(baseUrl + "{short}/", "linux-x86_64")
+        archived = archive.find(node)
+        fetched = archive.fetch(archived.binary, os.path.join(root, "fetched"), checksums=archived.checksums)
+        check("http fetch with checksums", open(fetched, "rb").read(), open(os.path.join(directory,
+              os.path.basename(archived.binary)), "rb").read())
+    finally:
+        if server != None:
+            server.shutdown()
+            os.chdir(cwd)
+        shutil.rmtree(root, ignore_errors=True)
+    print "%d checks failed" % len(failures)
+    return len(failures)
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--check"]:
+        sys.exit(selfCheck() and 1 or 0)
+    if len(sys.argv) < 3:
+        print "usage: binaryarchive.py [template] [changeset] [platform]"
+        print "       binaryarchive.py --check"
+        sys.exit(1)
+    archive = openArchive(sys.argv[1], len(sys.argv) > 3 and sys.argv[3] or None)
+    archived = archive.find(sys.argv[2])
+    if archived == None:
+        print "Nothing archived for " + sys.argv[2] + " on " + archive.platform + " at " + archive.location(sys.argv[2])
+        sys.exit(1)
+    print "binary: " + archived.binary
+    print "tests:  " + str(archived.tests)
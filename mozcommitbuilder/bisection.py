@@ -0,0 +1,515 @@
+# bisection.py
+#
+# Bisection engines. Both take verdicts and say what to test next:
+#
+#   HgBisector      drives "hg bisect" and reads its output
+#   NativeBisector  loads the good..bad DAG once and bisects in Python
+#   ProbabilisticBisector
+#                   like NativeBisector, but tolerates flaky verdicts
+#
+# The native engine follows hg bisect's rules: the candidates are the
+# ancestors of the bad changeset that aren't ancestors of a good one, the
+# next changeset to test is the one that splits the candidates most evenly,
+# and skipped changesets are never picked but can't be ruled out either.
+#
+# Check that the engines agree on a throwaway repository (needs hg) with:
+#     python bisection.py --check
+
+import math
+import re
+import sys
+from time import gmtime, strftime
+
+def bitCount(mask):
+    return bin(mask).count("1")
+
+def bitIndexes(mask):
+    #Indexes of the set bits, lowest first
+    indexes = []
+    i = 0
+    while mask:
+        if mask & 1:
+            indexes.append(i)
+        mask >>= 1
+        i += 1
+    return indexes
+
+class HgBisector():
+    def __init__(self, hg):
+        self.hg = hg
+        self.found = False
+        self.output = ""
+
+    def start(self, good, bad):
+        #Returns True if good..bad is already narrowed down to one changeset
+        self.hg.run(["bisect","--reset"])
+        setUpdate = self.hg.capture(["up",bad])
+        setBad = self.hg.capture(["bisect","--bad"])
+        setGood = self.hg.capture(["bisect","--good",good])
+
+        print str(setUpdate)
+        print str(setBad)
+        print str(setGood)
+        return self.check(setGood)
+
+    def mark(self, changeset, verdict):
+        #Hand a verdict to hg bisect. Returns True once the regression is found.
+        verdictCommand = ["bisect","--"+verdict]
+        if changeset:
+            verdictCommand.append(changeset)
+        print " ".join(["hg"] + verdictCommand)
+        retval = self.hg.capture(verdictCommand)
+        print str(retval)
+        if retval.startswith("Testing changeset"):
+            print "\n"
+        return self.check(retval)
+
+    def check(self, doneString):
+        # Check if we should terminate early because the bisector exited?
+        string_to_parse = str(doneString)
+
+        branch_unaware_flag = string_to_parse.find("Not all ancestors")
+        traceback_flag = string_to_parse.find("--extend")
+        regression_found = string_to_parse.find("The first")
+
+        if traceback_flag > -1:
+            #hg 1.9 and up only has --extend, which is branch aware
+            print "Using hg 1.9, we're branch aware! Let's explore that ancestor branch..."
+            print self.hg.capture(["bisect","--extend"], ignoreExitCode=True, ignoreStderr=True)
+        elif branch_unaware_flag > -1:
+            print "Not using hg 1.9 (not automatic) so you need to bisect again with the above changeset."
+        elif regression_found > -1:
+            self.found = True
+            self.output = string_to_parse
+        return self.found
+
+    def current(self):
+        #hg bisect leaves the working copy on the changeset to test
+        if self.found:
+            return None
+        return self.hg.node(".")
+
+    def untested(self):
+        #Changesets hg bisect still has to look at, in revision order
+        output = self.hg.capture(["log","-r","bisect(untested)","--template","{node}\n"])
+        return [node for node in output.split("\n") if node]
+
+    def result(self):
+        candidates = re.findall(r'changeset:\s+\d+:([0-9a-f]+)', self.output)
+        return {"found": self.found,
+                "culprit": candidates[0] if len(candidates) == 1 else None,
+                "candidates": candidates,
+                "output": self.output}
+
+class ChangesetDag():
+    #The changesets of a bisection range, indexed 0..n-1 in revision (and so
+    #topological) order. Ancestry is kept as one bitmask per changeset.
+    def __init__(self, revs, nodes, parents, dates, files):
+        self.revs = revs
+        self.nodes = nodes
+        self.parents = parents
+        self.dates = dates
+        self.files = files
+        self.index = {}
+        for i, node in enumerate(nodes):
+            self.index[node] = i
+        self.ancestors = []
+        for i in range(len(nodes)):
+            mask = 1 << i
+            for p in parents[i]:
+                mask |= self.ancestors[p]
+            self.ancestors.append(mask)
+
+    @classmethod
+    def load(cls, hg, good, bad):
+        #One hg log call for everything between good and bad
+        template = "{rev}\t{node}\t{p1rev}\t{p2rev}\t{date|hgdate}{files % '\t{file}'}\n"
+        output = hg.capture(["log", "-r", "sort(ancestors(%s) - ancestors(%s))" % (bad, good),
+                             "--template", template])
+        rows = []
+        for line in output.split("\n"):
+            if not line:
+                continue
+            fields = line.split("\t")
+            rows.append((int(fields[0]), fields[1], int(fields[2]), int(fields[3]),
+                         int(fields[4].split(" ")[0]), fields[5:]))
+        rows.sort()
+
+        revIndex = {}
+        for i, row in enumerate(rows):
+            revIndex[row[0]] = i
+        revs = [row[0] for row in rows]
+        nodes = [row[1] for row in rows]
+        #Parents outside the range are ancestors of good, so they don't matter
+        parents = [tuple([revIndex[p] for p in (row[2], row[3]) if p in revIndex]) for row in rows]
+        dates = [row[4] for row in rows]
+        files = [row[5] for row in rows]
+        return cls(revs, nodes, parents, dates, files)
+
+    def find(self, changeset):
+        #Index of a full or abbreviated node, or None
+        if changeset in self.index:
+            return self.index[changeset]
+        matches = [i for i, node in enumerate(self.nodes) if node.startswith(changeset)]
+        if len(matches) == 1:
+            return matches[0]
+        return None
+
+class NativeBisector():
+    def __init__(self, hg):
+        self.hg = hg
+        self.dag = None
+        self.candidates = 0
+        self.skipped = 0
+        self.bad = None
+        self.goods = []
+
+    def start(self, good, bad):
+        self.dag = ChangesetDag.load(self.hg, good, bad)
+        if not self.dag.nodes:
+            raise Exception(bad + " is not a descendant of " + good)
+        self.bad = self.dag.find(self.hg.node(bad))
+        self.candidates = self.dag.ancestors[self.bad]
+        self.skipped = 0
+        self.goods = [good]
+        self.report()
+        return self.done()
+
+    def mark(self, changeset, verdict):
+        #Returns True once the regression is found (or only skipped changesets are left)
+        i = self.dag.find(changeset)
+        if i == None:
+            #Outside the range, so it can't tell us anything new
+            print "Ignoring " + verdict + " verdict for " + str(changeset)[:12] + ", it's not in the bisection range"
+            return self.done()
+        print "Marking " + self.dag.nodes[i][:12] + " as " + verdict
+        if verdict == "bad":
+            self.bad = i
+            self.candidates &= self.dag.ancestors[i]
+        elif verdict == "good":
+            self.goods.append(self.dag.nodes[i])
+            self.candidates &= ~self.dag.ancestors[i]
+        elif verdict == "skip":
+            self.skipped |= 1 << i
+        else:
+            raise Exception("Unknown verdict " + str(verdict))
+        self.report()
+        return self.done()
+
+    def testable(self):
+        #Candidates we could still test, as a bitmask
+        return self.candidates & ~self.skipped & ~(1 << self.bad)
+
+    def done(self):
+        return bitCount(self.candidates) <= 1 or self.testable() == 0
+
+    def current(self):
+        #The candidate that splits the rest most evenly, None when we're done
+        if self.done():
+            return None
+        total = bitCount(self.candidates)
+        best = None
+        bestValue = -1
+        for i in bitIndexes(self.testable()):
+            below = bitCount(self.dag.ancestors[i] & self.candidates)
+            value = min(below, total - below)
+            if value > bestValue:
+                best = i
+                bestValue = value
+                if value == total // 2:
+                    break
+        return self.dag.nodes[best]
+
+    def untested(self):
+        return [self.dag.nodes[i] for i in bitIndexes(self.testable())]
+
+    def report(self):
+        total = bitCount(self.candidates)
+        if self.done():
+            result = self.result()
+            if result["culprit"]:
+                print "The first bad revision is: " + self.describe(self.dag.find(result["culprit"]))
+            else:
+                print "Due to skipped revisions, the first bad revision could be any of:"
+                for node in result["candidates"]:
+                    print "    " + self.describe(self.dag.find(node))
+        else:
+            tests = 0
+            while (1 << tests) < total:
+                tests += 1
+            print str(total) + " changesets left, about " + str(tests) + " more tests"
+
+    def describe(self, i):
+        return self.dag.nodes[i][:12] + " (rev " + str(self.dag.revs[i]) + ", " + \
+               strftime("%Y-%m-%d %H:%M:%S", gmtime(self.dag.dates[i])) + ", " + \
+               str(len(self.dag.files[i])) + " files)"
+
+    def result(self):
+        #The culprit range as plain data
+        candidates = [self.dag.nodes[i] for i in bitIndexes(self.candidates)]
+        found = self.done()
+        culprit = None
+        if found and len(candidates) == 1:
+            culprit = candidates[0]
+        return {"found": found,
+                "culprit": culprit,
+                "candidates": candidates,
+                "bad": self.dag.nodes[self.bad],
+                "goods": self.goods,
+                "skipped": [self.dag.nodes[i] for i in bitIndexes(self.skipped)],
+                "files": dict([(self.dag.nodes[i], self.dag.files[i]) for i in bitIndexes(self.candidates)])}
+
+def binaryEntropy(p):
+    if p <= 0.0 or p >= 1.0:
+        return 0.0
+    return -p * math.log(p, 2) - (1 - p) * math.log(1 - p, 2)
+
+class ProbabilisticBisector():
+    #Bisection for flaky conditions. Keeps a posterior over which changeset
+    #introduced the regression, tests wherever the expected information gain
+    #is highest (which may mean testing the same changeset again), and stops
+    #once one changeset is the culprit with at least the given confidence.
+    #
+    #falsePositive: chance a good changeset is reported bad
+    #falseNegative: chance a bad changeset is reported good
+    def __init__(self, hg, confidence=0.95, falsePositive=0.05, falseNegative=0.05, maxTests=None):
+        if not (0.0 <= falsePositive < 0.5 and 0.0 <= falseNegative < 0.5):
+            raise Exception("Error rates must be below 0.5, or the verdicts carry no information")
+        self.hg = hg
+        self.confidence = confidence
+        self.falsePositive = falsePositive
+        self.falseNegative = falseNegative
+        self.maxTests = maxTests
+        self.dag = None
+        self.posterior = []
+        self.skipped = 0
+        self.tests = 0
+        self.goods = []
+        self.bad = None
+
+    def start(self, good, bad):
+        self.dag = ChangesetDag.load(self.hg, good, bad)
+        if not self.dag.nodes:
+            raise Exception(bad + " is not a descendant of " + good)
+        self.bad = self.dag.find(self.hg.node(bad))
+        #Uniform prior over everything the known bad changeset could have inherited it from
+        candidates = bitIndexes(self.dag.ancestors[self.bad])
+        self.posterior = [0.0] * len(self.dag.nodes)
+        for i in candidates:
+            self.posterior[i] = 1.0 / len(candidates)
+        #With a linear history "culprit is an ancestor of x" is just "culprit <= x"
+        self.linear = all([self.dag.parents[i] == ((i - 1,) if i else ()) for i in range(len(self.dag.nodes))])
+        self.skipped = 0
+        self.tests = 0
+        self.goods = [good]
+        self.report()
+        return self.done()
+
+    def badProbabilities(self):
+        #For every changeset, the probability that it really contains the regression
+        if self.linear:
+            probabilities = []
+            total = 0.0
+            for p in self.posterior:
+                total += p
+                probabilities.append(total)
+            return probabilities
+        return [sum([self.posterior[c] for c in bitIndexes(ancestors)]) for ancestors in self.dag.ancestors]
+
+    def mark(self, changeset, verdict):
+        i = self.dag.find(changeset)
+        if i == None:
+            print "Ignoring " + verdict + " verdict for " + str(changeset)[:12] + ", it's not in the bisection range"
+            return self.done()
+        print "Marking " + self.dag.nodes[i][:12] + " as " + verdict
+        if verdict == "skip":
+            self.skipped |= 1 << i
+            self.report()
+            return self.done()
+        if verdict not in ("good", "bad"):
+            raise Exception("Unknown verdict " + str(verdict))
+
+        self.tests += 1
+        if verdict == "bad":
+            likelihoodIfBad = 1.0 - self.falseNegative
+            likelihoodIfGood = self.falsePositive
+            self.goods = [node for node in self.goods if node != self.dag.nodes[i]]
+        else:
+            likelihoodIfBad = self.falseNegative
+            likelihoodIfGood = 1.0 - self.falsePositive
+            self.goods.append(self.dag.nodes[i])
+
+        #Changeset i is bad exactly when the culprit is one of its ancestors
+        ancestors = self.dag.ancestors[i]
+        total = 0.0
+        for c in range(len(self.posterior)):
+            if (ancestors >> c) & 1:
+                self.posterior[c] *= likelihoodIfBad
+            else:
+                self.posterior[c] *= likelihoodIfGood
+            total += self.posterior[c]
+        if total > 0:
+            self.posterior = [p / total for p in self.posterior]
+        self.report()
+        return self.done()
+
+    def best(self):
+        #(index, probability) of the most likely culprit
+        i = max(range(len(self.posterior)), key=lambda c: self.posterior[c])
+        return (i, self.posterior[i])
+
+    def done(self):
+        if self.best()[1] >= self.confidence:
+            return True
+        if self.maxTests != None and self.tests >= self.maxTests:
+            return True
+        return self.testable() == []
+
+    def testable(self, probabilities=None):
+        #Changesets whose verdict we can't predict for sure are worth testing
+        probabilities = probabilities or self.badProbabilities()
+        return [i for i in range(len(self.dag.nodes))
+                if not (self.skipped >> i) & 1 and 0.0 < probabilities[i] < 1.0 - 1e-12]
+
+    def informationGain(self, bad):
+        #Expected reduction in entropy about the culprit from one test of a
+        #changeset that is really bad with probability bad
+        reportedBad = bad * (1.0 - self.falseNegative) + (1.0 - bad) * self.falsePositive
+        return binaryEntropy(reportedBad) - bad * binaryEntropy(self.falseNegative) - \
+               (1.0 - bad) * binaryEntropy(self.falsePositive)
+
+    def current(self):
+        if self.done():
+            return None
+        probabilities = self.badProbabilities()
+        best = max(self.testable(probabilities), key=lambda i: self.informationGain(probabilities[i]))
+        return self.dag.nodes[best]
+
+    def untested(self):
+        return [self.dag.nodes[i] for i in self.testable()]
+
+    def report(self):
+        (i, probability) = self.best()
+        if self.done():
+            print "The first bad revision is: " + self.dag.nodes[i][:12] + " (rev " + str(self.dag.revs[i]) + \
+                  ") with confidence " + ("%.3f" % probability) + " after " + str(self.tests) + " tests"
+        else:
+            print "Most likely culprit so far: " + self.dag.nodes[i][:12] + " (" + ("%.3f" % probability) + \
+                  "), " + str(self.tests) + " tests"
+
+    def result(self):
+        (i, probability) = self.best()
+        ranked = sorted(range(len(self.posterior)), key=lambda c: -self.posterior[c])[:5]
+        return {"found": self.done(),
+                "culprit": self.dag.nodes[i],
+                "confidence": probability,
+                "tests": self.tests,
+                "candidates": [self.dag.nodes[c] for c in ranked],
+                "probabilities": dict([(self.dag.nodes[c], self.posterior[c]) for c in ranked]),
+                "bad": self.dag.nodes[self.bad],
+                "goods": self.goods,
+                "skipped": [self.dag.nodes[c] for c in bitIndexes(self.skipped)]}
+
+def checkRepository(path):
+    #Throwaway repository: revs 0-8 in a line, a branch 9-12 off rev 3
+    #merged back as rev 13, then 14-20 in a line. Returns an HgClient on it.
+    import os
+    import subprocess
+    from hgclient import HgClient
+
+    subprocess.check_call(["hg", "init", path])
+    hg = HgClient(path)
+    def commit(rev):
+        f = open(os.path.join(path, "file%d" % rev), "w")
+        f.write("rev %d\n" % rev)
+        f.close()
+        hg.capture(["commit", "-A", "-q", "-m", "rev %d" % rev, "-u", "check", "-d", "%d 0" % (1300000000 + rev * 3600)])
+    for rev in range(9):
+        commit(rev)
+    hg.capture(["update", "-q", "3"])
+    for rev in range(9, 13):
+        commit(rev)
+    hg.capture(["update", "-q", "8"])
+    hg.capture(["merge", "-q", "12"])
+    hg.capture(["commit", "-q", "-m", "merge", "-u", "check", "-d", "%d 0" % (1300000000 + 13 * 3600)])
+    for rev in range(14, 21):
+        commit(rev)
+    return hg
+
+def selfCheck():
+    #Bisects the repository from checkRepository() with every engine, for a
+    #culprit on the merged branch and one after the merge, with some
+    #changesets that can't be tested. Returns the number of failures.
+    import random
+    import shutil
+    import tempfile
+
+    failures = []
+    def check(what, got, expected):
+        if got != expected:
+            failures.append(what)
+            print "FAIL %s: got %r, expected %r" % (what, got, expected)
+        else:
+            print "ok   " + what
+
+    def bisect(bisector, good, bad, verdict, limit=200):
+        #Feeds verdicts until the bisector is done, returns its result
+        done = bisector.start(good, bad)
+        while not done and limit > 0:
+            changeset = bisector.current()
+            done = bisector.mark(changeset, verdict(changeset))
+            limit -= 1
+        return bisector.result()
+
+    work = tempfile.mkdtemp(prefix="bisectcheck")
+    hg = None
+    try:
+        hg = checkRepository(work)
+        good = hg.node("0")
+        bad = hg.node("20")
+        #Changesets the engines want to test, but none a culprit's parent
+        skipped = set([hg.node("8"), hg.node("11"), hg.node("17")])
+        for culpritRev in ("10", "15"):
+            culprit = hg.node(culpritRev)
+            badOnes = set(hg.capture(["log", "-r", "descendants(%s)" % culprit, "--template", "{node}\n"]).split())
+            def verdict(changeset):
+                if changeset in skipped:
+                    return "skip"
+                return "bad" if changeset in badOnes else "good"
+
+            native = bisect(NativeBisector(hg), good, bad, verdict)
+            check("native bisection finds rev " + culpritRev, native["culprit"], culprit)
+            check("native bisection went around skipped changesets", native["skipped"] != [] and
+                  set(native["skipped"]) <= skipped, True)
+
+            mercurial = bisect(HgBisector(hg), good, bad, lambda changeset: verdict(hg.node(changeset)))
+            check("hg bisect agrees on rev " + culpritRev,
+                  (mercurial["found"], culprit.startswith(mercurial["culprit"] or "-")), (True, True))
+
+            probabilistic = bisect(ProbabilisticBisector(hg), good, bad, verdict)
+            check("probabilistic bisection finds rev " + culpritRev, (probabilistic["found"], probabilistic["culprit"]),
+                  (True, culprit))
+
+            #One verdict in ten reported wrong, it has to retest its way out
+            flaky = random.Random(int(culpritRev))
+            def flakyVerdict(changeset):
+                result = verdict(changeset)
+                if result != "skip" and flaky.random() < 0.1:
+                    return "good" if result == "bad" else "bad"
+                return result
+            noisy = bisect(ProbabilisticBisector(hg, confidence=0.99, falsePositive=0.1, falseNegative=0.1),
+                           good, bad, flakyVerdict)
+            check("probabilistic bisection converges on rev " + culpritRev + " with flaky verdicts",
+                  (noisy["found"], noisy["culprit"]), (True, culprit))
+    finally:
+        if hg != None:
+            hg.close()
+        shutil.rmtree(work, ignore_errors=True)
+    print "%d checks failed" % len(failures)
+    return len(failures)
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--check"]:
+        sys.exit(selfCheck() and 1 or 0)
+    print "usage: bisection.py --check"
+    sys.exit(1)
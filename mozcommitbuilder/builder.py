@@ -45,15 +45,33 @@ Known Issues:
        has spaces -- if we use ~ the build command will fail.
 '''
 
+from artifactcache import ArtifactCache, mozconfigFingerprint
+from binaryarchive import parseTemplates
+from bisection import HgBisector, NativeBisector, ProbabilisticBisector
+from compilercache import CompilerCache
+from conditionpool import ConditionPool, normalizeVerdict
+from costmodel import RebuildCostModel
+from download import streamInstall
+from extract import compression, extract
+from journal import BisectJournal
+from jobserver import JobClient, serve
+from testpackages import TestPackageStore
+from hgclient import HgClient
+from installstore import InstallStore
 from mozInstall import MozInstaller
+from pushlog import PushlogIndex
 from mozrunner import Runner, FirefoxRunner
 from optparse import OptionParser, OptionGroup
 from time import gmtime, strftime
 from types import *
-from utils import hgId, captureStdout, increment_day, cpuCount, getTestUrl, download_url, unzip, url_base
+from utils import captureStdout, streamCommand, BuildError, strsplit, cpuCount, getTestUrl, download_url, unzip, url_base
+from tracing import Tracer
+from verdictcache import VerdictCache, scriptHash, argsHash
 from trybuild import BuildCaller
+from worktree import WorktreePool
 import datetime
 import glob
+import hashlib
 import multiprocessing
 import os
 import re
@@ -64,8 +82,12 @@ import string
 import subprocess
 import sys
 import tempfile
-import urllib
+import threading
+import time
 import ximport
+import httpclient
+import trash
+import listing
 
 #Global Variables
 showMakeData = 0
@@ -74,7 +96,13 @@ progVersion="0.4.7"
 class Builder():
     def __init__(self, makeCommand=["make","-f","client.mk","build"] , shellCacheDir=os.path.join(os.path.expanduser("~"),
                  "moz-commitbuilder-cache"), cores=1, repoURL="http://hg.mozilla.org/mozilla-central",clean=False,
-                 mozconf=None, tryhost=None, tryport=None, remote=False, tryPusher=False, testBinaries=False):
+                 mozconf=None, tryhost=None, tryport=None, remote=False, tryPusher=False, testBinaries=False,
+                 useCache=True, parallel=1, worktrees=None, journal=None,
+                 window=0, costModel=None, compilerCache=None, compilerCacheSize="10G",
+                 trace=None, traceFormat="json", abortOnError=False, engine="hg",
+                 confidence=0.95, falsePositive=0.05, falseNegative=0.05, useVerdictCache=True,
+                 repeat=1, aggregation="any-fail", threshold=0.5, conditionTimeout=None, memoryLimit=None,
+                 limitVerdict="skip", archive=None, hybrid=False, installLinks="hardlink"):
         #Set variables that we need
         self.makeCommand = makeCommand
         self.shellCacheDir = shellCacheDir
@@ -85,13 +113,75 @@ class Builder():
         self.binaryDir = os.path.join(shellCacheDir, "binaries")
         self.repoPath = os.path.join(shellCacheDir,"mozbuild-trunk")
         self.hgPrefix = ['hg', '-R', self.repoPath]
+        httpclient.configure(os.path.join(shellCacheDir, "http"))
+        if not os.path.exists(shellCacheDir):
+            os.makedirs(shellCacheDir)
+        listing.configure(os.path.join(shellCacheDir, "listings.sqlite"))
+        #Also starts removing trash an earlier run didn't get to
+        trash.configure(os.path.join(shellCacheDir, "trash"))
+        self.testPackages = TestPackageStore(os.path.join(shellCacheDir, "testpackages"))
+        self.hgClients = {}
+        self.hgClientsLock = threading.Lock()
+        self.hg = self.hgClient(self.repoPath)
         self.mozconf = mozconf
         self.objdir = os.path.join(self.repoPath,"obj-ff-dbg")
         self.tryhost = tryhost
         self.tryport = tryport
         self.testBinaries = testBinaries
         self.remote = remote
+        #Where --remote looks for prebuilt binaries, see binaryarchive.py
+        self.archive = parseTemplates(archive)
+        if self.remote and self.archive == None:
+            print "No --archive for this platform, every changeset will be built locally."
+        self.hybrid = hybrid
+        self.archivedBuilds = {}
+        #Archive lookups choosePrebuilt() may make around one midpoint
+        self.prebuiltProbes = 8
+        #Archived installs as link farms over deduplicated files, see installstore.py
+        self.installs = None
+        if installLinks in ("hardlink", "reflink"):
+            self.installs = InstallStore(os.path.join(shellCacheDir, "installs"), links=installLinks)
         self.tryPusher = tryPusher
+        self.parallel = parallel
+        self.window = window
+        self.engine = engine
+        self.confidence = confidence
+        self.falsePositive = falsePositive
+        self.falseNegative = falseNegative
+        self.bisector = None
+        self.verdicts = None
+        if useVerdictCache:
+            self.verdicts = VerdictCache(os.path.join(shellCacheDir, "verdicts.sqlite"))
+        self.conditions = ConditionPool(repeat=repeat, jobs=cpuCount(), timeout=conditionTimeout,
+                                        memoryLimit=memoryLimit, limitVerdict=limitVerdict,
+                                        rule=aggregation, threshold=threshold)
+        self.tracer = Tracer(trace, traceFormat)
+        self.abortOnError = abortOnError
+        self.logDir = os.path.join(shellCacheDir, "logs")
+        self.compilerCache = None
+        if compilerCache:
+            self.compilerCache = CompilerCache(compilerCache, os.path.join(shellCacheDir, compilerCache),
+                                               maxSize=compilerCacheSize)
+            if self.compilerCache.available():
+                self.compilerCache.setupEnvironment()
+            else:
+                print compilerCache + " not found on this system, building without a compiler cache."
+                self.compilerCache = None
+        #Builds running right now. The cache's stats are shared, so they're
+        #zeroed when the first of overlapping builds starts and reported when
+        #the last one finishes.
+        self.compilerCacheBuilds = 0
+        self.compilerCacheLock = threading.Lock()
+        self.costModel = costModel or RebuildCostModel(os.path.join(shellCacheDir, "rebuild-costs.log"))
+        self.journal = BisectJournal(journal or os.path.join(shellCacheDir, "bisect-journal.json"))
+        self.worktrees = WorktreePool(self.repoPath, os.path.join(shellCacheDir, "worktrees"),
+                                      size=max(worktrees or 0, parallel))
+        self.artifacts = None
+        if useCache:
+            self.artifacts = ArtifactCache(os.path.join(shellCacheDir, "artifacts"))
+        #Cached builds only hold dist/, so they're only restored when whatever
+        #runs next needs nothing else from the objdir, see conditionDistOnly()
+        self.restoreArtifacts = False
 
         #Create directories we need
         if not os.path.exists(shellCacheDir):
@@ -114,13 +204,9 @@ class Builder():
 
     def getTip(self):
         #Get trunk's tip changeset identifier hash
+        changesetTip = None
         try:
-            tiprev = subprocess.Popen(self.hgPrefix+["tip"],stdout=subprocess.PIPE)
-            capturedString = tiprev.communicate()
-            try:
-                changesetTip = capturedString[0].split("\n")[0].split(" ")[3].split(":")[1]
-            except:
-                pass
+            changesetTip = self.hg.capture(["log","-r","tip","--template","{node|short}"], ignoreStderr=True)
         except:
             print "Woops, something went wrong!"
             quit()
@@ -131,26 +217,34 @@ class Builder():
         else:
             print "Couldn't get the tip changeset."
 
+    def hgClient(self, repoPath):
+        #One long-lived hg command server per working copy
+        self.hgClientsLock.acquire()
+        try:
+            if repoPath not in self.hgClients:
+                self.hgClients[repoPath] = HgClient(repoPath)
+            return self.hgClients[repoPath]
+        finally:
+            self.hgClientsLock.release()
+
+    def close(self):
+        #Shut down the hg command servers
+        for client in self.hgClients.values():
+            client.close()
+        if self.verdicts:
+            self.verdicts.close()
+
     def changesetFromDay(self, date, oldest=True):
-        # Gets first changeset from a given date via pushlog
-        nextDate = increment_day(date)
-        pushlog_url = "http://hg.mozilla.org/mozilla-central/json-pushes?startdate="+date+"&enddate="+nextDate
-        pushlog_json = simplejson.load(urllib.urlopen(pushlog_url))
-        sorted_keys = sorted(map(int,pushlog_json.keys()))
-
-        changesetString = None
-        if oldest:
-           try:
-               pushlog_first = str(sorted_keys.pop(0))
-               changesetString = str(pushlog_json[pushlog_first]['changesets'][0])
-           except:
-              pass
-        else:
-           try:
-              pushlog_last = str(sorted_keys.pop(-1))
-              changesetString = str(pushlog_json[pushlog_last]['changesets'][0])
-           except:
-                   pass
+        # Gets first changeset from a given date via the local pushlog index
+        index = PushlogIndex(os.path.join(self.shellCacheDir, "pushlog-" + url_base(self.repoURL.rstrip("/")) + ".sqlite"),
+                             self.repoURL.rstrip("/") + "/json-pushes")
+        try:
+            changesetString = index.changesetFromDay(date, oldest=oldest)
+        except Exception, e:
+            print "Couldn't read the pushlog: " + str(e)
+            changesetString = None
+        finally:
+            index.close()
 
         if changesetString != None:
             return changesetString
@@ -161,10 +255,7 @@ class Builder():
         #Get or update local trunk -- makeclean means delete old trunk and fetch fresh
         if makeClean:
             print "Making clean trunk environment..."
-            try:
-                shutil.rmtree(self.repoPath)
-            except:
-                pass
+            trash.discard(self.repoPath)
         #Gets or updates our cached repo for building
         if os.path.exists(os.path.join(self.repoPath,".hg")):
             print "Found a recent trunk. Updating it to head before we begin..."
@@ -172,17 +263,24 @@ class Builder():
             print "Update successful."
         else:
             print "Trunk not found."
-            makeClean = subprocess.call(["rm","-rf", self.repoPath])
+            trash.discard(self.repoPath)
             print "Removed old mozbuild-trunk directory. Downloading a fresh repo from mozilla-central..."
             #downloadTrunk = os.popen("hg clone http://hg.mozilla.org/mozilla-central mozbuild-trunk")
             downloadTrunk = subprocess.call(["hg", "clone", self.repoURL, "mozbuild-trunk"], cwd=self.shellCacheDir)
 
+    def mozconfigPath(self):
+        return os.path.join(self.confDir, 'config-default')
+
     def mozconfigure(self):
         #Set mozconfig settings
+        with self.tracer.span("mozconfig"):
+            self.writeMozconfig()
+
+    def writeMozconfig(self):
         print "\nConfiguring mozconfig:"
 
         #Make a place to put our mozconfig
-        mozconfig_path = os.path.join(self.confDir, 'config-default')
+        mozconfig_path = self.mozconfigPath()
         if os.path.exists(mozconfig_path):
             os.unlink(mozconfig_path)
 
@@ -194,7 +292,10 @@ class Builder():
             f=open(mozconfig_path, 'a')
             f.write('mk_add_options MOZ_OBJDIR=@TOPSRCDIR@/obj-ff-dbg\n')
             if sys.platform != "win32" or sys.platform != "cygwin":
-                f.write('mk_add_options MOZ_MAKE_FLAGS="-s -j '+str(self.cores)+'"')
+                f.write('mk_add_options MOZ_MAKE_FLAGS="-s -j '+str(self.cores)+'"\n')
+            if self.compilerCache:
+                f.writelines(self.compilerCache.mozconfigLines())
+            f.close()
             os.environ['MOZCONFIG']=mozconfig_path
             return
 
@@ -213,7 +314,11 @@ class Builder():
             f.write("ac_add_options --enable-application=browser\n")
         else:
             print "Configured to run with "+str(self.cores)+ " cores.\n"
-            f.write('mk_add_options MOZ_MAKE_FLAGS="-s -j '+str(self.cores)+'"')
+            f.write('mk_add_options MOZ_MAKE_FLAGS="-s -j '+str(self.cores)+'"\n')
+
+        if self.compilerCache:
+            print "Using " + self.compilerCache.kind + " with cache directory " + self.compilerCache.cacheDir
+            f.writelines(self.compilerCache.mozconfigLines())
 
         f.close()
 
@@ -225,15 +330,17 @@ class Builder():
         conditionscript = ximport.importRelativeOrAbsolute(testcondition)
         self.bisect(good,bad, testcondition=conditionscript, args_for_condition=args_for_condition)
 
-    def setupTests(self):
-        zippedTests = download_url(getTestUrl(),dest=str(os.path.join(self.shellCacheDir,"tests.zip")))
-        unzip(self.testDir,zippedTests)
+    def setupTests(self, testcondition=None):
+        #Extracted once per package version and reused, only the parts the
+        #condition lists in testPackages (everything if it doesn't say)
+        prefixes = getattr(testcondition, "testPackages", None)
+        self.testDir = self.testPackages.get(getTestUrl(), prefixes)
 
     def bisect(self,good,bad, testcondition=None, args_for_condition=[]):
         #Call hg bisect with initial params, set up building environment (mozconfig)
         #Support for using dates
         if self.testBinaries:
-            self.setupTests()
+            self.setupTests(testcondition)
 
         badDate = re.search(r'(\d\d\d\d-\d\d-\d\d)',good)
         goodDate = re.search(r'(\d\d\d\d-\d\d-\d\d)',bad)
@@ -251,162 +358,587 @@ class Builder():
             print "Bisecting on changeset range " + str(good)[:12] + " to " + str(bad)[:12]
 
         #Get the actual changesets that we will be using
-        good = hgId(good, self.hgPrefix)
-        bad = hgId(bad, self.hgPrefix)
+        good = self.hg.id(good)
+        bad = self.hg.id(bad)
 
         if good and bad and self.validate(good, bad):
             #Valid changesets, so do the bisection
-            subprocess.call(self.hgPrefix+["bisect","--reset"])
-
-            setUpdate = captureStdout(self.hgPrefix+["up",bad])
-            setBad = captureStdout(self.hgPrefix+["bisect","--bad"])
-            setGood = captureStdout(self.hgPrefix+["bisect","--good",good])
-
-            print str(setUpdate)
-            print str(setBad)
-            print str(setGood)
-
-            self.check_done(setGood)
+            self.journal.start(good, bad, condition=getattr(testcondition, "__file__", None),
+                               args=args_for_condition)
+            if self.startBisection(good, bad):
+                return
 
             # Set mozconfig
             self.mozconfigure()
 
-            # Call recursive bisection!
-            self.bisectRecurse(testcondition=testcondition, args_for_condition=args_for_condition)
+            self.runBisection(testcondition=testcondition, args_for_condition=args_for_condition)
 
         else:
             print "Invalid values. Please check your changeset revision numbers."
             print "If the problem persists, try running mozcommitbuilder with the -f flag."
 
+    def resumeBisect(self, testcondition=None, args_for_condition=None):
+        #Continue the bisection recorded in the journal. Changesets that already
+        #have a verdict are handed straight to hg bisect without rebuilding.
+        if not self.journal.load() or not self.journal.active():
+            print "No unfinished bisection to resume."
+            return
+
+        data = self.journal.data
+        if testcondition == None and data.get("condition"):
+            testcondition = ximport.importRelativeOrAbsolute(data["condition"])
+        if args_for_condition == None:
+            args_for_condition = data.get("args", [])
+
+        if self.testBinaries:
+            self.setupTests(testcondition)
+
+        judged = self.journal.judged()
+        print "Resuming bisection of " + data["good"][:12] + " to " + data["bad"][:12] + \
+              " with " + str(len(judged)) + " verdicts already recorded."
+        if self.startBisection(data["good"], data["bad"], judged=judged):
+            return
+
+        self.mozconfigure()
+        self.runBisection(testcondition=testcondition, args_for_condition=args_for_condition)
+
+    def startBisection(self, good, bad, judged=[]):
+        #Start a fresh bisector on good..bad and replay any verdicts we already have.
+        #Returns True if that's enough to find the regression.
+        if self.engine == "native":
+            self.bisector = NativeBisector(self.hg)
+        elif self.engine == "probabilistic":
+            self.bisector = ProbabilisticBisector(self.hg, confidence=self.confidence,
+                                                  falsePositive=self.falsePositive,
+                                                  falseNegative=self.falseNegative)
+        else:
+            self.bisector = HgBisector(self.hg)
+
+        if self.bisector.start(good, bad):
+            self.finishBisection()
+            return True
+
+        for node, verdict in judged:
+            if self.bisector.mark(node, verdict):
+                self.finishBisection()
+                return True
+        return False
+
+    def finishBisection(self):
+        print "Regression found using mozcommitbuilder " + progVersion + " on " + sys.platform + " at " + strftime("%Y-%m-%d %H:%M:%S", gmtime())
+        self.journal.finish(self.bisector.result())
+
+    def serve(self, port=8642, host="127.0.0.1", maxJobs=None):
+        #Run as a job server: concurrent hunts sharing one build scheduler
+        #with a build worker per shared working copy
+        self.cores = max(1, int(self.cores) // self.worktrees.size)
+        self.mozconfigure()
+        serve(self, port=port, host=host, maxJobs=maxJobs)
+
+    def conditionDistOnly(self, testcondition):
+        #Interactive runs only start dist/bin/firefox. A condition script says
+        #it needs nothing else from the objdir (no make targets, no _tests)
+        #with distOnly = True.
+        return testcondition == None or bool(getattr(testcondition, "distOnly", False))
+
+    def runBisection(self, testcondition=None, args_for_condition=[]):
+        #Test one changeset per step, or several per round
+        self.restoreArtifacts = self.conditionDistOnly(testcondition)
+        try:
+            if self.feedCachedVerdicts(self.verdictKey(testcondition, args_for_condition)):
+                return
+            if self.hybrid and self.coarseBisect(testcondition=testcondition, args_for_condition=args_for_condition):
+                return
+            if self.parallel > 1:
+                self.multisect(testcondition=testcondition, args_for_condition=args_for_condition)
+            else:
+                self.bisectLoop(testcondition=testcondition, args_for_condition=args_for_condition)
+        finally:
+            self.tracer.summary()
+            if self.verdicts:
+                self.verdicts.report()
+            httpclient.sharedClient().report()
+
+    def verdictKey(self, testcondition, args_for_condition):
+        #(script hash, args hash, mozconfig fingerprint) for the verdict cache,
+        #None when verdicts can't be cached: interactive bisection, or the
+        #probabilistic engine, which needs independent runs of flaky tests.
+        if not self.verdicts or testcondition == None or self.engine == "probabilistic":
+            return None
+        args = list(args_for_condition)
+        if self.conditions.repeat > 1:
+            #An aggregate of repeated runs is a different verdict than a single run
+            args += ["--repeat=" + str(self.conditions.repeat), self.conditions.rule, str(self.conditions.threshold)]
+        if self.conditions.timeout or self.conditions.memoryLimit:
+            #A run that hits a limit counts as --limit-verdict, so the limits are part of the verdict
+            args += ["--condition-timeout=" + str(self.conditions.timeout),
+                     "--memory-limit=" + str(self.conditions.memoryLimit),
+                     "--limit-verdict=" + self.conditions.limitVerdict]
+        try:
+            return (scriptHash(testcondition), argsHash(args),
+                    mozconfigFingerprint(self.mozconfigPath()))
+        except (IOError, OSError, AttributeError, TypeError):
+            return None
+
+    def archiveFingerprint(self):
+        #Stands in for the mozconfig of builds from the --archive template
+        return "archive-" + hashlib.sha1(self.archive.template).hexdigest()[:12]
+
+    def tryFingerprint(self):
+        #Stands in for the mozconfig of builds from the trypusher server
+        return "try-" + hashlib.sha1(str(self.tryhost) + ":" + str(self.tryport)).hexdigest()[:12]
+
+    def verdictSources(self, key):
+        #Build configurations whose verdicts this run can use: the local
+        #mozconfig, plus wherever this run gets prebuilt binaries from
+        sources = [key[2]]
+        if self.archive != None and (self.remote or self.hybrid):
+            sources.append(self.archiveFingerprint())
+        if self.tryPusher:
+            sources.append(self.tryFingerprint())
+        return sources
+
+    def cachedVerdict(self, node, key, count=True):
+        if key == None:
+            return None
+        for source in self.verdictSources(key):
+            verdict = self.verdicts.get(node, key[0], key[1], source, count=False)
+            if verdict != None:
+                break
+        if count:
+            if verdict != None:
+                self.verdicts.hits += 1
+            else:
+                self.verdicts.misses += 1
+        return verdict
+
+    def storeVerdict(self, node, key, verdict, source=None):
+        #Only real condition results are worth remembering: skips may be
+        #transient, and so may a verdict from a run killed for a limit.
+        #source is the build's configuration (step["source"]) when it wasn't
+        #built locally with our mozconfig.
+        if key == None or verdict not in ("good", "bad"):
+            return
+        if self.conditions.hitLimit():
+            print "Not caching the verdict for " + node[:12] + ", a condition run hit a limit."
+            return
+        self.verdicts.put(node, key[0], key[1], source or key[2], verdict)
+
+    def feedCachedVerdicts(self, key):
+        #Hand every verdict we already know for the range to the bisector
+        #without building. Returns True if that finds the regression.
+        if key == None:
+            return False
+        for node in self.untested():
+            verdict = self.cachedVerdict(node, key, count=False)
+            if verdict == None:
+                continue
+            print "Cached verdict for " + node[:12] + ": " + verdict
+            self.verdicts.hits += 1
+            step = self.journal.beginStep(node)
+            step["cached"] = True
+            self.journal.finishStep(step, verdict)
+            if self.markVerdict(verdict, node):
+                return True
+        return False
+
     def check_done(self, doneString):
-       # Check if we should terminate early because the bisector exited?
-        string_to_parse = str(doneString)
-
-        branch_unaware_flag = string_to_parse.find("Not all ancestors")
-        traceback_flag = string_to_parse.find("--extend")
-        regression_found = string_to_parse.find("The first")
-
-        if traceback_flag > -1:
-            #hg 1.9 and up only has --extend, which is branch aware
-            print "Using hg 1.9, we're branch aware! Let's explore that ancestor branch..."
-            subprocess.call(self.hgPrefix+["bisect","--extend"])
-        elif branch_unaware_flag > -1:
-            print "Not using hg 1.9 (not automatic) so you need to bisect again with the above changeset."
-        elif regression_found > -1:
+        # Check if we should terminate early because hg bisect exited?
+        # Returns True once the regression has been found.
+        if HgBisector(self.hg).check(doneString):
             print "Regression found using mozcommitbuilder " + progVersion + " on " + sys.platform + " at " + strftime("%Y-%m-%d %H:%M:%S", gmtime())
-            quit()
+            return True
+        return False
+
+    def markVerdict(self, verdict, changeset=None):
+        # Tell the bisector a changeset is good, bad, or skip (hg: the working copy
+        # unless changeset is given). Returns True once the regression is found.
+        with self.tracer.span("bisect", verdict=verdict):
+            found = self.bisector.mark(changeset, verdict)
+        if found:
+            self.finishBisection()
+        return found
+
+    def bisectLoop(self, testcondition=None, args_for_condition=[]):
+        #Build, run, and prompt until the bisector names the regression.
+        #Every step goes into the journal so --resume can pick it up.
+        key = self.verdictKey(testcondition, args_for_condition)
+        while True:
+            midpoint = self.bisector.current()
+            if midpoint == None:
+                return
+            current_revision, predicted = self.chooseRevision(midpoint)
+            if current_revision != self.hg.node("."):
+                with self.tracer.span("hg update", changeset=current_revision[:12]):
+                    self.hg.capture(["update",current_revision])
+            step = self.journal.beginStep(current_revision)
+            step["predictedCost"] = predicted
+
+            verdict = self.cachedVerdict(current_revision, key)
+            if verdict != None:
+                print "Cached verdict for " + current_revision[:12] + ": " + verdict
+                step["cached"] = True
+            else:
+                verdict = self.testRevision(current_revision, step, testcondition=testcondition,
+                                            args_for_condition=args_for_condition)
+                self.costModel.record(current_revision, predicted, step["buildTime"])
+                self.storeVerdict(current_revision, key, verdict, source=step.get("source"))
+            verdict = self.promptVerdict(verdict)
+            self.journal.finishStep(step, verdict)
+
+            if self.markVerdict(verdict, current_revision):
+                return
+
+    def coarseBisect(self, testcondition=None, args_for_condition=[]):
+        #First phase of --hybrid: narrow the range using only changesets that
+        #already have a build, in the artifact cache or the archive, so only
+        #the gap between the nearest prebuilt ones is left to compile.
+        #Returns True if that's enough to find the regression.
+        key = self.verdictKey(testcondition, args_for_condition)
+        tried = set()
+        tested = 0
+        while True:
+            midpoint = self.bisector.current()
+            if midpoint == None:
+                return True
+            node = self.choosePrebuilt(midpoint, tried)
+            if node == None:
+                print "Tested " + str(tested) + " prebuilt changesets, " + str(len(self.untested())) + \
+                      " changesets left to build locally."
+                return False
+            tried.add(node)
+            tested += 1
+            if node != midpoint:
+                print "Testing prebuilt " + node[:12] + " instead of midpoint " + midpoint[:12]
+
+            step = self.journal.beginStep(node)
+            step["phase"] = "coarse"
+            verdict = self.cachedVerdict(node, key)
+            if verdict != None:
+                print "Cached verdict for " + node[:12] + ": " + verdict
+                step["cached"] = True
+            else:
+                archived = self.archivedBuilds.get(node)
+                if archived:
+                    verdict = self.testArchivedBuild(archived, step, testcondition=testcondition,
+                                                     args_for_condition=args_for_condition)
+                else:
+                    #Restored from the artifact cache by build(), nothing compiles
+                    with self.tracer.span("hg update", changeset=node[:12]):
+                        self.hg.capture(["update", node])
+                    verdict = self.testRevision(node, step, testcondition=testcondition,
+                                                args_for_condition=args_for_condition)
+                self.storeVerdict(node, key, verdict, source=step.get("source"))
+            verdict = self.promptVerdict(verdict)
+            self.journal.finishStep(step, verdict)
+
+            if self.markVerdict(verdict, node):
+                return True
+
+    def choosePrebuilt(self, midpoint, tried=()):
+        #The untested changeset with a prebuilt binary closest to midpoint, or
+        #None. Only the self.prebuiltProbes nearest changesets that haven't
+        #been looked up yet are asked for in the archive, so a sparse archive
+        #costs a few listings per step rather than one per changeset.
+        untested = self.untested()
+        index = len(untested) // 2
+        if midpoint in untested:
+            index = untested.index(midpoint)
+        probes = 0
+        for i in sorted(range(len(untested)), key=lambda i: abs(i - index)):
+            node = untested[i]
+            if node in tried:
+                continue
+            if self.restorableArtifact(node):
+                return node
+            if self.archive == None:
+                continue
+            if node not in self.archivedBuilds:
+                if probes >= self.prebuiltProbes:
+                    continue
+                probes += 1
+            if self.hasPrebuilt(node):
+                return node
+        return None
+
+    def hasPrebuilt(self, node):
+        #Whether node can be tested without compiling. Archive lookups are remembered.
+        if self.restorableArtifact(node):
+            return True
+        if self.archive == None:
+            return False
+        if node not in self.archivedBuilds:
+            with self.tracer.span("archive lookup", changeset=node[:12]):
+                self.archivedBuilds[node] = self.archive.find(node)
+        return self.archivedBuilds[node] != None
 
     def bisectRecurse(self, testcondition=None, args_for_condition=[]):
-        #Recursively build, run, and prompt
+        #Kept for API users, bisection is loop driven now
+        self.bisectLoop(testcondition=testcondition, args_for_condition=args_for_condition)
+
+    def untested(self):
+        #Changesets the bisector still has to look at, in revision order
+        return self.bisector.untested()
+
+    def changedFiles(self, fromRev, toRev):
+        return strsplit(self.hg.capture(["status","--rev",fromRev,"--rev",toRev,"-m","-a","-r","-n"]), "\n")
+
+    def chooseRevision(self, midpoint):
+        #Look up to self.window changesets either side of hg's midpoint for the
+        #one that's cheapest to build from what's in the objdir right now.
+        #Returns (changeset, predicted cost), the cost is None if we didn't look.
+        if self.window <= 0 or self.remote or self.tryPusher:
+            return (midpoint, None)
+
+        builtNode = self.builtNode(self.objdir)
+        untested = self.untested()
+        if not builtNode or midpoint not in untested:
+            return (midpoint, None)
+
+        index = untested.index(midpoint)
+        best = None
+        for i in range(max(0, index - self.window), min(len(untested), index + self.window + 1)):
+            node = untested[i]
+            if self.restorableArtifact(node):
+                cost = 0.0
+            else:
+                cost = self.costModel.estimate(self.changedFiles(builtNode, node))
+            if best == None or (cost, abs(i - index)) < (best[1], best[2]):
+                best = (node, cost, abs(i - index))
+
+        if best[0] != midpoint:
+            print "Testing " + best[0][:12] + " instead of midpoint " + midpoint[:12] + \
+                  " (" + str(best[2]) + " changesets away, predicted rebuild cost " + str(best[1]) + ")"
+        return (best[0], best[1])
+
+    def testRevision(self, current_revision, step, testcondition=None, args_for_condition=[]):
+        #Get a build of the working copy and judge it. Returns the verdict, or ""
+        #if the user still has to be asked. Timings go into step.
         verdict = ""
-        current_revision = captureStdout(self.hgPrefix+["id","-i"])
 
+        archived = None
         if self.remote:
-            print "on current revision "+current_revision
-            print "This would ask for a remote changeset, but it's not implemented yet."
-            #TODO:
-            #Remote bisection!
-            #Step 1. Check if revision is in the archive
-            #Step 2. If revision is not in the archive, set remote=False and continue (it will build and bisect that revision)
-            #if not check_archived:
-            #    set remote false and continue
-            #else:
-            #Step 3. If the revision is in the archive, download it and its corresponding tests
-                #STEP3
-                #1. Extract tests into some directory
-                #2. Extract Nightly.app into "tests"
-                #MozInstaller(src=, dest="", dest_app="Nightly.app")
-                #3. run the following:
-                #test_command = ['python', 'mochitest/runtests.py', '--appname=./Nightly.app/Contents/MacOS/firefox-bin', '--utility-path=bin', '--extra-profile-file=bin/plugins', '--certificate-path=certs', '--autorun', '--close-when-done', '--console-level=INFO', '--test-path=test_name']
-                #output = captureStdout(test_command, ignoreStderr=True)
-                #set verdict based on output
-                #python mochitest/runtests.py --appname=./Nightly.app/Contents/MacOS/firefox-bin --utility-path=bin --extra-profile-file=bin/plugins --certificate-path=certs --autorun --close-when-done --console-level=INFO --test-path=test_name
-
-                #example test name: Harness_sanity/test_sanityException.html
-                #Step 4. Run and run test to get verdict
-                #Step 5. Set verdict
+            archived = self.findArchivedBuild(current_revision)
+
+        if archived:
+            verdict = self.testArchivedBuild(archived, step, testcondition=testcondition,
+                                             args_for_condition=args_for_condition)
 
         elif self.tryPusher:
+            step["source"] = self.tryFingerprint()
+            buildStart = time.time()
             try:
-                caller = BuildCaller(host=self.tryhost, port=int(self.tryport), data=current_revision)
-                print "Getting revision "+current_revision+"..."
+                caller = BuildCaller(host=self.tryhost, port=int(self.tryport), data=current_revision[:12])
+                print "Getting revision "+current_revision[:12]+"..."
             except:
                 print "Failed to connect to trypusher. Make sure your settings are correct and that the trypusher server was started."
                 exit()
-            response = caller.getChangeset()
-            print "Waiting on Mozilla Pulse for revision " + response + "..."
-            url = caller.getURLResponse(response)
+            with self.tracer.span("try build", changeset=current_revision[:12]):
+                response = caller.getChangeset()
+                print "Waiting on Mozilla Pulse for revision " + response + "..."
+                url = caller.getURLResponse(response)
             print "the base is " +url_base(url)
             #Download it here
-            #1. Download from url, extract to same place as tests
+            #1. Download from url, extract into this build's own directory
             #2. Run test or start browser.
-            binary_path =  os.path.join(self.binaryDir,url_base(url))
-            downloaded_binary = download_url(url, dest=str(binary_path))
-            MozInstaller(src=str(binary_path), dest=str(self.testDir), dest_app="Nightly.app")
-            #now nightly is installed in
-            if sys.platform == "darwin":
-                binary_path = os.path.join(self.testDir,"Nightly.app")
-                runner = FirefoxRunner(binary=os.path.join(binary_path,"Contents","MacOS")+"/firefox-bin")
-            elif sys.platform == "linux2":
-                binary_path = os.path.join(self.testDir,"firefox")
-                runner = FirefoxRunner(binary=binary_path)
-            elif sys.platform == "win32" or sys.platform == "cygwin":
-                binary_path = os.path.join(self.testDir,"firefox.exe")
-                runner = FirefoxRunner(binary=binary_path)
+            #Try packages have the same name for every changeset, so each
+            #changeset downloads into its own directory
+            binary_path =  os.path.join(self.binaryDir, "downloads", "try", current_revision, url_base(url))
+            installDir = self.tryInstallDir(current_revision)
+            if compression(url):
+                #Tarballs are unpacked while they download
+                with self.tracer.span("download and install", url=url):
+                    streamInstall(url, str(installDir), dest=str(binary_path))
             else:
-                print "Your platform is not currently supported."
-                quit()
-
-            dest = runner.start()
-            if not dest:
-                print "Failed to start the downloaded binary"
-                verdict == "skip"
-            runner.wait()
+                with self.tracer.span("download", url=url):
+                    downloaded_binary = download_url(url, dest=str(binary_path))
+                with self.tracer.span("install", changeset=current_revision[:12]):
+                    MozInstaller(src=str(binary_path), dest=str(installDir), dest_app="Nightly.app")
+            step["buildTime"] = time.time() - buildStart
+            step["artifact"] = binary_path
+
+            testStart = time.time()
+            #now nightly is installed in
+            runner = FirefoxRunner(binary=self.installedBinary(installDir))
+
+            with self.tracer.span("run", changeset=current_revision[:12]):
+                dest = runner.start()
+                if not dest:
+                    print "Failed to start the downloaded binary"
+                    verdict = "skip"
+                runner.wait()
             if verdict == "skip":
                 pass
             elif testcondition!=None:
                 #Support condition scripts where arg0 is the directory with the binary and tests
-                args_to_pass = [self.testDir] + args_for_condition
-
-                if hasattr(testcondition, "init"):
-                    testcondition.init(args_to_pass)
-
-                #TODO: refactor to use directories with revision numbers
-                #8.2.11 - revision number can now be found in current_revision variable
-                tmpdir = tempfile.mkdtemp()
-                verdict = testcondition.interesting(args_to_pass,tmpdir)
-
-                #Allow user to return true/false or bad/good
-                if verdict != "bad" and verdict != "good":
-                    verdict = "bad" if verdict else "good"
+                verdict = self.runCondition(testcondition, args_for_condition, installDir)
+            step["testTime"] = time.time() - testStart
         else:
+            buildStart = time.time()
             try:
                 self.build()
             except Exception:
                 print "This build failed!"
                 verdict = "skip"
+            step["buildTime"] = time.time() - buildStart
+            step["artifact"] = self.artifactPath(current_revision)
 
+            testStart = time.time()
             if verdict == "skip":
                 pass
             elif testcondition==None:
                 #Not using a test, interactive bisect begin!
-                self.run()
+                with self.tracer.span("run", changeset=current_revision[:12]):
+                    self.run()
             else:
                 #Using Jesse's idea: import any testing script and run it as the truth condition
-                args_to_pass = [self.objdir] + args_for_condition
-
-                if hasattr(testcondition, "init"):
-                    testcondition.init(args_to_pass)
-
-                #TODO: refactor to use directories with revision numbers
-                #8.2.11 - revision number can now be found in current_revision variable
-                tmpdir = tempfile.mkdtemp()
-                verdict = testcondition.interesting(args_to_pass,tmpdir)
+                verdict = self.runCondition(testcondition, args_for_condition, self.objdir)
+            step["testTime"] = time.time() - testStart
+
+        return verdict
+
+    def findArchivedBuild(self, node):
+        #The archived build of node, or None to build it locally
+        if self.archive == None:
+            return None
+        archived = self.archivedBuilds.get(node)
+        if node not in self.archivedBuilds:
+            with self.tracer.span("archive lookup", changeset=node[:12]):
+                archived = self.archivedBuilds[node] = self.archive.find(node)
+        if archived == None:
+            print "No archived build of " + node[:12] + ", building it locally."
+        return archived
+
+    def tryInstallDir(self, node):
+        #Fresh directory for a try build of node, with the entries of the
+        #shared test package linked in next to where the build goes, so
+        #installing never writes into the package store
+        installDir = os.path.join(self.binaryDir, "try", node[:12])
+        trash.discard(installDir)
+        os.makedirs(installDir)
+        if os.path.isdir(self.testDir):
+            for name in os.listdir(self.testDir):
+                source = os.path.join(self.testDir, name)
+                if hasattr(os, "symlink"):
+                    os.symlink(source, os.path.join(installDir, name))
+                elif os.path.isdir(source):
+                    shutil.copytree(source, os.path.join(installDir, name))
+                else:
+                    shutil.copy2(source, installDir)
+        return installDir
+
+    def installArchivedBuild(self, archived):
+        #Fetch and install an archived build and its tests into their own
+        #directory. Returns that directory.
+        installDir = os.path.join(self.binaryDir, "archived", archived.node[:12])
+        trash.discard(installDir)
+        os.makedirs(installDir)
+        build = archived.binary + " " + str(archived.tests)
+        if self.installs != None and self.installs.materialize(build, installDir):
+            return installDir
+        #Downloads live apart from the install so an interrupted one can resume
+        downloadDir = os.path.join(self.binaryDir, "downloads", archived.node[:12])
+        with self.tracer.span("download and install", url=archived.binary):
+            streamed = self.archive.streamInstall(archived.binary, downloadDir, installDir,
+                                                  checksums=archived.checksums, store=self.installs)
+        if not streamed:
+            with self.tracer.span("download", url=archived.binary):
+                binary = self.archive.fetch(archived.binary, downloadDir, checksums=archived.checksums)
+            with self.tracer.span("install", changeset=archived.node[:12]):
+                if self.installs != None and (binary.endswith(".zip") or compression(binary)):
+                    #Written through the store, so files it has are only linked
+                    extract(str(binary), installDir, store=self.installs)
+                else:
+                    MozInstaller(src=str(binary), dest=str(installDir), dest_app="Nightly.app")
+        if archived.tests:
+            with self.tracer.span("download", url=archived.tests):
+                tests = self.archive.fetch(archived.tests, downloadDir, checksums=archived.checksums)
+            with self.tracer.span("install", changeset=archived.node[:12]):
+                unzip(installDir, tests, store=self.installs)
+        if self.installs != None:
+            with self.tracer.span("deduplicate", changeset=archived.node[:12]):
+                self.installs.ingest(installDir, build)
+        return installDir
+
+    def testArchivedBuild(self, archived, step, testcondition=None, args_for_condition=[]):
+        #Same as a local build step, but nothing gets compiled
+        verdict = ""
+        step["source"] = self.archiveFingerprint()
+        buildStart = time.time()
+        print "Using archived build " + archived.binary
+        try:
+            installDir = self.installArchivedBuild(archived)
+        except Exception, e:
+            print "Couldn't install the archived build: " + str(e)
+            return "skip"
+        step["buildTime"] = time.time() - buildStart
+        step["artifact"] = archived.binary
+
+        testStart = time.time()
+        if testcondition == None:
+            with self.tracer.span("run", changeset=archived.node[:12]):
+                runner = FirefoxRunner(binary=self.installedBinary(installDir))
+                if not runner.start():
+                    print "Failed to start the archived binary"
+                    verdict = "skip"
+                runner.wait()
+        else:
+            #arg0 is the directory with the binary and tests, like the try builds
+            verdict = self.runCondition(testcondition, args_for_condition, installDir)
+        step["testTime"] = time.time() - testStart
+        return verdict
 
-                #Allow user to return true/false or bad/good
-                if verdict != "bad" and verdict != "good":
-                    verdict = "bad" if verdict else "good"
+    def installedBinary(self, directory):
+        #Path of the firefox binary MozInstaller put into directory
+        if sys.platform == "darwin":
+            return os.path.join(directory,"Nightly.app","Contents","MacOS")+"/firefox-bin"
+        elif sys.platform == "linux2":
+            return os.path.join(directory,"firefox","firefox")
+        elif sys.platform == "win32" or sys.platform == "cygwin":
+            return os.path.join(directory,"firefox","firefox.exe")
+        else:
+            print "Your platform is not currently supported."
+            quit()
 
+    def restorableArtifact(self, node):
+        #Cached build of node that build() would restore instead of compiling
+        if not self.restoreArtifacts:
+            return None
+        return self.artifactPath(node)
+
+    def artifactPath(self, node):
+        #Path of the cached build of node, if there is one
+        if not self.artifacts or not node:
+            return None
+        artifact = self.artifacts.path(node, mozconfigFingerprint(self.mozconfigPath()))
+        if os.path.exists(artifact):
+            return artifact
+        return None
+
+    def runCondition(self, testcondition, args_for_condition, objdir):
+        #Run a condition script against objdir and return "good" or "bad"
+        with self.tracer.span("condition", objdir=objdir):
+            return self.callCondition(testcondition, args_for_condition, objdir)
+
+    def callCondition(self, testcondition, args_for_condition, objdir):
+        #Conditions loaded from a file run in worker processes, with limits
+        #and repeats. Anything else (e.g. a module built on the fly) runs here.
+        script = getattr(testcondition, "__file__", None)
+        if script:
+            return self.conditions.run(script, objdir, args_for_condition)
+        self.conditions.local.limited = False
+
+        args_to_pass = [objdir] + args_for_condition
+
+        if hasattr(testcondition, "init"):
+            testcondition.init(args_to_pass)
+
+        #TODO: refactor to use directories with revision numbers
+        tmpdir = tempfile.mkdtemp()
+        return normalizeVerdict(testcondition.interesting(args_to_pass,tmpdir))
+
+    def promptVerdict(self, verdict=""):
+        #Ask the user until we get a usable verdict
         while verdict not in ["good", "bad", "skip"]:
             verdict = raw_input("Was this commit good or bad? (type 'good', 'bad', or 'skip'): ")
             if verdict == 'g':
@@ -415,58 +947,217 @@ class Builder():
                 verdict = "bad"
             if verdict == 's':
                 verdict = "skip"
-
-        # do hg bisect --good, --bad, or --skip
-        verdictCommand = self.hgPrefix+["bisect","--"+verdict]
-        print " ".join(verdictCommand)
-        retval = captureStdout(verdictCommand)
-
-        string_to_parse = str(retval)
-        print string_to_parse
-
-        self.check_done(string_to_parse)
-
-        if retval.startswith("Testing changeset"):
-            print "\n"
-
-        self.bisectRecurse(testcondition=testcondition, args_for_condition=args_for_condition)
+        return verdict
+
+    def multisect(self, testcondition=None, args_for_condition=[]):
+        #k-ary bisection: build several evenly spaced changesets of the
+        #remaining range at once, each in its own shared working copy
+        #Split our cores between the simultaneous builds
+        self.cores = max(1, int(self.cores) // self.parallel)
+        self.mozconfigure()
+        key = self.verdictKey(testcondition, args_for_condition)
+
+        while True:
+            untested = self.untested()
+            if not untested:
+                print "No untested changesets left in the range."
+                return
+
+            #Pick evenly spaced changesets so the range shrinks to 1/(N+1)
+            if len(untested) <= self.parallel:
+                picks = untested
+            else:
+                stride = len(untested) / float(self.parallel + 1)
+                picks = [untested[int(stride * (i + 1))] for i in range(self.parallel)]
+
+            print "Testing " + str(len(picks)) + " of " + str(len(untested)) + " untested changesets: " + \
+                  ", ".join([node[:12] for node in picks])
+
+            #Build them all at once, each in the warm working copy closest to it
+            failed = {}
+            leases = {}
+            steps = {}
+            cached = {}
+            threads = []
+            for node in picks:
+                steps[node] = self.journal.beginStep(node)
+                verdict = self.cachedVerdict(node, key)
+                if verdict != None:
+                    cached[node] = verdict
+                    steps[node]["cached"] = True
+                    continue
+                thread = threading.Thread(target=self.buildInWorktree, args=(node, leases, failed, steps[node]))
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+
+            #Judge each build, then hand all the verdicts to hg bisect
+            verdicts = []
+            for node in picks:
+                verdict = ""
+                lease = leases.get(node)
+                testStart = time.time()
+                try:
+                    if node in cached:
+                        print "Cached verdict for " + node[:12] + ": " + cached[node]
+                        verdict = cached[node]
+                    elif node in failed or lease == None:
+                        print "The build of " + node[:12] + " failed!"
+                        verdict = "skip"
+                    elif testcondition == None:
+                        print "Running " + node[:12] + "..."
+                        with self.tracer.span("run", changeset=node[:12]):
+                            self.run(objdir=lease.objdir)
+                    else:
+                        verdict = self.runCondition(testcondition, args_for_condition, lease.objdir)
+                        self.storeVerdict(node, key, verdict)
+                    verdict = self.promptVerdict(verdict)
+                finally:
+                    if lease != None:
+                        lease.release(node=node)
+                steps[node]["testTime"] = time.time() - testStart
+                steps[node]["artifact"] = self.artifactPath(node)
+                self.journal.finishStep(steps[node], verdict)
+                verdicts.append((node, verdict))
+
+            for node, verdict in verdicts:
+                if self.markVerdict(verdict, node):
+                    return
+
+    def buildInWorktree(self, node, leases, failed, step):
+        #Thread body for multisect. The lease is released by the caller.
+        buildStart = time.time()
+        try:
+            lease = self.leaseWorktree(node)
+            leases[node] = lease
+            self.build(changeset=node, worktree=lease.path)
+        except Exception, e:
+            print "Build of " + node[:12] + " failed: " + str(e)
+            failed[node] = True
+        step["buildTime"] = time.time() - buildStart
+
+    def leaseWorktree(self, changeset=None):
+        #Lease the free shared working copy whose last build is closest to
+        #changeset, for build(changeset, worktree=lease.path). Call
+        #lease.release(node) when done so the next lease knows what's warm.
+        return self.worktrees.lease(changeset)
 
     def buildAndRun(self, changeset=0):
         #API convenience function
+        self.restoreArtifacts = True
         self.build(changeset=changeset)
         #print "Starting up Firefox..."
         self.run()
         #print "Complete! Firefox should be running."
 
-    def build(self, changeset=0):
+    def build(self, changeset=0, worktree=None):
         #Build a binary and return the file path
         #Binary file named by changeset number
+        #worktree is an alternative working copy to build in (default: the trunk)
+        repoPath = worktree or self.repoPath
+        hg = self.hgClient(repoPath)
+        objdir = os.path.join(repoPath, "obj-ff-dbg")
+
         if changeset != 0:
             changeset = str(changeset)
             print "Switching to revision "+changeset[:8]+"..."
-            subprocess.call(self.hgPrefix+["update",changeset]) #switch to a given directory
+            with self.tracer.span("hg update", changeset=changeset[:12]):
+                (retval, out, err) = hg.run(["update",changeset]) #switch to a given directory
+                print out + err
+
+        #Reuse a build of this exact changeset and mozconfig if we have one
+        #and only dist/ is going to be used
+        node = hg.node(".")
+        fingerprint = mozconfigFingerprint(self.mozconfigPath())
+        if self.restoreArtifacts and self.artifacts and node and self.artifacts.has(node, fingerprint):
+            print "Found cached build of "+node[:12]+", skipping compile."
+            with self.tracer.span("artifact restore", changeset=node[:12]):
+                restored = self.artifacts.restore(node, fingerprint, objdir)
+            if restored:
+                self.setBuiltNode(objdir, node)
+                return
 
         #Call make on our cached trunk
         print "Building..."
-        makeData = captureStdout(self.makeCommand, ignoreStderr=True,
-                                                        currWorkingDir=self.repoPath)
-        if showMakeData == 1:
-            print makeData
+        self.beginCompilerStats()
+        #Stream make's output to a log instead of holding it all in memory
+        logPath = os.path.join(self.logDir, os.path.basename(repoPath) + "-build.log")
+        try:
+            try:
+                with self.tracer.span("make", changeset=(node or "")[:12]):
+                    streamCommand(self.makeCommand, currWorkingDir=repoPath, logPath=logPath,
+                                  abortOnError=self.abortOnError, echo=(showMakeData == 1))
+            except BuildError, e:
+                print e.tail
+                print str(e) + ", full log in " + logPath
+                raise
+            print "Build complete!"
+        finally:
+            self.endCompilerStats()
+        self.setBuiltNode(objdir, node)
+
+        #Only worth packing up if this run could ever restore it
+        if self.restoreArtifacts and self.artifacts and node:
+            print "Caching build of "+node[:12]+"..."
+            try:
+                with self.tracer.span("artifact store", changeset=node[:12]):
+                    self.artifacts.store(node, fingerprint, os.path.join(objdir, "dist"))
+            except Exception, e:
+                print "Failed to cache build: " + str(e)
 
-        print "Build complete!"
+    def builtNode(self, objdir):
+        #Changeset the objdir was last compiled from, or None
+        try:
+            f = open(os.path.join(objdir, ".commitbuilder-node"))
+            node = f.read().strip()
+            f.close()
+            return node or None
+        except IOError:
+            return None
+
+    def beginCompilerStats(self):
+        if not self.compilerCache:
+            return
+        self.compilerCacheLock.acquire()
+        try:
+            if self.compilerCacheBuilds == 0:
+                self.compilerCache.zeroStats()
+            self.compilerCacheBuilds += 1
+        finally:
+            self.compilerCacheLock.release()
+
+    def endCompilerStats(self):
+        if not self.compilerCache:
+            return
+        self.compilerCacheLock.acquire()
+        try:
+            self.compilerCacheBuilds -= 1
+            if self.compilerCacheBuilds == 0:
+                self.compilerCache.report()
+        finally:
+            self.compilerCacheLock.release()
+
+    def setBuiltNode(self, objdir, node):
+        if not node or not os.path.isdir(objdir):
+            return
+        f = open(os.path.join(objdir, ".commitbuilder-node"), "w")
+        f.write(node)
+        f.close()
 
-    def run(self):
+    def run(self, objdir=None):
         #Run the built binary if it exists. ONLY WORKS IF BUILD WAS CALLED!
+        objdir = objdir or self.objdir
         if sys.platform == "darwin":
-            runner = FirefoxRunner(binary=os.path.join(self.shellCacheDir,"mozbuild-trunk","obj-ff-dbg","dist","NightlyDebug.app","Contents","MacOS")+"/firefox-bin")
+            runner = FirefoxRunner(binary=os.path.join(objdir,"dist","NightlyDebug.app","Contents","MacOS")+"/firefox-bin")
             runner.start()
             runner.wait()
         elif sys.platform == "linux2":
-            runner = FirefoxRunner(binary=os.path.join(self.shellCacheDir,"mozbuild-trunk","obj-ff-dbg","dist","bin") + "/firefox")
+            runner = FirefoxRunner(binary=os.path.join(objdir,"dist","bin") + "/firefox")
             runner.start()
             runner.wait()
         elif sys.platform == "win32" or sys.platform == "cygwin":
-            runner = FirefoxRunner(binary=os.path.join(self.shellCacheDir,"mozbuild-trunk","obj-ff-dbg","dist","bin") + "/firefox.exe")
+            runner = FirefoxRunner(binary=os.path.join(objdir,"dist","bin") + "/firefox.exe")
             runner.start()
             runner.wait()
         else:
@@ -480,8 +1171,9 @@ class Builder():
 
         #Run "make package"
         print "Making binary..."
-        makeData = captureStdout(["make","package"], ignoreStderr=True,
-                                 currWorkingDir=os.path.join(self.repoPath,"obj-ff-dbg"))
+        with self.tracer.span("make package", changeset=str(revision)[:12]):
+            makeData = captureStdout(["make","package"], ignoreStderr=True,
+                                     currWorkingDir=os.path.join(self.repoPath,"obj-ff-dbg"))
 
         binary = None
         renamedBinary = None
@@ -552,6 +1244,24 @@ def cli():
     group1.add_option("-f", "--freshtrunk", action = "store_true", dest="makeClean", default=False,
                                         help="Delete old trunk and use a fresh one")
 
+    group1.add_option("--compiler-cache", dest="compilerCache", default=None, metavar="[ccache|sccache]",
+                                        help="Compile through ccache or sccache, with its cache in the cache directory")
+
+    group1.add_option("--compiler-cache-size", dest="compilerCacheSize", default="10G", metavar="[size]",
+                                        help="Size budget for the compiler cache (default: %default)")
+
+    group1.add_option("--trace", dest="trace", default=None, metavar="[path]",
+                                        help="Write a timing span for every build and bisection phase to this file")
+
+    group1.add_option("--trace-format", dest="traceFormat", default="json", metavar="[json|chrome]",
+                                        help="JSON lines, or Chrome trace-event format for chrome://tracing (default: %default)")
+
+    group1.add_option("--abort-on-error", action="store_true", dest="abortOnError", default=False,
+                                        help="Stop make at the first fatal compiler or linker error (the changeset is skipped)")
+
+    group1.add_option("--nocache", action="store_false", dest="useCache", default=True,
+                                        help="Always compile, never reuse builds from the artifact cache")
+
 
     group2 = OptionGroup(parser, "Bisector Options",
                                         "These are options for bisecting on changesets. Dates are retrieved from pushlog " \
@@ -586,6 +1296,31 @@ def cli():
                                         "Options for using an automated test instead of interactive prompting for bisection. " \
                                         "Please read documentation on how to write testing functions for this script.")
 
+    group5.add_option("--no-verdict-cache", action="store_false", dest="useVerdictCache", default=True,
+                                        help="Always build and test, never reuse verdicts from earlier runs of the same condition")
+
+    group5.add_option("--forget-verdicts", dest="forgetVerdicts", default=None, metavar="[condtest.py or hash]",
+                                        help="Drop all cached verdicts of a condition script (by path or source hash) and exit")
+
+    group5.add_option("--repeat", dest="repeat", type="int", default=1, metavar="[N]",
+                                        help="Run the condition N times per changeset, in parallel across cores if the script sets parallelSafe")
+
+    group5.add_option("--aggregate", dest="aggregation", default="any-fail",
+                                        choices=["any-fail", "majority", "threshold"],
+                                        help="How repeated runs combine into one verdict: any-fail, majority or threshold (default any-fail)")
+
+    group5.add_option("--threshold", dest="threshold", type="float", default=0.5, metavar="[fraction]",
+                                        help="With --aggregate=threshold, the fraction of bad runs that makes a changeset bad (default 0.5)")
+
+    group5.add_option("--condition-timeout", dest="conditionTimeout", type="float", default=None, metavar="[seconds]",
+                                        help="Kill a condition run after this many seconds")
+
+    group5.add_option("--memory-limit", dest="memoryLimit", type="int", default=None, metavar="[MB]",
+                                        help="Kill a condition run that uses more than this much memory")
+
+    group5.add_option("--limit-verdict", dest="limitVerdict", default="skip", choices=["skip", "bad"],
+                                        help="Verdict of a run killed by --condition-timeout or --memory-limit: skip or bad (default skip)")
+
     group5.add_option("-c", "--condition", dest="condition", default=None, metavar="[condtest.py -opt1 -opt2]",
                                         help="External condition for bisecting. " \
                                              "Note: THIS MUST BE THE LAST OPTION CALLED.")
@@ -604,10 +1339,82 @@ def cli():
                                         help="Trypusher Port",
                                         default=8080)
 
+    group2.add_option("--parallel", dest="parallel", type="int", default=1, metavar="[N]",
+                                        help="Build and test N changesets of the range at once, in separate " \
+                                             "working copies (default: %default)")
+
+    group2.add_option("--worktrees", dest="worktrees", type="int", default=None, metavar="[N]",
+                                        help="Number of shared working copies to keep warm for parallel builds " \
+                                             "(default: the --parallel value)")
+
+    group2.add_option("--engine", dest="engine", default="hg", metavar="[hg|native|probabilistic]",
+                                        help="Bisect with hg bisect, natively over a DAG of the range loaded once, " \
+                                             "or probabilistically for flaky conditions (default: %default)")
+
+    group2.add_option("--confidence", dest="confidence", type="float", default=0.95, metavar="[p]",
+                                        help="Probabilistic engine: stop once a culprit is this likely (default: %default)")
+
+    group2.add_option("--false-positive", dest="falsePositive", type="float", default=0.05, metavar="[p]",
+                                        help="Probabilistic engine: chance the condition calls a good changeset bad (default: %default)")
+
+    group2.add_option("--false-negative", dest="falseNegative", type="float", default=0.05, metavar="[p]",
+                                        help="Probabilistic engine: chance the condition calls a bad changeset good (default: %default)")
+
+    group2.add_option("--window", dest="window", type="int", default=0, metavar="[N]",
+                                        help="Test the changeset that is cheapest to rebuild within N changesets " \
+                                             "of the midpoint (default: %default, always the midpoint)")
+
+    group2.add_option("--resume", action="store_true", dest="resume", default=False,
+                                        help="Continue the last unfinished bisection from its journal")
+
+    group2.add_option("--journal", dest="journal", default=None, metavar="[path]",
+                                        help="Where to record bisection steps (default: bisect-journal.json in the cache directory)")
+
+    group2.add_option("--hybrid", action="store_true", dest="hybrid", default=False,
+                                        help="Narrow the range with cached and --archive builds first, then build " \
+                                             "locally only in the gap between the nearest ones")
+
     group2.add_option("-r", "--remote", action="store_true", dest="remote",
-                                        help="Use remote build cache to avoid extra builds (NOT YET WORKING)",
+                                        help="Test archived binaries from --archive instead of building, " \
+                                             "building locally only what isn't archived",
                                         default=False)
 
+    group2.add_option("--archive", action="append", dest="archive", default=[], metavar="[[platform=]template]",
+                                        help="Where --remote finds binaries: a URL or directory with {node}, {short} " \
+                                             "and {platform} in it. End it with / to search a directory for the " \
+                                             "binary and tests. Repeat with platform= (linux-x86_64, linux-i686, " \
+                                             "mac, win32) for per platform templates")
+
+    group2.add_option("--install-links", dest="installLinks", default="hardlink",
+                                        choices=["hardlink", "reflink", "none"], metavar="[hardlink|reflink|none]",
+                                        help="How archived installs share identical files through the install " \
+                                             "store: hard links, copy on write reflinks (btrfs, xfs) or not at " \
+                                             "all (default: hardlink)")
+
+    group8 = OptionGroup(parser, "Job Server Options",
+                                        "Run many bisections at once in a long-running server that shares "
+                                        "builds between them, and talk to it.")
+
+    group8.add_option("--serve", dest="serve", type="int", default=None, metavar="[port]",
+                                        help="Run a job server on localhost:port. Use --worktrees to set how many " \
+                                             "builds run at once")
+
+    group8.add_option("--max-jobs", dest="maxJobs", type="int", default=None, metavar="[N]",
+                                        help="With --serve, how many bisections run at once (default: twice the build workers)")
+
+    group8.add_option("--server", dest="server", default=None, metavar="[http://localhost:port]",
+                                        help="Submit -g/-b/-c to a job server instead of bisecting here, " \
+                                             "or with --job/--cancel, look at its jobs")
+
+    group8.add_option("--priority", dest="priority", type="int", default=0, metavar="[N]",
+                                        help="Priority of a submitted job, higher builds first (default: %default)")
+
+    group8.add_option("--job", dest="job", type="int", default=None, metavar="[id]",
+                                        help="With --server, show a job's status and result")
+
+    group8.add_option("--cancel", dest="cancel", type="int", default=None, metavar="[id]",
+                                        help="With --server, cancel a job")
+
     group7 = OptionGroup(parser, "Broken and Unstable Options",
                                         "Caution: use these options at your own risk.  "
                                         "They aren't recommended.")
@@ -623,11 +1430,38 @@ def cli():
     parser.add_option_group(group4)
     parser.add_option_group(group5)
     parser.add_option_group(group6)
+    parser.add_option_group(group8)
     parser.add_option_group(group7)
     (options, args_for_condition) = parser.parse_args()
 
+    if options.forgetVerdicts:
+        cache = VerdictCache(os.path.join(os.path.expanduser("~"), "moz-commitbuilder-cache", "verdicts.sqlite"))
+        script = options.forgetVerdicts
+        if os.path.exists(script):
+            script = scriptHash(script)
+        print "Forgot " + str(cache.forget(script)) + " cached verdicts of " + options.forgetVerdicts
+        cache.close()
+        quit()
+
+    if options.server:
+        client = JobClient(options.server)
+        if options.cancel != None:
+            print simplejson.dumps(client.cancel(options.cancel), indent=2)
+        elif options.job != None:
+            print simplejson.dumps(client.status(options.job), indent=2)
+        elif options.good and options.bad and options.condition:
+            job = client.submit(options.good, options.bad, options.condition, args=args_for_condition,
+                                priority=options.priority)
+            if "id" in job:
+                print "Submitted job " + str(job["id"]) + " to " + options.server
+            else:
+                print "The job server refused the job: " + str(job.get("error"))
+        else:
+            print simplejson.dumps(client.status(), indent=2)
+        quit()
+
     # If a user only wants to make clean or has supplied no options:
-    if (not options.good or not options.bad) and not options.single:
+    if (not options.good or not options.bad) and not options.single and not options.resume and not options.serve:
         if options.makeClean:
             #Make a clean trunk and quit.
             commitBuilder = Builder(clean=options.makeClean)
@@ -641,13 +1475,25 @@ def cli():
 
     # Set up a trunk for either bisection or build.
     mozConfiguration = options.mozconf
-    commitBuilder = Builder(clean=options.makeClean, mozconf=mozConfiguration, tryhost=options.tryhost, tryport=options.tryport, remote=options.remote, tryPusher=options.trypusher)
+    commitBuilder = Builder(clean=options.makeClean, mozconf=mozConfiguration, tryhost=options.tryhost, tryport=options.tryport, remote=options.remote, tryPusher=options.trypusher, useCache=options.useCache, parallel=options.parallel, worktrees=options.worktrees, journal=options.journal, window=options.window,
+                            compilerCache=options.compilerCache, compilerCacheSize=options.compilerCacheSize,
+                            trace=options.trace, traceFormat=options.traceFormat,
+                            abortOnError=options.abortOnError, engine=options.engine,
+                            confidence=options.confidence, falsePositive=options.falsePositive,
+                            falseNegative=options.falseNegative, useVerdictCache=options.useVerdictCache,
+                            repeat=options.repeat, aggregation=options.aggregation, threshold=options.threshold,
+                            conditionTimeout=options.conditionTimeout, limitVerdict=options.limitVerdict,
+                            memoryLimit=options.memoryLimit and options.memoryLimit * 1024 * 1024,
+                            archive=options.archive, hybrid=options.hybrid, installLinks=options.installLinks)
     if options.cores:
         commitBuilder.cores = options.cores
         commitBuilder.mozconfigure()
 
+    if options.serve:
+        commitBuilder.serve(port=options.serve, maxJobs=options.maxJobs)
+
     # For building single commits:
-    if options.single:
+    elif options.single:
         if options.run:
             commitBuilder.buildAndRun(changeset=options.single)
             print "Firefox successfully built and ran!"
@@ -676,9 +1522,18 @@ def cli():
 
         commitBuilder.bisect(options.good,options.bad, testcondition=conditionscript, args_for_condition=args_for_condition)
 
+    elif options.resume:
+        conditionscript = None
+        if options.condition:
+            conditionscript = ximport.importRelativeOrAbsolute(options.condition)
+        commitBuilder.resumeBisect(testcondition=conditionscript, args_for_condition=args_for_condition or None)
+
     # Should not get here.
     else:
         print "Invalid input. Please try again."
 
+    commitBuilder.tracer.close()
+    commitBuilder.close()
+
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,112 @@
+# compilercache.py
+#
+# ccache/sccache support: mozconfig lines, a cache directory with a size
+# budget, and hit/miss statistics for each build.
+
+import os
+import re
+import simplejson
+import subprocess
+from distutils.spawn import find_executable
+
+supportedCaches = ["ccache", "sccache"]
+
+class CompilerCache():
+    def __init__(self, kind, cacheDir, maxSize="10G"):
+        if kind not in supportedCaches:
+            raise Exception("Unsupported compiler cache " + str(kind) + ", use one of " + ", ".join(supportedCaches))
+        self.kind = kind
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+        self.binary = find_executable(kind)
+
+        if not os.path.exists(self.cacheDir):
+            os.makedirs(self.cacheDir)
+
+    def available(self):
+        return self.binary != None
+
+    def setupEnvironment(self):
+        #Point the cache at our directory. make (and the sccache server) inherit this.
+        if self.kind == "ccache":
+            os.environ["CCACHE_DIR"] = self.cacheDir
+            os.environ["CCACHE_MAXSIZE"] = str(self.maxSize)
+            self.call(["-M", str(self.maxSize)])
+        else:
+            os.environ["SCCACHE_DIR"] = self.cacheDir
+            os.environ["SCCACHE_CACHE_SIZE"] = str(self.maxSize)
+
+    def mozconfigLines(self):
+        return ['ac_add_options --with-ccache=' + self.binary + '\n']
+
+    def call(self, args):
+        devnull = open(os.devnull, "w")
+        try:
+            return subprocess.call([self.binary] + args, stdout=devnull, stderr=devnull)
+        finally:
+            devnull.close()
+
+    def output(self, args):
+        p = subprocess.Popen([self.binary] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (stdout, stderr) = p.communicate()
+        return stdout
+
+    def zeroStats(self):
+        if self.kind == "ccache":
+            self.call(["-z"])
+        else:
+            self.call(["--zero-stats"])
+
+    def stats(self):
+        #Returns (hits, misses) since the last zeroStats()
+        if self.kind == "ccache":
+            return self.ccacheStats()
+        return self.sccacheStats()
+
+    def ccacheStats(self):
+        hits = 0
+        misses = 0
+        #ccache 3.7+ has a machine readable format
+        printed = self.output(["--print-stats"])
+        if printed:
+            for line in printed.splitlines():
+                fields = line.split("\t")
+                if len(fields) != 2 or not fields[1].isdigit():
+                    continue
+                if fields[0] in ("direct_cache_hit", "preprocessed_cache_hit"):
+                    hits += int(fields[1])
+                elif fields[0] == "cache_miss":
+                    misses += int(fields[1])
+            return (hits, misses)
+
+        for line in self.output(["-s"]).splitlines():
+            m = re.match(r'\s*cache hit \((direct|preprocessed)\)\s+(\d+)', line)
+            if m:
+                hits += int(m.group(2))
+            m = re.match(r'\s*cache miss\s+(\d+)', line)
+            if m:
+                misses += int(m.group(1))
+        return (hits, misses)
+
+    def sccacheStats(self):
+        try:
+            stats = simplejson.loads(self.output(["--show-stats", "--stats-format=json"]))["stats"]
+        except (ValueError, KeyError, TypeError):
+            return (0, 0)
+        return (self.countStat(stats.get("cache_hits")), self.countStat(stats.get("cache_misses")))
+
+    def countStat(self, value):
+        #Newer sccache versions split counts per language
+        if isinstance(value, dict):
+            return sum(value.get("counts", {}).values())
+        return int(value or 0)
+
+    def report(self):
+        (hits, misses) = self.stats()
+        total = hits + misses
+        rate = 0.0
+        if total:
+            rate = 100.0 * hits / total
+        print "Compiler cache (" + self.kind + "): " + str(hits) + " hits, " + str(misses) + \
+              " misses (" + ("%.1f" % rate) + "% hit rate)"
+        return (hits, misses)
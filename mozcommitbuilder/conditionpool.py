@@ -0,0 +1,251 @@
+# conditionpool.py
+#
+# Runs condition scripts in worker processes, each with its own temporary
+# directory, so a hung or runaway test can be killed and flaky conditions
+# can be run several times in parallel. The verdicts of repeated runs are
+# combined with an aggregation rule.
+#
+# Repeats of one changeset share its objdir, so they run one at a time unless
+# the condition script sets parallelSafe = True, saying it only writes to its
+# temporary directory and the profile directory it gets in
+# $COMMITBUILDER_PROFILE.
+#
+# Run as a script this is the worker:
+#     python conditionpool.py [condtest.py] [result file] [tmpdir] [args as JSON]
+
+import os
+import shutil
+import signal
+import simplejson
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+aggregationRules = ["any-fail", "majority", "threshold"]
+limitVerdicts = ["skip", "bad"]
+
+#Worker exit code when the condition itself ran out of memory
+memoryExitCode = 3
+
+def normalizeVerdict(verdict):
+    #Allow conditions to return true/false or bad/good
+    if verdict != "bad" and verdict != "good":
+        verdict = "bad" if verdict else "good"
+    return verdict
+
+def aggregate(verdicts, rule="any-fail", threshold=0.5):
+    #Combine the verdicts of repeated runs. Skipped runs don't count, and
+    #with nothing left (or a tie under "majority") the changeset is skipped.
+    judged = [verdict for verdict in verdicts if verdict in ("good", "bad")]
+    if not judged:
+        return "skip"
+    bad = judged.count("bad")
+    if rule == "any-fail":
+        return "bad" if bad else "good"
+    if rule == "majority":
+        if bad * 2 == len(judged):
+            return "skip"
+        return "bad" if bad * 2 > len(judged) else "good"
+    if rule == "threshold":
+        return "bad" if bad >= threshold * len(judged) else "good"
+    raise Exception("Unknown aggregation rule " + str(rule) + ", use one of " + ", ".join(aggregationRules))
+
+def processGroupRss(pgid):
+    #Resident memory in bytes of every process in a process group, from /proc.
+    #None where /proc isn't available.
+    if not os.path.isdir("/proc/self"):
+        return None
+    pageSize = os.sysconf("SC_PAGE_SIZE")
+    total = 0
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            f = open(os.path.join("/proc", entry, "stat"))
+            try:
+                stat = f.read()
+            finally:
+                f.close()
+        except (IOError, OSError):
+            continue
+        #The command name may contain spaces, the fields we want follow its ")"
+        fields = stat[stat.rfind(")") + 2:].split()
+        if int(fields[2]) == pgid:
+            total += int(fields[21]) * pageSize
+    return total
+
+class ConditionPool():
+    def __init__(self, repeat=1, jobs=None, timeout=None, memoryLimit=None, limitVerdict="skip",
+                 rule="any-fail", threshold=0.5):
+        #timeout is in seconds and memoryLimit in bytes, per run. Runs that hit
+        #either limit are killed and count as limitVerdict.
+        if rule not in aggregationRules:
+            raise Exception("Unknown aggregation rule " + str(rule) + ", use one of " + ", ".join(aggregationRules))
+        if limitVerdict not in limitVerdicts:
+            raise Exception("Unknown limit verdict " + str(limitVerdict) + ", use one of " + ", ".join(limitVerdicts))
+        self.repeat = max(1, int(repeat))
+        self.jobs = max(1, min(self.repeat, int(jobs or self.repeat)))
+        self.timeout = timeout
+        self.memoryLimit = memoryLimit
+        self.limitVerdict = limitVerdict
+        self.rule = rule
+        self.threshold = threshold
+        #Whether a run of this thread's last run() hit a limit, see hitLimit()
+        self.local = threading.local()
+        #{script: whether it declares parallelSafe}
+        self.parallelScripts = {}
+
+    def hitLimit(self):
+        #True if any run of the calling thread's last run() was killed for a
+        #limit, so its verdict says more about the limit than the changeset
+        return getattr(self.local, "limited", False)
+
+    def run(self, script, objdir, args):
+        #Run the condition script repeat times, jobs at a time, and return the aggregate verdict
+        verdicts = [None] * self.repeat
+        limited = [False] * self.repeat
+        pending = range(self.repeat)
+        lock = threading.Lock()
+        jobs = self.jobs
+        if jobs > 1 and not self.parallelSafe(script):
+            jobs = 1
+
+        def worker():
+            while True:
+                lock.acquire()
+                try:
+                    if not pending:
+                        return
+                    index = pending.pop(0)
+                finally:
+                    lock.release()
+                try:
+                    (verdicts[index], limited[index]) = self.runOnce(script, objdir, args)
+                except Exception, e:
+                    print "Condition run failed (" + str(e) + "), skipping it."
+                    verdicts[index] = "skip"
+
+        threads = [threading.Thread(target=worker) for i in range(jobs)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.local.limited = any(limited)
+        verdict = aggregate(verdicts, self.rule, self.threshold)
+        if self.repeat > 1:
+            print "Condition verdicts: " + ", ".join(verdicts) + " -> " + verdict + " (" + self.rule + ")"
+        return verdict
+
+    def parallelSafe(self, script):
+        #Whether the script's runs may share an objdir at the same time
+        if script not in self.parallelScripts:
+            import ximport
+            try:
+                testcondition = ximport.importRelativeOrAbsolute(script)
+                self.parallelScripts[script] = bool(getattr(testcondition, "parallelSafe", False))
+            except Exception:
+                self.parallelScripts[script] = False
+        return self.parallelScripts[script]
+
+    def runOnce(self, script, objdir, args):
+        #One run in a fresh worker process, temporary directory and profile
+        #directory. Returns (verdict, whether a limit was hit).
+        tmpdir = tempfile.mkdtemp(prefix="condition-")
+        resultPath = tmpdir + ".verdict"
+        profile = os.path.join(tmpdir, "profile")
+        cmd = [sys.executable, workerPath(), script, resultPath, tmpdir, simplejson.dumps([objdir] + list(args))]
+        env = dict(os.environ)
+        env["COMMITBUILDER_PROFILE"] = profile
+        #Scratch files of anything the condition starts land in tmpdir too
+        env["TMPDIR"] = tmpdir
+        kwargs = {"env": env}
+        if os.name == "posix":
+            kwargs["preexec_fn"] = self.limitChild
+        try:
+            os.mkdir(profile)
+            p = subprocess.Popen(cmd, **kwargs)
+            reason = self.watch(p)
+            if reason:
+                print "Condition " + reason + ", counting this run as " + self.limitVerdict + "."
+                return (self.limitVerdict, True)
+            if p.returncode == memoryExitCode:
+                print "Condition ran out of memory, counting this run as " + self.limitVerdict + "."
+                return (self.limitVerdict, True)
+            try:
+                f = open(resultPath)
+                try:
+                    return (normalizeVerdict(f.read().strip()), False)
+                finally:
+                    f.close()
+            except IOError:
+                print "Condition script exited with code " + str(p.returncode) + " without a verdict, skipping."
+                return ("skip", False)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            if os.path.exists(resultPath):
+                os.remove(resultPath)
+
+    def limitChild(self):
+        #Runs in the child before exec: own process group so the whole tree
+        #can be killed, and an address space cap where we can't watch RSS
+        os.setsid()
+        if self.memoryLimit and not os.path.isdir("/proc/self"):
+            import resource
+            resource.setrlimit(resource.RLIMIT_AS, (self.memoryLimit, self.memoryLimit))
+
+    def watch(self, p):
+        #Wait for the worker. Returns why it was killed, or None if it exited.
+        start = time.time()
+        while p.poll() == None:
+            reason = None
+            if self.timeout and time.time() - start > self.timeout:
+                reason = "timed out after " + str(self.timeout) + "s"
+            elif self.memoryLimit and os.name == "posix":
+                rss = processGroupRss(p.pid)
+                if rss != None and rss > self.memoryLimit:
+                    reason = "used " + str(rss / (1024 * 1024)) + " MB of memory"
+            if reason:
+                killGroup(p)
+                return reason
+            time.sleep(0.2)
+        return None
+
+def killGroup(p):
+    try:
+        if os.name == "posix":
+            os.killpg(p.pid, signal.SIGKILL)
+        else:
+            p.kill()
+    except OSError:
+        pass
+    p.wait()
+
+def workerPath():
+    path = os.path.abspath(__file__)
+    if path.endswith(".pyc") or path.endswith(".pyo"):
+        path = path[:-1]
+    return path
+
+def main(script, resultPath, tmpdir, args):
+    import ximport
+    testcondition = ximport.importRelativeOrAbsolute(script)
+    if hasattr(testcondition, "init"):
+        testcondition.init(args)
+    try:
+        verdict = normalizeVerdict(testcondition.interesting(args, tmpdir))
+    except MemoryError:
+        sys.exit(memoryExitCode)
+    f = open(resultPath, "w")
+    try:
+        f.write(verdict)
+    finally:
+        f.close()
+
+if __name__ == "__main__":
+    if len(sys.argv) != 5:
+        print "usage: conditionpool.py [condtest.py] [result file] [tmpdir] [args as JSON]"
+        sys.exit(1)
+    main(sys.argv[1], sys.argv[2], sys.argv[3], simplejson.loads(sys.argv[4]))
@@ -0,0 +1,51 @@
+# costmodel.py
+#
+# Rough estimates of how expensive an incremental rebuild will be, given the
+# files that differ between the objdir's last build and the next changeset.
+# Builder uses this to pick a cheap changeset near the bisection midpoint.
+
+import os
+import re
+import simplejson
+import time
+
+class RebuildCostModel():
+    #(pattern, cost) pairs, first match wins. Costs are relative, not seconds.
+    weights = [
+        #Anything that reruns configure or touches the build system rebuilds the world
+        (re.compile(r'(^|/)(configure\.in|configure|old-configure\.in|client\.mk|moz\.configure)$'), 1000.0),
+        (re.compile(r'\.(m4|mk)$'), 1000.0),
+        (re.compile(r'^(build|config)/'), 500.0),
+        (re.compile(r'(^|/)(Makefile\.in|moz\.build)$'), 20.0),
+        #Headers and interface definitions are included all over the place
+        (re.compile(r'\.(h|hh|hpp|idl|ipdl|ipdlh|webidl)$'), 50.0),
+        (re.compile(r'\.(c|cc|cpp|cxx|mm|m|s|asm)$'), 1.0),
+        #Chrome, tests and docs just get copied around
+        (re.compile(r'\.(js|jsm|xul|xml|css|dtd|properties|html|png|ico|txt)$'), 0.1),
+    ]
+    defaultWeight = 0.5
+
+    def __init__(self, logPath=None):
+        self.logPath = logPath
+
+    def fileCost(self, path):
+        path = path.replace(os.sep, "/")
+        for pattern, weight in self.weights:
+            if pattern.search(path):
+                return weight
+        return self.defaultWeight
+
+    def estimate(self, files):
+        #Predicted cost of rebuilding after files change
+        return sum([self.fileCost(f) for f in files])
+
+    def record(self, changeset, predicted, actual):
+        #Log predicted cost vs. actual build seconds so the weights can be tuned
+        if not self.logPath or predicted == None or actual == None:
+            return
+        f = open(self.logPath, "a")
+        f.write(simplejson.dumps({"changeset": changeset,
+                                  "predicted": predicted,
+                                  "actual": actual,
+                                  "time": time.time()}) + "\n")
+        f.close()
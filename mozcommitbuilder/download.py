@@ -0,0 +1,578 @@
+# download.py
+#
+# Downloads big files (builds, tests.zip) straight to disk in chunks. Partial
+# downloads are kept next to the destination and resumed with HTTP Range
+# requests, large files can be fetched as several ranges in parallel, and the
+# result is checked against an expected size and checksum when we have them.
+# Tarballs can also be unpacked while they download, see streamInstall.
+#
+# Try it against a server with:
+#     python download.py [url] [dest] [segments]
+# or check resuming, segments and verification against a stand-in server with:
+#     python download.py --check
+
+import hashlib
+import httplib
+import os
+import re
+import shutil
+import simplejson
+import sys
+import threading
+import time
+
+import extract
+import httpclient
+
+chunkSize = 256 * 1024
+#Files smaller than this aren't worth splitting into ranges
+minSegmentedSize = 16 * 1024 * 1024
+
+class DownloadError(Exception):
+    pass
+
+def request(url, method="GET", start=None, end=None, validator=None):
+    #validator (an ETag or Last-Modified) makes a range request If-Range, so
+    #a changed file comes back whole instead of as a range of the new one
+    headers = {}
+    if start != None:
+        headers["Range"] = "bytes=" + str(start) + "-" + (str(end) if end != None else "")
+        if validator and not validator.startswith("W/"):
+            headers["If-Range"] = validator
+    return httpclient.sharedClient().open(url, method=method, headers=headers)
+
+def probe(url):
+    #(length or None, whether the server takes Range requests, ETag or
+    #Last-Modified or None)
+    try:
+        response = request(url, method="HEAD")
+    except (httplib.HTTPException, IOError):
+        return (None, False, None)
+    try:
+        length = response.getheader("Content-Length")
+        ranges = response.getheader("Accept-Ranges", "") == "bytes"
+        validator = response.getheader("ETag") or response.getheader("Last-Modified")
+        response.read()
+        return (int(length) if length else None, ranges, validator)
+    finally:
+        response.close()
+
+def fileChecksum(path, algorithm):
+    digest = hashlib.new(algorithm)
+    f = open(path, "rb")
+    try:
+        for chunk in iter(lambda: f.read(chunkSize), ""):
+            digest.update(chunk)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+def parseChecksums(text):
+    #Mozilla .checksums files: "<hash> <algorithm> <size> <filename>" per line.
+    #Returns {basename: (algorithm, hash, size)}
+    manifest = {}
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) != 4:
+            continue
+        (digest, algorithm, size, name) = fields
+        try:
+            manifest[os.path.basename(name)] = (algorithm, digest.lower(), int(size))
+        except ValueError:
+            continue
+    return manifest
+
+def fetchManifest(url):
+    #Parsed .checksums file at url, or {} if we couldn't get it
+    try:
+        return parseChecksums(httpclient.sharedClient().get(url))
+    except (httplib.HTTPException, IOError), e:
+        print "Couldn't read checksums from " + url + ": " + str(e)
+        return {}
+
+class Download():
+    def __init__(self, url, dest, segments=4, size=None, checksum=None, quiet=False):
+        #checksum is (algorithm, hex digest). size and checksum are verified if given.
+        self.url = url
+        self.dest = dest
+        self.partPath = dest + ".part"
+        self.statePath = dest + ".part.json"
+        #Where a streamed .part came from, so it's only resumed from the same file
+        self.sourcePath = dest + ".part.source"
+        self.validator = None
+        self.segments = max(1, int(segments))
+        self.size = size
+        self.checksum = checksum
+        self.quiet = quiet
+        self.received = 0
+        self.lock = threading.Lock()
+
+    def log(self, message):
+        if not self.quiet:
+            print message
+
+    def run(self):
+        #Returns dest once the file is complete and verified
+        known = self.size != None or self.checksum != None
+        if known and os.path.exists(self.dest) and self.verified(self.dest):
+            self.log("Already downloaded " + self.dest)
+            return self.dest
+        parent = os.path.dirname(self.dest)
+        if parent and not os.path.exists(parent):
+            os.makedirs(parent)
+
+        self.log("Downloading " + self.url + "...")
+        start = time.time()
+        (length, ranges, self.validator) = probe(self.url)
+        if self.size != None and length != None and length != self.size:
+            raise DownloadError(self.url + " is " + str(length) + " bytes, expected " + str(self.size))
+        length = length or self.size
+
+        if ranges and length and self.segments > 1 and length >= minSegmentedSize:
+            self.fetchSegments(length)
+        else:
+            self.fetchStream(length, ranges)
+
+        if not self.verified(self.partPath):
+            os.remove(self.partPath)
+            raise DownloadError("Downloaded " + self.url + " doesn't match its expected size or checksum")
+        if os.name == "nt" and os.path.exists(self.dest):
+            os.remove(self.dest)
+        os.rename(self.partPath, self.dest)
+        for path in (self.statePath, self.sourcePath):
+            if os.path.exists(path):
+                os.remove(path)
+
+        elapsed = max(time.time() - start, 0.001)
+        self.log("Downloaded %.1f MB in %.1fs (%.1f MB/s)" % (self.received / 1048576.0, elapsed,
+                                                             self.received / 1048576.0 / elapsed))
+        return self.dest
+
+    def verified(self, path):
+        if self.size != None and os.path.getsize(path) != self.size:
+            return False
+        if self.checksum != None:
+            (algorithm, digest) = self.checksum
+            if fileChecksum(path, algorithm) != digest.lower():
+                return False
+        return True
+
+    def copy(self, response, f, limit=None, segment=None, saveState=None):
+        #Stream response into f, at most limit bytes. Returns bytes written.
+        #A segment's done count is kept current and saved every few seconds,
+        #so an interrupted download resumes close to where it stopped.
+        written = 0
+        lastSave = time.time()
+        while limit == None or written < limit:
+            chunk = response.read(chunkSize if limit == None else min(chunkSize, limit - written))
+            if not chunk:
+                break
+            f.write(chunk)
+            written += len(chunk)
+            self.lock.acquire()
+            self.received += len(chunk)
+            self.lock.release()
+            if segment != None:
+                segment[2] += len(chunk)
+                if time.time() - lastSave > 2:
+                    f.flush()
+                    saveState()
+                    lastSave = time.time()
+        return written
+
+    def source(self):
+        return {"url": self.url, "validator": self.validator}
+
+    def partSource(self):
+        try:
+            f = open(self.sourcePath)
+            try:
+                return simplejson.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return None
+
+    def fetchStream(self, length, ranges):
+        #One connection, picking up after a partial file of the same url and
+        #version if the server lets us
+        offset = 0
+        if ranges and os.path.exists(self.partPath) and not os.path.exists(self.statePath) and \
+           self.partSource() == self.source():
+            offset = os.path.getsize(self.partPath)
+            if length != None and offset > length:
+                offset = 0
+        if length != None and offset == length:
+            return
+
+        response = request(self.url, start=offset if offset else None, validator=self.validator)
+        try:
+            if offset and response.status != 206:
+                #Server ignored the range, start over
+                offset = 0
+            if offset:
+                self.log("Resuming at " + str(offset) + " bytes")
+            else:
+                f = open(self.sourcePath, "w")
+                simplejson.dump(self.source(), f)
+                f.close()
+            f = open(self.partPath, "ab" if offset else "wb")
+            try:
+                self.copy(response, f)
+            finally:
+                f.close()
+        finally:
+            response.close()
+        if length != None and os.path.getsize(self.partPath) != length:
+            raise DownloadError("Download of " + self.url + " stopped at " + str(os.path.getsize(self.partPath)) +
+                                " of " + str(length) + " bytes, run again to resume")
+
+    def loadState(self, length):
+        #[[start, end, done], ...] of a partial segmented download of this url
+        try:
+            f = open(self.statePath)
+            try:
+                state = simplejson.load(f)
+            finally:
+                f.close()
+            if state["url"] == self.url and state.get("validator") == self.validator and \
+               state["length"] == length and os.path.exists(self.partPath):
+                return state["segments"]
+        except (IOError, ValueError, KeyError):
+            pass
+        segmentLength = -(-length // self.segments)
+        return [[start, min(start + segmentLength, length), 0] for start in range(0, length, segmentLength)]
+
+    def saveState(self, length, segments):
+        self.lock.acquire()
+        try:
+            f = open(self.statePath + ".tmp", "w")
+            simplejson.dump({"url": self.url, "validator": self.validator, "length": length,
+                             "segments": segments}, f)
+            f.close()
+            if os.name == "nt" and os.path.exists(self.statePath):
+                os.remove(self.statePath)
+            os.rename(self.statePath + ".tmp", self.statePath)
+        finally:
+            self.lock.release()
+
+    def fetchSegments(self, length):
+        #Each range is written in place into a file of the final size
+        segments = self.loadState(length)
+        if not os.path.exists(self.partPath) or os.path.getsize(self.partPath) != length:
+            f = open(self.partPath, "wb")
+            f.truncate(length)
+            f.close()
+            for segment in segments:
+                segment[2] = 0
+        resumed = sum([segment[2] for segment in segments])
+        if resumed:
+            self.log("Resuming with " + str(resumed) + " of " + str(length) + " bytes already here")
+        self.saveState(length, segments)
+
+        errors = []
+        def fetch(segment):
+            try:
+                while segment[0] + segment[2] < segment[1]:
+                    position = segment[0] + segment[2]
+                    response = request(self.url, start=position, end=segment[1] - 1, validator=self.validator)
+                    try:
+                        if response.status != 206:
+                            raise DownloadError("Server ignored the range request")
+                        f = open(self.partPath, "r+b")
+                        try:
+                            f.seek(position)
+                            written = self.copy(response, f, limit=segment[1] - position, segment=segment,
+                                                saveState=lambda: self.saveState(length, segments))
+                        finally:
+                            f.close()
+                    finally:
+                        response.close()
+                    if written == 0:
+                        raise DownloadError("Connection closed at byte " + str(position))
+                    self.saveState(length, segments)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=fetch, args=(segment,)) for segment in segments
+                   if segment[2] < segment[1] - segment[0]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise DownloadError("Download of " + self.url + " failed (" + str(errors[0]) + "), run again to resume")
+
+def download(url, dest, segments=4, size=None, checksum=None, quiet=False):
+    return Download(url, dest, segments=segments, size=size, checksum=checksum, quiet=quiet).run()
+
+class TeeReader():
+    #File-like view of a response that copies what's read into f (if any)
+    #and keeps count and checksum of it
+    def __init__(self, response, f=None, algorithm=None):
+        self.response = response
+        self.f = f
+        self.digest = hashlib.new(algorithm) if algorithm else None
+        self.received = 0
+
+    def read(self, amount=None):
+        chunk = self.response.read(amount)
+        if chunk:
+            self.received += len(chunk)
+            if self.f != None:
+                self.f.write(chunk)
+            if self.digest != None:
+                self.digest.update(chunk)
+        return chunk
+
+    def drain(self):
+        #Read whatever the consumer left, e.g. the padding after a tarball
+        while self.read(chunkSize):
+            pass
+
+def moveEntries(src, dest):
+    #Move everything in src into dest, replacing what's in the way
+    if not os.path.exists(dest):
+        os.makedirs(dest)
+    for name in os.listdir(src):
+        target = os.path.join(dest, name)
+        if os.path.islink(target) or os.path.isfile(target):
+            os.remove(target)
+        elif os.path.isdir(target):
+            shutil.rmtree(target)
+        os.rename(os.path.join(src, name), target)
+
+def streamInstall(url, installDir, dest=None, size=None, checksum=None, quiet=False, store=None):
+    #Untar the tarball at url into installDir while it downloads, instead of
+    #downloading it first and reading it back. A copy is kept at dest if given
+    #and used instead of the network next time. Files go through the install
+    #store if one is given. Returns installDir.
+    kind = extract.compression(url)
+    name = os.path.basename(url.split("?")[0])
+    cached = Download(url, dest, size=size, checksum=checksum, quiet=quiet) if dest else None
+    #A copy we can't check against a size or checksum might be of another
+    #build with the same name, so it's only reused when it can be verified
+    known = size != None or checksum != None
+    if cached != None and known and os.path.exists(dest) and cached.verified(dest):
+        if not quiet:
+            print "Installing " + name + " from " + dest
+        extract.extractTar(dest, installDir, quiet=quiet, store=store)
+        return installDir
+
+    if not quiet:
+        print "Downloading and installing " + url + "..."
+    start = time.time()
+    partPath = dest + ".part" if dest else None
+    if partPath:
+        if not os.path.exists(os.path.dirname(partPath)):
+            os.makedirs(os.path.dirname(partPath))
+        #A segmented or resumable download's state doesn't describe this copy
+        for path in (dest + ".part.json", dest + ".part.source"):
+            if os.path.exists(path):
+                os.remove(path)
+    #Unpacked next to installDir and only moved in once the download checks
+    #out, so a bad download leaves nothing behind
+    stagingDir = installDir.rstrip(os.sep) + ".partial-" + str(os.getpid())
+    shutil.rmtree(stagingDir, ignore_errors=True)
+    try:
+        response = request(url)
+        f = open(partPath, "wb") if partPath else None
+        try:
+            tee = TeeReader(response, f, checksum[0] if checksum else None)
+            extract.extractTarFile(tee, stagingDir, kind, name, quiet=True, store=store)
+            tee.drain()
+        finally:
+            if f != None:
+                f.close()
+            response.close()
+
+        if (size != None and tee.received != size) or \
+           (checksum != None and tee.digest.hexdigest() != checksum[1].lower()):
+            if partPath:
+                os.remove(partPath)
+            raise DownloadError("Downloaded " + url + " doesn't match its expected size or checksum")
+        moveEntries(stagingDir, installDir)
+    finally:
+        shutil.rmtree(stagingDir, ignore_errors=True)
+    if partPath:
+        if os.name == "nt" and os.path.exists(dest):
+            os.remove(dest)
+        os.rename(partPath, dest)
+    elapsed = max(time.time() - start, 0.001)
+    if not quiet:
+        print "Downloaded and installed %.1f MB in %.1fs (%.1f MB/s)" % (tee.received / 1048576.0, elapsed,
+                                                                        tee.received / 1048576.0 / elapsed)
+    return installDir
+
+def selfCheck():
+    #Downloads from a stand-in server that serves ranges and can drop a
+    #connection partway. Returns the number of failures.
+    import BaseHTTPServer
+    import tarfile
+    import tempfile
+
+    global minSegmentedSize
+    files = {}
+    seen = {"gets": [], "cut": None}
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_HEAD(self):
+            self.serve(False)
+
+        def do_GET(self):
+            self.serve(True)
+
+        def serve(self, body):
+            if self.path not in files:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            (etag, data) = files[self.path]
+            (start, end) = (0, len(data))
+            match = re.match(r"^bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+            ifRange = self.headers.get("If-Range")
+            partial = match != None and ifRange in (None, etag)
+            if partial:
+                start = int(match.group(1))
+                end = int(match.group(2)) + 1 if match.group(2) else len(data)
+            if body:
+                seen["gets"].append((self.path, start if partial else None, ifRange))
+            self.send_response(206 if partial else 200)
+            self.send_header("ETag", etag)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(end - start))
+            if partial:
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end - 1, len(data)))
+            self.end_headers()
+            if not body:
+                return
+            if seen["cut"] != None:
+                #Drop the connection partway, like a flaky network
+                self.wfile.write(data[start:start + seen["cut"]])
+                seen["cut"] = None
+                self.close_connection = 1
+                return
+            self.wfile.write(data[start:end])
+
+    failures = []
+    def check(what, got, expected):
+        if got != expected:
+            failures.append(what)
+            print "FAIL %s: got %r, expected %r" % (what, got, expected)
+        else:
+            print "ok   " + what
+
+    def read(path):
+        f = open(path, "rb")
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    root = tempfile.mkdtemp(prefix="downloadcheck")
+    (server, baseUrl) = httpclient.checkServer(Handler)
+    oldClient = httpclient.sharedClient()
+    httpclient.client = httpclient.HttpClient()
+    savedMinimum = minSegmentedSize
+    try:
+        data = "".join([chr(i % 251) for i in range(300000)])
+        digest = ("sha1", hashlib.sha1(data).hexdigest())
+        files["/build.zip"] = ('"1"', data)
+        dest = os.path.join(root, "build.zip")
+
+        seen["cut"] = 100000
+        try:
+            download(baseUrl + "build.zip", dest, segments=1, quiet=True)
+            check("interrupted download fails", None, DownloadError)
+        except DownloadError:
+            check("interrupted download fails", os.path.getsize(dest + ".part"), 100000)
+        download(baseUrl + "build.zip", dest, segments=1, checksum=digest, quiet=True)
+        check("resumed at the break", seen["gets"][-1], ("/build.zip", 100000, '"1"'))
+        check("resumed download intact", read(dest), data)
+        check("no leftovers", sorted(os.listdir(root)), ["build.zip"])
+
+        #A .part of another build under the same name isn't resumed
+        other = os.path.join(root, "other.zip")
+        files["/other.zip"] = ('"2"', data[::-1])
+        seen["cut"] = 50000
+        try:
+            download(baseUrl + "other.zip", other, segments=1, quiet=True)
+        except DownloadError:
+            pass
+        files["/other.zip"] = ('"3"', data)
+        download(baseUrl + "other.zip", other, segments=1, checksum=digest, quiet=True)
+        check("changed file starts over", seen["gets"][-1], ("/other.zip", None, None))
+        check("changed file intact", read(other), data)
+
+        minSegmentedSize = 1024
+        segmented = os.path.join(root, "segmented.zip")
+        before = len(seen["gets"])
+        download(baseUrl + "build.zip", segmented, segments=4, checksum=digest, quiet=True)
+        check("four range segments", sorted([get[1] for get in seen["gets"][before:]]), [0, 75000, 150000, 225000])
+        check("segments reassembled", read(segmented), data)
+        minSegmentedSize = savedMinimum
+
+        bad = os.path.join(root, "bad.zip")
+        try:
+            download(baseUrl + "build.zip", bad, segments=1, checksum=("sha1", "0" * 40), quiet=True)
+            check("checksum mismatch fails", None, DownloadError)
+        except DownloadError:
+            check("checksum mismatch fails", (os.path.exists(bad), os.path.exists(bad + ".part")), (False, False))
+        try:
+            download(baseUrl + "build.zip", bad, segments=1, size=len(data) + 1, quiet=True)
+            check("size mismatch fails", None, DownloadError)
+        except DownloadError:
+            check("size mismatch fails", os.path.exists(bad), False)
+
+        #Streamed installs
+        tarPath = os.path.join(root, "firefox.tar.gz")
+        tar = tarfile.open(tarPath, "w:gz")
+        member = os.path.join(root, "firefox-bin")
+        f = open(member, "w")
+        f.write("binary")
+        f.close()
+        tar.add(member, "firefox/firefox-bin")
+        tar.close()
+        tarball = read(tarPath)
+        files["/firefox.tar.gz"] = ('"4"', tarball)
+        installDir = os.path.join(root, "install")
+        kept = os.path.join(root, "kept", "firefox.tar.gz")
+        try:
+            streamInstall(baseUrl + "firefox.tar.gz", installDir, dest=kept, checksum=("sha1", "0" * 40), quiet=True)
+            check("bad streamed install fails", None, DownloadError)
+        except DownloadError:
+            check("bad streamed install leaves nothing", (os.path.exists(installDir), os.listdir(root).count("install.partial-" + str(os.getpid()))),
+                  (False, 0))
+        tarDigest = ("sha1", hashlib.sha1(tarball).hexdigest())
+        streamInstall(baseUrl + "firefox.tar.gz", installDir, dest=kept, checksum=tarDigest, quiet=True)
+        check("streamed install", read(os.path.join(installDir, "firefox", "firefox-bin")), "binary")
+        check("streamed copy kept", read(kept), tarball)
+        before = len(seen["gets"])
+        streamInstall(baseUrl + "firefox.tar.gz", os.path.join(root, "again"), dest=kept, checksum=tarDigest, quiet=True)
+        check("verified copy reused", len(seen["gets"]), before)
+        streamInstall(baseUrl + "firefox.tar.gz", os.path.join(root, "unverified"), dest=kept, quiet=True)
+        check("unverifiable copy fetched again", len(seen["gets"]), before + 1)
+    finally:
+        minSegmentedSize = savedMinimum
+        httpclient.sharedClient().close()
+        httpclient.client = oldClient
+        server.shutdown()
+        shutil.rmtree(root, ignore_errors=True)
+    print "%d checks failed" % len(failures)
+    return len(failures)
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--check"]:
+        sys.exit(selfCheck() and 1 or 0)
+    if len(sys.argv) < 2:
+        print "usage: download.py [url] [dest] [segments]"
+        print "       download.py --check"
+        sys.exit(1)
+    dest = os.path.basename(sys.argv[1].rstrip("/"))
+    if len(sys.argv) > 2:
+        dest = sys.argv[2]
+    segments = 4
+    if len(sys.argv) > 3:
+        segments = int(sys.argv[3])
+    download(sys.argv[1], dest, segments=segments)
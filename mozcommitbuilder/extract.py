@@ -0,0 +1,383 @@
+# extract.py
+#
+# Unpacks builds and test packages. Zip members are split into groups of
+# about equal size and extracted by a pool of processes, each with its own
+# handle on the archive. Tarballs are read as a stream, through a parallel
+# decompressor (pigz, lbzip2, pbzip2) when one is installed. Unix permissions
+# and symlinks are kept, and paths leaving the destination are refused.
+# Given an install store (see installstore.py), files are written through it,
+# which links the ones it already has instead of writing them again.
+#
+# Benchmark on a synthetic archive with:
+#     python extract.py [megabytes] [files]
+
+import multiprocessing
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+
+chunkSize = 256 * 1024
+#Archives smaller than this are extracted in-process, a pool isn't worth it
+minParallelSize = 8 * 1024 * 1024
+#Parallel decompressors tried for tarballs, in order of preference
+decompressors = {"gz": [["pigz", "-dc"]],
+                 "bz2": [["lbzip2", "-dc"], ["pbzip2", "-dc"]]}
+
+class ExtractError(Exception):
+    pass
+
+def safePath(dest, name):
+    #Where name goes under dest, refusing absolute paths and ".." escapes
+    #or through a symlink extracted earlier
+    path = os.path.normpath(os.path.join(dest, name))
+    if os.path.isabs(name) or not (path + os.sep).startswith(os.path.normpath(dest) + os.sep):
+        raise ExtractError("Refusing to extract " + name + " outside of " + dest)
+    if path == os.path.normpath(dest):
+        return path
+    parent = os.path.realpath(os.path.dirname(path))
+    if not (parent + os.sep).startswith(os.path.realpath(dest) + os.sep):
+        raise ExtractError("Refusing to extract " + name + " through a symlink outside of " + dest)
+    return path
+
+def report(what, size, start, quiet):
+    elapsed = max(time.time() - start, 0.001)
+    if not quiet:
+        print "Extracted %s: %.1f MB in %.1fs (%.1f MB/s)" % (what, size / 1048576.0, elapsed,
+                                                             size / 1048576.0 / elapsed)
+    return (size, elapsed)
+
+def zipMode(info):
+    #Unix mode stored by zip on Unix, or 0 if the archive doesn't have one
+    if info.create_system != 3:
+        return 0
+    return info.external_attr >> 16
+
+def extractMember(zipped, info, dest, store=None):
+    #Extract one zip member. Returns the number of bytes written.
+    path = safePath(dest, info.filename)
+    mode = zipMode(info)
+    if info.filename.endswith("/"):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return 0
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            #Another worker made it first
+            pass
+    if os.path.lexists(path):
+        os.remove(path)
+    if stat.S_ISLNK(mode) and hasattr(os, "symlink"):
+        os.symlink(zipped.read(info), path)
+        return 0
+    if store != None:
+        source = zipped.open(info)
+        try:
+            store.addFile(source, path, stat.S_IMODE(mode) or 0644, info.file_size)
+        finally:
+            source.close()
+        return info.file_size
+    source = zipped.open(info)
+    f = open(path, "wb")
+    try:
+        shutil.copyfileobj(source, f, chunkSize)
+    finally:
+        f.close()
+        source.close()
+    if stat.S_IMODE(mode):
+        os.chmod(path, stat.S_IMODE(mode))
+    return info.file_size
+
+def extractGroup(job):
+    #Pool worker: extract the named members of src into dest
+    (src, dest, names) = job
+    zipped = zipfile.ZipFile(src)
+    try:
+        written = 0
+        for name in names:
+            written += extractMember(zipped, zipped.getinfo(name), dest)
+        return written
+    finally:
+        zipped.close()
+
+def splitMembers(infos, groups):
+    #Largest first into the lightest group, so groups take about as long
+    buckets = [[0, []] for i in range(groups)]
+    for info in sorted(infos, key=lambda info: info.file_size, reverse=True):
+        bucket = min(buckets, key=lambda bucket: bucket[0])
+        bucket[0] += info.file_size + 512
+        bucket[1].append(info.filename)
+    return [names for (size, names) in buckets if names]
+
+def extractZip(src, dest, members=None, jobs=None, quiet=False, store=None):
+    #Extract src into dest. members limits it to those names. Returns
+    #(bytes, seconds). Through a store, members are extracted in-process.
+    start = time.time()
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    try:
+        zipped = zipfile.ZipFile(src)
+    except (zipfile.BadZipfile, IOError), e:
+        raise ExtractError("Can't read " + src + ": " + str(e))
+    try:
+        infos = zipped.infolist()
+        if members != None:
+            wanted = set(members)
+            infos = [info for info in infos if info.filename in wanted]
+        total = sum([info.file_size for info in infos])
+        jobs = jobs or multiprocessing.cpu_count()
+        try:
+            if jobs < 2 or total < minParallelSize or store != None:
+                written = sum([extractMember(zipped, info, dest, store) for info in infos])
+            else:
+                #Directories first so workers don't race to create them
+                for info in infos:
+                    if info.filename.endswith("/"):
+                        extractMember(zipped, info, dest)
+                groups = splitMembers([info for info in infos if not info.filename.endswith("/")], jobs)
+                pool = multiprocessing.Pool(len(groups))
+                try:
+                    written = sum(pool.map(extractGroup, [(src, dest, names) for names in groups]))
+                finally:
+                    pool.close()
+                    pool.join()
+        except NotImplementedError:
+            #Compression method zipfile doesn't know, e.g. deflate64
+            written = unzipCommand(src, dest, members)
+        #Directory modes last, a read-only directory would stop its own contents
+        for info in infos:
+            mode = stat.S_IMODE(zipMode(info))
+            if info.filename.endswith("/") and mode:
+                os.chmod(safePath(dest, info.filename), mode)
+    except zipfile.BadZipfile, e:
+        raise ExtractError("Can't extract " + src + ": " + str(e))
+    finally:
+        zipped.close()
+    return report(os.path.basename(src), written, start, quiet)
+
+def unzipCommand(src, dest, members=None):
+    args = ["unzip", "-o", "-q", "-d", dest, src]
+    if members != None:
+        args += list(members)
+    try:
+        code = subprocess.call(args)
+    except OSError, e:
+        raise ExtractError("Can't extract " + src + " and no unzip command: " + str(e))
+    if code != 0:
+        raise ExtractError("unzip failed on " + src + " with exit code " + str(code))
+    return sum([info.file_size for info in zipfile.ZipFile(src).infolist()
+                if members == None or info.filename in members])
+
+def compression(name):
+    if name.endswith(".tar.gz") or name.endswith(".tgz"):
+        return "gz"
+    if name.endswith(".tar.bz2") or name.endswith(".tbz2"):
+        return "bz2"
+    return ""
+
+def findDecompressor(kind):
+    for command in decompressors.get(kind, []):
+        for directory in os.environ.get("PATH", "").split(os.pathsep):
+            if os.path.isfile(os.path.join(directory, command[0])):
+                return command
+    return None
+
+def extractTarStream(fileobj, dest, kind="", name="tarball", quiet=False, store=None):
+    #Extract a tarball read front to back from fileobj (which can be a socket
+    #or pipe). kind is "gz", "bz2" or "" for an already decompressed stream.
+    #Returns (bytes, seconds).
+    start = time.time()
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    directories = []
+    written = 0
+    try:
+        tar = tarfile.open(fileobj=fileobj, mode="r|" + kind)
+        try:
+            for member in tar:
+                path = safePath(dest, member.name)
+                if member.issym() and os.path.isabs(member.linkname):
+                    raise ExtractError("Refusing absolute symlink " + member.name + " -> " + member.linkname)
+                if member.isdir():
+                    if not os.path.isdir(path):
+                        os.makedirs(path)
+                    directories.append(member)
+                    continue
+                if os.path.lexists(path) and not os.path.isdir(path):
+                    os.remove(path)
+                if store != None and member.isreg():
+                    if not os.path.isdir(os.path.dirname(path)):
+                        os.makedirs(os.path.dirname(path))
+                    #No mtime, the file may be a link to a blob other installs share
+                    store.addFile(tar.extractfile(member), path, member.mode, member.size)
+                else:
+                    tar.extract(member, dest)
+                written += member.size
+        finally:
+            tar.close()
+    except (tarfile.TarError, EOFError, IOError), e:
+        raise ExtractError("Can't extract " + name + ": " + str(e))
+    #Directory modes last, like TarFile.extractall
+    for member in reversed(directories):
+        os.chmod(safePath(dest, member.name), member.mode & 07777)
+    return report(name, written, start, quiet)
+
+def extractTarFile(fileobj, dest, kind="", name="tarball", quiet=False, store=None):
+    #extractTarStream, with the decompression done by a parallel decompressor
+    #fed from fileobj when there is one
+    command = findDecompressor(kind)
+    if command == None:
+        return extractTarStream(fileobj, dest, kind, name, quiet, store)
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=chunkSize)
+    errors = []
+    def feed():
+        try:
+            try:
+                for chunk in iter(lambda: fileobj.read(chunkSize), ""):
+                    proc.stdin.write(chunk)
+            except Exception, e:
+                errors.append(e)
+        finally:
+            try:
+                proc.stdin.close()
+            except IOError:
+                #The decompressor is gone, it exits with an error below
+                pass
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    try:
+        result = extractTarStream(proc.stdout, dest, "", name, quiet, store)
+    finally:
+        proc.stdout.close()
+        feeder.join()
+        code = proc.wait()
+    if errors:
+        raise errors[0]
+    if code != 0:
+        raise ExtractError(command[0] + " failed on " + name + " with exit code " + str(code))
+    return result
+
+def extractTar(src, dest, quiet=False, store=None):
+    #Extract the tarball at src, through a parallel decompressor if there is one
+    kind = compression(src)
+    command = findDecompressor(kind)
+    if command == None:
+        f = open(src, "rb")
+        try:
+            return extractTarStream(f, dest, kind, os.path.basename(src), quiet, store)
+        finally:
+            f.close()
+    proc = subprocess.Popen(command + [src], stdout=subprocess.PIPE, bufsize=chunkSize)
+    try:
+        result = extractTarStream(proc.stdout, dest, "", os.path.basename(src), quiet, store)
+    finally:
+        proc.stdout.close()
+        code = proc.wait()
+    if code != 0:
+        raise ExtractError(command[0] + " failed on " + src + " with exit code " + str(code))
+    return result
+
+def extract(src, dest, quiet=False, store=None):
+    #Pick the extractor by file name
+    if src.endswith(".zip"):
+        return extractZip(src, dest, quiet=quiet, store=store)
+    if compression(src) or src.endswith(".tar"):
+        return extractTar(src, dest, quiet=quiet, store=store)
+    raise ExtractError("Don't know how to extract " + src)
+
+def syntheticTree(root, megabytes, files):
+    #Files of mixed compressibility totalling about megabytes, like a build
+    if not os.path.isdir(os.path.join(root, "bin", "components")):
+        os.makedirs(os.path.join(root, "bin", "components"))
+    size = megabytes * 1048576 // files
+    for i in range(files):
+        path = os.path.join(root, "bin", "components" if i % 3 else "", "file%d" % i)
+        f = open(path, "wb")
+        if i % 2:
+            f.write(os.urandom(size))
+        else:
+            f.write(("function f%d() { return %d; }\n" % (i, i)) * (size // 32))
+        f.close()
+        os.chmod(path, 0755 if i % 5 == 0 else 0644)
+    if hasattr(os, "symlink"):
+        os.symlink("file0", os.path.join(root, "bin", "link"))
+
+def benchmark(megabytes=200, files=400):
+    work = tempfile.mkdtemp(prefix="extractbench")
+    try:
+        tree = os.path.join(work, "tree")
+        syntheticTree(tree, megabytes, files)
+        zipPath = os.path.join(work, "build.zip")
+        zipped = zipfile.ZipFile(zipPath, "w", zipfile.ZIP_DEFLATED)
+        for parent, dirs, names in os.walk(tree):
+            for name in names:
+                path = os.path.join(parent, name)
+                arcname = os.path.relpath(path, tree)
+                if os.path.islink(path):
+                    info = zipfile.ZipInfo(arcname)
+                    info.create_system = 3
+                    info.external_attr = (stat.S_IFLNK | 0777) << 16
+                    zipped.writestr(info, os.readlink(path))
+                else:
+                    zipped.write(path, arcname)
+        zipped.close()
+        tarPaths = []
+        for kind in ("gz", "bz2"):
+            tarPath = os.path.join(work, "build.tar." + kind)
+            tar = tarfile.open(tarPath, "w:" + kind)
+            tar.add(tree, "firefox")
+            tar.close()
+            tarPaths.append(tarPath)
+        print "%d files, %d MB, zip %.1f MB" % (files, megabytes, os.path.getsize(zipPath) / 1048576.0)
+
+        def timed(label, function):
+            out = os.path.join(work, "out")
+            shutil.rmtree(out, ignore_errors=True)
+            os.makedirs(out)
+            start = time.time()
+            function(out)
+            elapsed = time.time() - start
+            print "%-32s %7.2fs %8.1f MB/s" % (label, elapsed, megabytes / elapsed)
+
+        def extractall(out):
+            zipped = zipfile.ZipFile(zipPath)
+            zipped.extractall(out)
+            zipped.close()
+        timed("zipfile.extractall", extractall)
+        timed("extractZip, 1 process", lambda out: extractZip(zipPath, out, jobs=1, quiet=True))
+        jobs = multiprocessing.cpu_count()
+        timed("extractZip, pool of %d" % jobs, lambda out: extractZip(zipPath, out, jobs=jobs, quiet=True))
+        for tarPath in tarPaths:
+            kind = compression(tarPath)
+            def stream(out):
+                f = open(tarPath, "rb")
+                try:
+                    extractTarStream(f, out, kind, quiet=True)
+                finally:
+                    f.close()
+            timed("stream tar." + kind, stream)
+            command = findDecompressor(kind)
+            if command:
+                timed("stream tar." + kind + " via " + command[0], lambda out: extractTar(tarPath, out, quiet=True))
+            timed("tar command, tar." + kind,
+                  lambda out: subprocess.check_call(["tar", "-xf", tarPath, "-C", out]))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+if __name__ == "__main__":
+    megabytes = 200
+    files = 400
+    if len(sys.argv) > 1:
+        megabytes = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        files = int(sys.argv[2])
+    benchmark(megabytes, files)
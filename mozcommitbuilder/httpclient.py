@@ -0,0 +1,372 @@
+# httpclient.py
+#
+# One HTTP client for everything that touches the network: keep-alive
+# connections are pooled per host, and GET responses that carry an ETag or
+# Last-Modified are kept on disk and revalidated with a conditional request,
+# so unchanged directory listings and pushlog pages come back as a 304.
+#
+# Check caching and connection reuse against a stand-in server with:
+#     python httpclient.py --check
+
+import hashlib
+import httplib
+import os
+import simplejson
+import socket
+import sys
+import threading
+import urlparse
+
+#Hops to follow before giving up on a redirect chain
+maxRedirects = 5
+
+class HttpError(IOError):
+    def __init__(self, url, status, reason=""):
+        IOError.__init__(self, "HTTP " + str(status) + " " + reason + " for " + url)
+        self.url = url
+        self.status = status
+
+class PooledResponse():
+    #A streaming response. Closing it hands the connection back to the pool
+    #if the body was read to the end, and drops it otherwise.
+    def __init__(self, client, key, connection, response, url):
+        self.client = client
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.url = url
+        self.status = response.status
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, amount=None):
+        return self.response.read(amount)
+
+    def close(self):
+        if self.connection == None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.client.release(self.key, self.connection)
+        else:
+            self.response.close()
+            self.connection.close()
+        self.connection = None
+
+class HttpClient():
+    def __init__(self, cacheDir=None, timeout=60, maxIdle=4):
+        self.cacheDir = cacheDir
+        self.timeout = timeout
+        self.maxIdle = maxIdle
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.reused = 0
+        self.hits = 0
+        self.misses = 0
+
+    def connect(self, key):
+        (scheme, host, port) = key
+        self.lock.acquire()
+        try:
+            pool = self.idle.get(key)
+            if pool:
+                self.reused += 1
+                return (pool.pop(), True)
+        finally:
+            self.lock.release()
+        if scheme == "https":
+            return (httplib.HTTPSConnection(host, port, timeout=self.timeout), False)
+        return (httplib.HTTPConnection(host, port, timeout=self.timeout), False)
+
+    def release(self, key, connection):
+        self.lock.acquire()
+        try:
+            pool = self.idle.setdefault(key, [])
+            if len(pool) < self.maxIdle:
+                pool.append(connection)
+                return
+        finally:
+            self.lock.release()
+        connection.close()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for pool in self.idle.values():
+                for connection in pool:
+                    connection.close()
+            self.idle = {}
+        finally:
+            self.lock.release()
+
+    def open(self, url, method="GET", headers={}):
+        #Streaming request. Follows redirects, raises HttpError for 4xx/5xx.
+        #Close the returned response when done with it.
+        for hop in range(maxRedirects + 1):
+            response = self.send(url, method, headers)
+            if response.status in (301, 302, 303, 307, 308) and response.getheader("Location"):
+                response.read()
+                response.close()
+                url = urlparse.urljoin(url, response.getheader("Location"))
+                continue
+            if response.status >= 400:
+                response.read()
+                response.close()
+                raise HttpError(url, response.status, response.response.reason)
+            return response
+        raise HttpError(url, response.status, "too many redirects")
+
+    def send(self, url, method, headers):
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme or "http"
+        if scheme not in ("http", "https"):
+            raise HttpError(url, 0, "unsupported scheme " + scheme)
+        port = parts.port or (443 if scheme == "https" else 80)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        self.lock.acquire()
+        self.requests += 1
+        self.lock.release()
+        while True:
+            (connection, reused) = self.connect(key)
+            try:
+                connection.request(method, path, headers=headers)
+                response = connection.getresponse()
+                return PooledResponse(self, key, connection, response, url)
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                #The server may have dropped an idle keep-alive connection, try a fresh one once
+                if not reused:
+                    raise
+
+    def cachePaths(self, url):
+        name = hashlib.sha1(url).hexdigest()
+        return (os.path.join(self.cacheDir, name + ".json"), os.path.join(self.cacheDir, name + ".body"))
+
+    def loadCached(self, url):
+        #(metadata, body) of a cached response, or (None, None)
+        if not self.cacheDir:
+            return (None, None)
+        (metaPath, bodyPath) = self.cachePaths(url)
+        try:
+            f = open(metaPath)
+            try:
+                meta = simplejson.load(f)
+            finally:
+                f.close()
+            f = open(bodyPath, "rb")
+            try:
+                body = f.read()
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return (None, None)
+        if meta.get("url") != url:
+            return (None, None)
+        return (meta, body)
+
+    def storeCached(self, url, response, body):
+        etag = response.getheader("ETag")
+        lastModified = response.getheader("Last-Modified")
+        if not self.cacheDir or not (etag or lastModified):
+            return
+        if not os.path.exists(self.cacheDir):
+            try:
+                os.makedirs(self.cacheDir)
+            except OSError:
+                pass
+        (metaPath, bodyPath) = self.cachePaths(url)
+        for path, data in ((bodyPath, body),
+                           (metaPath, simplejson.dumps({"url": url, "etag": etag, "lastModified": lastModified}))):
+            #Temporary file and rename so a concurrent reader never sees half of it
+            tmpPath = path + "." + str(os.getpid()) + "." + threading.currentThread().getName() + ".tmp"
+            f = open(tmpPath, "wb")
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            if os.name == "nt" and os.path.exists(path):
+                os.remove(path)
+            os.rename(tmpPath, path)
+
+    def get(self, url, cache=True):
+        #Body of url. Cached responses are revalidated with If-None-Match or
+        #If-Modified-Since and reused on a 304.
+        headers = {}
+        (meta, cached) = (None, None)
+        if cache:
+            (meta, cached) = self.loadCached(url)
+            if meta:
+                if meta.get("etag"):
+                    headers["If-None-Match"] = meta["etag"]
+                if meta.get("lastModified"):
+                    headers["If-Modified-Since"] = meta["lastModified"]
+
+        response = self.open(url, headers=headers)
+        try:
+            if response.status == 304 and meta:
+                response.read()
+                self.count(hit=True)
+                return cached
+            body = response.read()
+        finally:
+            response.close()
+        if cache:
+            self.count(hit=False)
+            self.storeCached(url, response, body)
+        return body
+
+    def count(self, hit):
+        self.lock.acquire()
+        try:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return {"requests": self.requests, "reused": self.reused, "hits": self.hits, "misses": self.misses}
+
+    def report(self):
+        if self.requests:
+            print "HTTP: " + str(self.requests) + " requests, " + str(self.reused) + " reused connections, " + \
+                  str(self.hits) + " cache hits, " + str(self.misses) + " misses"
+
+#The client everything shares, see configure()
+client = HttpClient(cacheDir=os.path.join(os.path.expanduser("~"), "moz-commitbuilder-cache", "http"))
+
+def configure(cacheDir):
+    #Point the shared client's response cache somewhere else
+    global client
+    client.close()
+    client = HttpClient(cacheDir=cacheDir)
+    return client
+
+def sharedClient():
+    return client
+
+def checkServer(handler):
+    #A keep-alive HTTP server on a free local port for self checks, serving
+    #handler (a BaseHTTPRequestHandler class) from a daemon thread. Returns
+    #(server, base URL), call server.shutdown() when done.
+    import BaseHTTPServer
+    import SocketServer
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+        def handle_error(self, request, address):
+            #Clients dropping connections is part of what's checked
+            pass
+
+    handler.protocol_version = "HTTP/1.1"
+    handler.log_message = lambda self, *args: None
+    server = Server(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return (server, "http://127.0.0.1:%d/" % server.server_address[1])
+
+def selfCheck():
+    #Conditional requests, redirects, errors and keep-alive reuse against a
+    #stand-in server. Returns the number of failures.
+    import BaseHTTPServer
+    import shutil
+    import tempfile
+
+    pages = {"/page": ('"v1"', None, "page v1"),
+             "/dated": (None, "Sat, 01 Oct 2011 10:00:00 GMT", "dated page")}
+    seen = {"connections": set(), "304": 0, "conditional": 0}
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            seen["connections"].add(self.client_address)
+            if self.path == "/redirect":
+                return self.reply(302, "", {"Location": "/page"})
+            if self.path not in pages:
+                return self.reply(404, "not here")
+            (etag, lastModified, body) = pages[self.path]
+            headers = {}
+            if etag:
+                headers["ETag"] = etag
+            if lastModified:
+                headers["Last-Modified"] = lastModified
+            if self.headers.get("If-None-Match") or self.headers.get("If-Modified-Since"):
+                seen["conditional"] += 1
+            if (etag and self.headers.get("If-None-Match") == etag) or \
+               (lastModified and self.headers.get("If-Modified-Since") == lastModified):
+                seen["304"] += 1
+                return self.reply(304, None, headers)
+            self.reply(200, body, headers)
+
+        def reply(self, status, body, headers={}):
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            if body != None:
+                self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if body:
+                self.wfile.write(body)
+
+    root = tempfile.mkdtemp(prefix="httpcheck")
+    failures = []
+    def check(what, got, expected):
+        if got != expected:
+            failures.append(what)
+            print "FAIL %s: got %r, expected %r" % (what, got, expected)
+        else:
+            print "ok   " + what
+
+    (server, baseUrl) = checkServer(Handler)
+    client = HttpClient(cacheDir=os.path.join(root, "cache"))
+    try:
+        check("first fetch", client.get(baseUrl + "page"), "page v1")
+        check("ETag revalidated", client.get(baseUrl + "page"), "page v1")
+        check("304 on unchanged ETag", seen["304"], 1)
+        check("Last-Modified fetch", client.get(baseUrl + "dated"), "dated page")
+        check("Last-Modified revalidated", client.get(baseUrl + "dated"), "dated page")
+        check("304 on unchanged Last-Modified", seen["304"], 2)
+        check("hits and misses", (client.hits, client.misses), (2, 2))
+
+        pages["/page"] = ('"v2"', None, "page v2")
+        check("changed ETag refetched", client.get(baseUrl + "page"), "page v2")
+        check("cache=False is unconditional", (client.get(baseUrl + "page", cache=False), seen["conditional"]),
+              ("page v2", 3))
+        check("redirect followed", client.get(baseUrl + "redirect"), "page v2")
+        try:
+            client.get(baseUrl + "missing")
+            check("404 raises", None, 404)
+        except HttpError, e:
+            check("404 raises", e.status, 404)
+
+        check("keep-alive reuse", (client.reused, len(seen["connections"])), (client.requests - 1, 1))
+        response = client.open(baseUrl + "dated")
+        response.read(3)
+        response.close()
+        check("half read response isn't pooled", len(client.idle.get(("http", "127.0.0.1", server.server_address[1]), [])), 0)
+        client.get(baseUrl + "dated")
+        check("new connection after a dropped one", len(seen["connections"]), 2)
+
+        #A cache from another run is revalidated too
+        other = HttpClient(cacheDir=os.path.join(root, "cache"))
+        check("cache shared across clients", (other.get(baseUrl + "page"), other.hits), ("page v2", 1))
+        other.close()
+    finally:
+        client.close()
+        server.shutdown()
+        shutil.rmtree(root, ignore_errors=True)
+    print "%d checks failed" % len(failures)
+    return len(failures)
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["--check"]:
+        print "usage: httpclient.py --check"
+        sys.exit(1)
+    sys.exit(selfCheck() and 1 or 0)
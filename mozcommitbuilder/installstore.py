@@ -0,0 +1,424 @@
+# installstore.py
+#
+# Content addressed store for installed builds. Every file of an install is
+# kept once as a read-only blob named after its SHA-1 and mode, and installs
+# are farms of hard links (or reflinks) to the blobs, so builds that differ
+# in a few files cost only those files on disk. A manifest per build lets a
+# rerun recreate its install from links without extracting anything.
+# Extractors can write through the store (addFile), so files of a new build
+# that the store already has are linked as they stream by instead of written
+# and hashed again afterwards.
+#
+# A hard link is the blob itself, so a condition running as root (or one that
+# chmods a file and writes to it) changes every install sharing that file.
+# materialize() checks each blob's size, mtime and mode against the manifest
+# and rehashes the ones that changed, a damaged blob is dropped and the
+# build is installed from scratch again.
+#
+# Add an installed directory to a store (turning it into links) with:
+#     python installstore.py [store] [directory]
+# or compare installing near-identical builds with and without it with:
+#     python installstore.py --benchmark [megabytes] [files]
+
+import errno
+import hashlib
+import os
+import shutil
+import simplejson
+import stat
+import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+chunkSize = 256 * 1024
+#addFile() hashes files up to this size before writing anything
+bufferedSize = 4 * 1024 * 1024
+#ioctl asking Linux filesystems with copy on write (btrfs, xfs) for a reflink
+FICLONE = 0x40049409
+
+def fileDigest(path):
+    digest = hashlib.sha1()
+    f = open(path, "rb")
+    try:
+        for chunk in iter(lambda: f.read(chunkSize), ""):
+            digest.update(chunk)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+def reflink(src, dst):
+    #Copy on write clone of src at dst, raises OSError/IOError where unsupported
+    if fcntl == None:
+        raise OSError(errno.EOPNOTSUPP, "No reflinks on this platform")
+    source = open(src, "rb")
+    try:
+        target = open(dst, "wb")
+        try:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        except (IOError, OSError):
+            target.close()
+            os.remove(dst)
+            raise
+        target.close()
+    finally:
+        source.close()
+    shutil.copymode(src, dst)
+
+class InstallStore():
+    def __init__(self, root, links="hardlink", keep=20, pruneInterval=3600):
+        #links: "hardlink" or "reflink", each falls back to the next one and
+        #finally to a copy. keep: how many build manifests to hold on to.
+        #Unused blobs are looked for at most every pruneInterval seconds.
+        self.root = root
+        self.blobDir = os.path.join(root, "blobs")
+        self.manifestDir = os.path.join(root, "manifests")
+        self.prunedPath = os.path.join(root, "pruned")
+        self.links = links
+        self.keep = keep
+        self.pruneInterval = pruneInterval
+        self.lock = threading.Lock()
+        #{(device, inode): (blob key, whether the blob was there before, size,
+        #mtime)} of files written by addFile(), so ingest() doesn't hash them
+        #again. Size and mtime catch inodes reused after a failed install.
+        self.added = {}
+        for directory in (self.blobDir, self.manifestDir):
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+    def blobPath(self, key):
+        return os.path.join(self.blobDir, key[:2], key)
+
+    def manifestPath(self, build):
+        return os.path.join(self.manifestDir, hashlib.sha1(build).hexdigest() + ".json")
+
+    def link(self, blob, path):
+        #Put blob at path the cheapest way this filesystem allows
+        methods = [os.link, reflink, shutil.copy2]
+        if self.links == "reflink" or not hasattr(os, "link"):
+            methods = [reflink, shutil.copy2]
+        for method in methods[:-1]:
+            try:
+                method(blob, path)
+                return
+            except (IOError, OSError):
+                pass
+        methods[-1](blob, path)
+
+    def replace(self, blob, path):
+        #Swap the file at path for a link to blob, atomically where possible
+        tmpPath = path + ".store-" + str(os.getpid()) + "." + threading.currentThread().getName()
+        self.link(blob, tmpPath)
+        if os.name == "nt":
+            os.remove(path)
+        os.rename(tmpPath, path)
+
+    def ingest(self, directory, build=None):
+        #Turn the files under directory into links to blobs, adding the ones
+        #the store doesn't have yet. With build (e.g. the package URL), a
+        #manifest is kept so materialize() can recreate the tree later.
+        #Returns (files, bytes shared with earlier builds, new bytes).
+        start = time.time()
+        entries = []
+        (files, shared, added) = (0, 0, 0)
+        for parent, dirs, names in os.walk(directory):
+            relParent = os.path.relpath(parent, directory)
+            for name in dirs:
+                path = os.path.join(parent, name)
+                if os.path.islink(path):
+                    entries.append({"path": os.path.normpath(os.path.join(relParent, name)),
+                                    "link": os.readlink(path)})
+                else:
+                    entries.append({"path": os.path.normpath(os.path.join(relParent, name)),
+                                    "dir": stat.S_IMODE(os.stat(path).st_mode)})
+            for name in names:
+                path = os.path.join(parent, name)
+                relPath = os.path.normpath(os.path.join(relParent, name))
+                info = os.lstat(path)
+                if stat.S_ISLNK(info.st_mode):
+                    entries.append({"path": relPath, "link": os.readlink(path)})
+                    continue
+                if not stat.S_ISREG(info.st_mode):
+                    continue
+                files += 1
+                self.lock.acquire()
+                try:
+                    known = self.added.pop((info.st_dev, info.st_ino), None)
+                finally:
+                    self.lock.release()
+                if known != None and known[2:] == (info.st_size, info.st_mtime) and \
+                   os.path.exists(self.blobPath(known[0])):
+                    (key, existed) = known[:2]
+                    if existed:
+                        shared += info.st_size
+                    else:
+                        added += info.st_size
+                    self.addEntry(entries, relPath, key)
+                    continue
+                #Blobs are shared, so nobody gets to write to them
+                mode = stat.S_IMODE(info.st_mode) & ~0222
+                key = fileDigest(path) + "-" + "%o" % mode
+                blob = self.blobPath(key)
+                if os.path.exists(blob):
+                    if not os.path.samefile(blob, path):
+                        self.replace(blob, path)
+                    shared += info.st_size
+                else:
+                    self.addBlob(path, blob, mode)
+                    added += info.st_size
+                self.addEntry(entries, relPath, key)
+        if build != None:
+            self.saveManifest(build, entries)
+        elapsed = time.time() - start
+        print "Install store: %d files, %.1f MB shared with other builds, %.1f MB new (%.1fs)" % \
+              (files, shared / 1048576.0, added / 1048576.0, elapsed)
+        return (files, shared, added)
+
+    def addEntry(self, entries, relPath, key):
+        blobInfo = os.stat(self.blobPath(key))
+        entries.append({"path": relPath, "blob": key, "size": blobInfo.st_size, "mtime": blobInfo.st_mtime})
+
+    def addFile(self, fileobj, path, mode, size):
+        #Write size bytes from fileobj to path through the store. Small files
+        #are hashed first and only written if the store doesn't have them,
+        #bigger ones are hashed while they're written and swapped for a link
+        #if it does. Returns the blob key.
+        mode = stat.S_IMODE(mode) & ~0222
+        if os.path.lexists(path):
+            #It may be a link to a blob, which mustn't be written through
+            os.remove(path)
+        digest = hashlib.sha1()
+        data = None
+        if size <= bufferedSize:
+            data = fileobj.read()
+            digest.update(data)
+        else:
+            f = open(path, "wb")
+            try:
+                for chunk in iter(lambda: fileobj.read(chunkSize), ""):
+                    digest.update(chunk)
+                    f.write(chunk)
+            finally:
+                f.close()
+        key = digest.hexdigest() + "-" + "%o" % mode
+        blob = self.blobPath(key)
+        existed = os.path.exists(blob)
+        if existed and data != None:
+            self.link(blob, path)
+        elif existed:
+            self.replace(blob, path)
+        else:
+            if data != None:
+                f = open(path, "wb")
+                try:
+                    f.write(data)
+                finally:
+                    f.close()
+            self.addBlob(path, blob, mode)
+        info = os.lstat(path)
+        self.lock.acquire()
+        try:
+            self.added[(info.st_dev, info.st_ino)] = (key, existed, info.st_size, info.st_mtime)
+        finally:
+            self.lock.release()
+        return key
+
+    def addBlob(self, path, blob, mode):
+        if not os.path.exists(os.path.dirname(blob)):
+            try:
+                os.makedirs(os.path.dirname(blob))
+            except OSError:
+                pass
+        os.chmod(path, mode)
+        if self.links == "hardlink":
+            try:
+                #The installed file becomes the blob
+                os.link(path, blob)
+                return
+            except (AttributeError, OSError), e:
+                if getattr(e, "errno", None) == errno.EEXIST:
+                    #Someone else added it meanwhile
+                    self.replace(blob, path)
+                    return
+        tmpPath = blob + "." + str(os.getpid()) + "." + threading.currentThread().getName() + ".tmp"
+        self.link(path, tmpPath)
+        os.rename(tmpPath, blob)
+
+    def saveManifest(self, build, entries):
+        path = self.manifestPath(build)
+        f = open(path + ".tmp", "w")
+        simplejson.dump({"build": build, "entries": entries}, f)
+        f.close()
+        if os.name == "nt" and os.path.exists(path):
+            os.remove(path)
+        os.rename(path + ".tmp", path)
+        self.pruneIfDue()
+
+    def materialize(self, build, dest):
+        #Recreate the install of build in the empty directory dest. Returns
+        #False if the store doesn't have all of it, dest is left alone then.
+        try:
+            f = open(self.manifestPath(build))
+            try:
+                manifest = simplejson.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return False
+        entries = manifest["entries"]
+        if manifest.get("build") != build:
+            return False
+        start = time.time()
+        for entry in entries:
+            if "blob" in entry and not self.intact(entry):
+                return False
+        if not os.path.exists(dest):
+            os.makedirs(dest)
+        for entry in entries:
+            if "dir" in entry:
+                path = os.path.join(dest, entry["path"])
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+        for entry in entries:
+            path = os.path.join(dest, entry["path"])
+            if "blob" in entry:
+                self.link(self.blobPath(entry["blob"]), path)
+            elif "link" in entry:
+                os.symlink(entry["link"], path)
+        #Directory modes last, like the extractors
+        for entry in reversed(entries):
+            if "dir" in entry:
+                os.chmod(os.path.join(dest, entry["path"]), entry["dir"])
+        os.utime(self.manifestPath(build), None)
+        print "Installed %s from the install store, %d entries in %.1fs" % (build, len(entries), time.time() - start)
+        return True
+
+    def intact(self, entry):
+        #Whether the blob of a manifest entry is there and unchanged. Only
+        #blobs whose size, mtime or mode look touched are hashed again.
+        key = entry["blob"]
+        blob = self.blobPath(key)
+        try:
+            info = os.stat(blob)
+        except OSError:
+            return False
+        mode = int(key.split("-")[1], 8)
+        if stat.S_IMODE(info.st_mode) == mode and info.st_size == entry.get("size", info.st_size) and \
+           info.st_mtime == entry.get("mtime", info.st_mtime):
+            return True
+        if fileDigest(blob) == key.split("-")[0]:
+            os.chmod(blob, mode)
+            return True
+        print "Install store: " + entry["path"] + " was changed by an install using it, dropping its blob"
+        try:
+            os.remove(blob)
+        except OSError:
+            pass
+        return False
+
+    def pruneIfDue(self):
+        #prune() walks every blob, so it only runs every pruneInterval seconds
+        try:
+            if time.time() - os.path.getmtime(self.prunedPath) < self.pruneInterval:
+                return
+        except OSError:
+            pass
+        open(self.prunedPath, "w").close()
+        self.prune()
+
+    def prune(self):
+        #Keep the newest manifests, and drop blobs that no install links to
+        #and no kept manifest needs
+        self.lock.acquire()
+        try:
+            manifests = sorted([os.path.join(self.manifestDir, name) for name in os.listdir(self.manifestDir)
+                                if name.endswith(".json")], key=os.path.getmtime, reverse=True)
+            for path in manifests[self.keep:]:
+                os.remove(path)
+            needed = set()
+            for path in manifests[:self.keep]:
+                try:
+                    f = open(path)
+                    try:
+                        needed.update([entry["blob"] for entry in simplejson.load(f)["entries"] if "blob" in entry])
+                    finally:
+                        f.close()
+                except (IOError, ValueError, KeyError):
+                    pass
+            for parent, dirs, names in os.walk(self.blobDir):
+                for name in names:
+                    path = os.path.join(parent, name)
+                    if name not in needed and os.stat(path).st_nlink == 1:
+                        os.remove(path)
+        finally:
+            self.lock.release()
+
+    def usage(self):
+        #(bytes held by blobs, bytes all the linked installs would take as copies)
+        held = 0
+        linked = 0
+        for parent, dirs, names in os.walk(self.blobDir):
+            for name in names:
+                info = os.stat(os.path.join(parent, name))
+                held += info.st_size
+                linked += info.st_size * max(info.st_nlink - 1, 1)
+        return (held, linked)
+
+def benchmark(megabytes=200, files=400):
+    #Install build A, then build B which differs in one file out of twenty,
+    #extracting B normally and then ingesting it, or through the store
+    import extract
+    import random
+    import tarfile
+    import tempfile
+    work = tempfile.mkdtemp(prefix="storebench")
+    try:
+        tree = os.path.join(work, "tree")
+        extract.syntheticTree(tree, megabytes, files)
+        tarballs = []
+        for name in ("a", "b"):
+            if name == "b":
+                names = sorted(os.listdir(os.path.join(tree, "bin", "components")))
+                for changed in random.Random(1).sample(names, max(1, len(names) // 20)):
+                    f = open(os.path.join(tree, "bin", "components", changed), "ab")
+                    f.write("changed")
+                    f.close()
+            tarPath = os.path.join(work, name + ".tar.gz")
+            tar = tarfile.open(tarPath, "w:gz")
+            tar.add(tree, "firefox")
+            tar.close()
+            tarballs.append(tarPath)
+        print "%d files, %d MB, B differs in %d of them" % (files, megabytes, max(1, len(names) // 20))
+
+        def timed(label, name, through):
+            #Each way gets its own store holding build A
+            store = InstallStore(os.path.join(work, name))
+            extract.extractTar(tarballs[0], os.path.join(work, name + "-a"), quiet=True)
+            store.ingest(os.path.join(work, name + "-a"), "a")
+            dest = os.path.join(work, name + "-b")
+            start = time.time()
+            extract.extractTar(tarballs[1], dest, quiet=True, store=store if through else None)
+            extracted = time.time() - start
+            store.ingest(dest, "b")
+            elapsed = time.time() - start
+            print "%-28s extract %6.2fs, with ingest %6.2fs" % (label, extracted, elapsed)
+        timed("extract, then ingest", "after", False)
+        timed("extract through the store", "through", True)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--benchmark"]:
+        benchmark(*[int(arg) for arg in sys.argv[2:4]])
+        sys.exit(0)
+    if len(sys.argv) < 3:
+        print "usage: installstore.py [store] [directory]"
+        sys.exit(1)
+    store = InstallStore(sys.argv[1])
+    store.ingest(sys.argv[2])
+    (held, linked) = store.usage()
+    print "Store holds %.1f MB for %.1f MB of installs" % (held / 1048576.0, linked / 1048576.0)
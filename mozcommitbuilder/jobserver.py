@@ -0,0 +1,470 @@
+# jobserver.py
+#
+# Long-running bisection daemon. Hunts are submitted over a small local HTTP
+# API and run concurrently, each with its own in-process bisector. Their
+# builds go through one scheduler that owns the shared working copies, hands
+# out builds by job priority and builds a changeset only once no matter how
+# many hunts ask for it.
+#
+#     POST   /jobs        {"good":, "bad":, "condition":, "args": [], "priority": 0}
+#     GET    /jobs        summaries of every job
+#     GET    /jobs/<id>   one job, with its steps and result
+#     DELETE /jobs/<id>   cancel a job
+#     GET    /builds      what the scheduler is building and has queued
+
+import BaseHTTPServer
+import SocketServer
+import itertools
+import os
+import re
+import simplejson
+import threading
+import time
+import traceback
+import urllib2
+
+from bisection import NativeBisector, ProbabilisticBisector
+
+class BuildTicket():
+    #One build of a changeset, shared by every job that asked for it while it
+    #was queued, building, being tested or kept around after that
+    def __init__(self, node, priority, seq):
+        self.node = node
+        self.priority = priority
+        self.seq = seq
+        self.users = 0
+        self.objdir = None
+        self.failed = False
+        self.ready = threading.Event()
+        self.state = "queued"
+        self.finished = None
+
+class BuildScheduler():
+    def __init__(self, builder, linger=60):
+        #linger: seconds a finished build keeps its working copy, so a hunt
+        #asking for the same changeset right after doesn't build it again.
+        #Queued builds take the working copy back sooner.
+        self.builder = builder
+        self.linger = linger
+        self.workers = builder.worktrees.size
+        self.cv = threading.Condition()
+        self.tickets = {}
+        self.queue = []
+        self.seq = itertools.count()
+        self.built = 0
+        self.shared = 0
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.worker, name="build-" + str(i))
+            thread.setDaemon(True)
+            thread.start()
+
+    def request(self, node, priority=0):
+        #Returns a ticket for a build of node. wait() on it, then done() when
+        #the objdir isn't needed anymore.
+        self.cv.acquire()
+        try:
+            ticket = self.tickets.get(node)
+            if ticket != None:
+                self.shared += 1
+                ticket.priority = max(ticket.priority, priority)
+            else:
+                ticket = BuildTicket(node, priority, self.seq.next())
+                self.tickets[node] = ticket
+                self.queue.append(ticket)
+                self.cv.notifyAll()
+            ticket.users += 1
+            return ticket
+        finally:
+            self.cv.release()
+
+    def wait(self, ticket):
+        #The objdir of the build, or None if it failed
+        ticket.ready.wait()
+        if ticket.failed:
+            return None
+        return ticket.objdir
+
+    def done(self, ticket):
+        self.cv.acquire()
+        try:
+            ticket.users -= 1
+            if ticket.users <= 0:
+                #A build nobody waits for anymore isn't started. Builds that
+                #are under way are dropped by their worker, see worker().
+                if ticket in self.queue:
+                    self.queue.remove(ticket)
+                    if self.tickets.get(ticket.node) is ticket:
+                        del self.tickets[ticket.node]
+                ticket.finished = time.time()
+                self.cv.notifyAll()
+        finally:
+            self.cv.release()
+
+    def next(self):
+        #Highest priority first, oldest request breaks ties
+        self.cv.acquire()
+        try:
+            while not self.queue:
+                self.cv.wait()
+            ticket = max(self.queue, key=lambda ticket: (ticket.priority, -ticket.seq))
+            self.queue.remove(ticket)
+            ticket.state = "building"
+            return ticket
+        finally:
+            self.cv.release()
+
+    def worker(self):
+        #Each worker holds one working copy at a time, until the build it made
+        #there has been tested by everyone who asked for it
+        while True:
+            ticket = self.next()
+            lease = None
+            try:
+                lease = self.builder.leaseWorktree(ticket.node)
+                self.builder.build(changeset=ticket.node, worktree=lease.path)
+                ticket.objdir = lease.objdir
+                self.built += 1
+            except Exception, e:
+                print "Build of " + ticket.node[:12] + " failed: " + str(e)
+                ticket.failed = True
+            ticket.state = "ready"
+            ticket.ready.set()
+            readyAt = time.time()
+
+            self.cv.acquire()
+            try:
+                while True:
+                    if ticket.users > 0:
+                        self.cv.wait()
+                        continue
+                    #Keep a good build for late requests until it's too old
+                    #or a queued build needs this worker
+                    remaining = max(ticket.finished or 0, readyAt) + self.linger - time.time()
+                    if ticket.failed or self.queue or remaining <= 0:
+                        break
+                    self.cv.wait(remaining)
+                #Nobody needs this objdir anymore, a later request builds again
+                #(usually straight from the artifact cache)
+                if self.tickets.get(ticket.node) is ticket:
+                    del self.tickets[ticket.node]
+            finally:
+                self.cv.release()
+            if lease != None:
+                lease.release(node=ticket.node)
+
+    def status(self):
+        self.cv.acquire()
+        try:
+            return {"workers": self.workers,
+                    "built": self.built,
+                    "shared": self.shared,
+                    "builds": [{"node": ticket.node, "state": ticket.state, "priority": ticket.priority,
+                                "users": ticket.users} for ticket in self.tickets.values()]}
+        finally:
+            self.cv.release()
+
+class Job():
+    fields = ["id", "good", "bad", "condition", "args", "priority", "state", "submitted", "started",
+              "finished", "steps", "result", "error"]
+
+    def __init__(self, jobId, good, bad, condition, args=[], priority=0):
+        self.id = jobId
+        self.good = good
+        self.bad = bad
+        self.condition = condition
+        self.args = list(args)
+        self.priority = priority
+        self.state = "queued"
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.steps = []
+        self.result = None
+        self.error = None
+        self.cancelled = False
+
+    def record(self, summary=False):
+        record = dict([(field, getattr(self, field)) for field in self.fields])
+        if summary:
+            del record["steps"]
+            record["tested"] = len(self.steps)
+        return record
+
+class JobServer():
+    def __init__(self, builder, maxJobs=None):
+        #maxJobs caps how many hunts bisect at once, the rest wait in line
+        self.builder = builder
+        self.scheduler = BuildScheduler(builder)
+        self.jobDir = os.path.join(builder.shellCacheDir, "jobs")
+        if not os.path.exists(self.jobDir):
+            os.makedirs(self.jobDir)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(maxJobs or self.scheduler.workers * 2)
+        self.ids = itertools.count(self.lastJobId() + 1)
+        self.recover()
+
+    def lastJobId(self):
+        #Job IDs keep counting across restarts, finished jobs stay on disk
+        ids = [int(name[:-5]) for name in os.listdir(self.jobDir) if re.match(r"^\d+\.json$", name)]
+        return max(ids or [0])
+
+    def recover(self):
+        #Jobs the last server left queued or running start over. Verdicts
+        #they already had come from the verdict cache. Jobs whose condition
+        #script is gone are marked failed.
+        names = [name for name in os.listdir(self.jobDir) if re.match(r"^\d+\.json$", name)]
+        for name in sorted(names, key=lambda name: int(name[:-5])):
+            try:
+                f = open(os.path.join(self.jobDir, name))
+                try:
+                    record = simplejson.load(f)
+                finally:
+                    f.close()
+            except (IOError, ValueError):
+                continue
+            if record.get("state") not in ("queued", "running"):
+                continue
+            job = Job(record["id"], record["good"], record["bad"], record["condition"], record.get("args", []),
+                      record.get("priority", 0))
+            job.submitted = record.get("submitted") or job.submitted
+            if not os.path.exists(job.condition):
+                job.state = "failed"
+                job.error = "Interrupted by a server restart, and the condition script is gone"
+                job.finished = time.time()
+                self.save(job)
+                continue
+            print "Restarting job " + str(job.id) + ", interrupted while " + record["state"]
+            self.start(job)
+
+    def save(self, job):
+        path = os.path.join(self.jobDir, str(job.id) + ".json")
+        f = open(path + ".tmp", "w")
+        simplejson.dump(job.record(), f, indent=2)
+        f.close()
+        if os.name == "nt" and os.path.exists(path):
+            os.remove(path)
+        os.rename(path + ".tmp", path)
+
+    def submit(self, good, bad, condition, args=[], priority=0):
+        if not condition:
+            raise ValueError("Jobs need a condition script, the server can't ask anyone for verdicts")
+        if not os.path.exists(condition):
+            raise ValueError("No condition script at " + condition)
+        self.lock.acquire()
+        try:
+            job = Job(self.ids.next(), good, bad, os.path.abspath(condition), args, int(priority))
+        finally:
+            self.lock.release()
+        self.start(job)
+        return job
+
+    def start(self, job):
+        self.lock.acquire()
+        try:
+            self.jobs[job.id] = job
+        finally:
+            self.lock.release()
+        self.save(job)
+        thread = threading.Thread(target=self.runJob, args=(job,), name="job-" + str(job.id))
+        thread.setDaemon(True)
+        thread.start()
+
+    def get(self, jobId):
+        job = self.jobs.get(jobId)
+        if job != None:
+            return job.record()
+        path = os.path.join(self.jobDir, str(jobId) + ".json")
+        if os.path.exists(path):
+            f = open(path)
+            try:
+                return simplejson.load(f)
+            finally:
+                f.close()
+        return None
+
+    def cancel(self, jobId):
+        job = self.jobs.get(jobId)
+        if job == None:
+            return False
+        job.cancelled = True
+        return True
+
+    def resolve(self, rev):
+        #Changeset or YYYY-MM-DD date to a full node
+        if re.match(r"^\d\d\d\d-\d\d-\d\d$", rev):
+            rev = self.builder.changesetFromDay(rev) or rev
+        return self.builder.hg.node(rev)
+
+    def newBisector(self):
+        if self.builder.engine == "probabilistic":
+            return ProbabilisticBisector(self.builder.hg, confidence=self.builder.confidence,
+                                         falsePositive=self.builder.falsePositive,
+                                         falseNegative=self.builder.falseNegative)
+        #hg bisect keeps its state in the repository, so hunts can't share it
+        return NativeBisector(self.builder.hg)
+
+    def runJob(self, job):
+        self.slots.acquire()
+        try:
+            if job.cancelled:
+                job.state = "cancelled"
+                return
+            job.state = "running"
+            job.started = time.time()
+            self.save(job)
+            try:
+                self.bisect(job)
+                job.state = "cancelled" if job.cancelled else "done"
+            except Exception, e:
+                traceback.print_exc()
+                job.state = "failed"
+                job.error = str(e)
+        finally:
+            job.finished = time.time()
+            self.save(job)
+            self.slots.release()
+
+    def bisect(self, job):
+        builder = self.builder
+        good = self.resolve(job.good)
+        bad = self.resolve(job.bad)
+        if not (good and bad):
+            raise ValueError("Unknown changeset " + (job.bad if good else job.good))
+        bisector = self.newBisector()
+        found = bisector.start(good, bad)
+        key = builder.verdictKey(job.condition, job.args)
+        while not found and not job.cancelled:
+            node = bisector.current()
+            if node == None:
+                break
+            step = {"changeset": node, "started": time.time(), "cached": False}
+            verdict = builder.cachedVerdict(node, key)
+            if verdict != None:
+                step["cached"] = True
+            else:
+                ticket = self.scheduler.request(node, job.priority)
+                try:
+                    objdir = self.scheduler.wait(ticket)
+                    if objdir == None:
+                        verdict = "skip"
+                    else:
+                        with builder.tracer.span("condition", objdir=objdir, job=job.id):
+                            verdict = builder.conditions.run(job.condition, objdir, job.args)
+                        builder.storeVerdict(node, key, verdict)
+                finally:
+                    self.scheduler.done(ticket)
+            step["verdict"] = verdict
+            step["finished"] = time.time()
+            job.steps.append(step)
+            self.save(job)
+            found = bisector.mark(node, verdict)
+        job.result = bisector.result()
+
+    def status(self):
+        self.lock.acquire()
+        try:
+            jobs = sorted(self.jobs.values(), key=lambda job: job.id)
+        finally:
+            self.lock.release()
+        return [job.record(summary=True) for job in jobs]
+
+class JobRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def reply(self, code, data):
+        body = simplejson.dumps(data, indent=2)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def jobId(self):
+        match = re.match(r"^/jobs/(\d+)/?$", self.path)
+        if match:
+            return int(match.group(1))
+        return None
+
+    def do_GET(self):
+        jobs = self.server.jobs
+        if self.path.rstrip("/") == "/jobs":
+            self.reply(200, jobs.status())
+        elif self.path.rstrip("/") == "/builds":
+            self.reply(200, jobs.scheduler.status())
+        elif self.jobId() != None:
+            record = jobs.get(self.jobId())
+            if record == None:
+                self.reply(404, {"error": "No such job"})
+            else:
+                self.reply(200, record)
+        else:
+            self.reply(404, {"error": "Unknown path " + self.path})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            self.reply(404, {"error": "Unknown path " + self.path})
+            return
+        try:
+            data = simplejson.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            job = self.server.jobs.submit(data["good"], data["bad"], data.get("condition"),
+                                          args=data.get("args", []), priority=data.get("priority", 0))
+        except (ValueError, KeyError, TypeError), e:
+            self.reply(400, {"error": str(e)})
+            return
+        self.reply(201, job.record())
+
+    def do_DELETE(self):
+        jobId = self.jobId()
+        if jobId == None or not self.server.jobs.cancel(jobId):
+            self.reply(404, {"error": "No such running job"})
+        else:
+            self.reply(200, {"id": jobId, "cancelled": True})
+
+class JobHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def serve(builder, port=8642, host="127.0.0.1", maxJobs=None):
+    #Runs until interrupted. Only listens on localhost unless told otherwise,
+    #since anyone who can submit a job can run a condition script here.
+    server = JobHTTPServer((host, port), JobRequestHandler)
+    server.jobs = JobServer(builder, maxJobs=maxJobs)
+    print "Job server listening on http://" + host + ":" + str(port) + " with " + \
+          str(server.jobs.scheduler.workers) + " build workers"
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print "Shutting down the job server."
+    server.server_close()
+
+class JobClient():
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def call(self, method, path, data=None):
+        body = None
+        if data != None:
+            body = simplejson.dumps(data)
+        request = urllib2.Request(self.url + path, data=body)
+        request.get_method = lambda: method
+        if body != None:
+            request.add_header("Content-Type", "application/json")
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError, e:
+            response = e
+        try:
+            return simplejson.load(response)
+        finally:
+            response.close()
+
+    def submit(self, good, bad, condition, args=[], priority=0):
+        return self.call("POST", "/jobs", {"good": good, "bad": bad, "condition": condition and os.path.abspath(condition),
+                                           "args": list(args), "priority": priority})
+
+    def status(self, jobId=None):
+        if jobId == None:
+            return self.call("GET", "/jobs")
+        return self.call("GET", "/jobs/" + str(jobId))
+
+    def cancel(self, jobId):
+        return self.call("DELETE", "/jobs/" + str(jobId))
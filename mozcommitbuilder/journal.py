@@ -0,0 +1,90 @@
+# journal.py
+#
+# On-disk record of a bisection so it can be resumed after a crash or ^C.
+
+import os
+import simplejson
+import time
+
+class BisectJournal():
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+
+    def load(self):
+        #Returns True if there's a journal on disk
+        if not os.path.exists(self.path):
+            self.data = None
+            return False
+        f = open(self.path)
+        try:
+            self.data = simplejson.load(f)
+        finally:
+            f.close()
+        return True
+
+    def save(self):
+        #Write to a temporary file and rename so the journal is never half written
+        tmpPath = self.path + ".tmp"
+        f = open(tmpPath, "w")
+        simplejson.dump(self.data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        if os.name == "nt" and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmpPath, self.path)
+
+    def start(self, good, bad, condition=None, args=[]):
+        self.data = {"good": good,
+                     "bad": bad,
+                     "condition": condition,
+                     "args": list(args),
+                     "started": time.time(),
+                     "finished": None,
+                     "result": None,
+                     "steps": []}
+        self.save()
+
+    def active(self):
+        return self.data != None and self.data.get("finished") == None
+
+    def steps(self):
+        if self.data == None:
+            return []
+        return self.data["steps"]
+
+    def judged(self):
+        #(changeset, verdict) for every step that got a verdict, in order
+        return [(step["changeset"], step["verdict"]) for step in self.steps() if step.get("verdict")]
+
+    def verdictFor(self, changeset):
+        for node, verdict in self.judged():
+            if node == changeset:
+                return verdict
+        return None
+
+    def beginStep(self, changeset):
+        step = {"changeset": changeset,
+                "verdict": None,
+                "started": time.time(),
+                "buildTime": None,
+                "testTime": None,
+                "artifact": None}
+        if self.data != None:
+            self.data["steps"].append(step)
+            self.save()
+        return step
+
+    def finishStep(self, step, verdict):
+        step["verdict"] = verdict
+        step["finished"] = time.time()
+        if self.data != None:
+            self.save()
+
+    def finish(self, result):
+        if self.data == None:
+            return
+        self.data["finished"] = time.time()
+        self.data["result"] = result
+        self.save()
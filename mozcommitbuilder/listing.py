@@ -0,0 +1,352 @@
+# listing.py
+#
+# Reads HTTP directory listings (archive and FTP mirror pages) with an
+# incremental HTMLParser, yielding links as the page streams in so a search
+# can stop at the first match. Parsed listings can be kept in a SQLite index
+# (name -> URL, size, date) for fast lookups across runs.
+#
+# Benchmark on a synthetic listing with:
+#     python listing.py [entries]
+# or check parsing and the index against a stand-in server with:
+#     python listing.py --check
+
+import HTMLParser
+import re
+import sqlite3
+import sys
+import threading
+import time
+import urllib
+import urlparse
+
+import httpclient
+
+chunkSize = 64 * 1024
+#Apache and nginx listings put the date and size in the text after the link
+datePattern = re.compile(r"(\d{1,2}-\w{3}-\d{4} \d{1,2}:\d{2}|\d{4}-\d{2}-\d{2} \d{1,2}:\d{2})")
+sizePattern = re.compile(r"\s(\d+(?:\.\d+)?[KMGT]?|-)\s*$")
+
+class LinkExtractor(HTMLParser.HTMLParser):
+    #Collects <a href> entries. Each one is finished, with the size and date
+    #from the text after it, when the next link starts or the page ends.
+    def __init__(self, baseUrl=""):
+        HTMLParser.HTMLParser.__init__(self)
+        self.baseUrl = baseUrl
+        self.current = None
+        self.text = []
+        self.done = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag != "a":
+            return
+        href = dict(attrs).get("href")
+        if href == None:
+            return
+        self.finish()
+        self.current = {"href": href}
+
+    def handle_data(self, data):
+        if self.current != None:
+            self.text.append(data)
+
+    def finish(self):
+        if self.current == None:
+            return
+        entry = self.current
+        text = " ".join(self.text)
+        match = datePattern.search(text)
+        entry["date"] = match.group(1) if match else None
+        #The size follows the date, after the link's own text
+        after = text[match.end():] if match else ""
+        match = sizePattern.search(" " + after)
+        entry["size"] = match.group(1) if match and match.group(1) != "-" else None
+        entry["name"] = urllib.unquote(entry["href"].split("?")[0].rstrip("/").split("/")[-1])
+        entry["url"] = urlparse.urljoin(self.baseUrl, entry["href"])
+        self.done.append(entry)
+        self.current = None
+        self.text = []
+
+    def feedChunk(self, chunk):
+        #Entries finished by this chunk
+        self.feed(chunk)
+        done = self.done
+        self.done = []
+        return done
+
+    def end(self):
+        self.close()
+        self.finish()
+        done = self.done
+        self.done = []
+        return done
+
+def extractLinks(chunks, baseUrl=""):
+    #Yields link entries (dicts with href, name, url, size, date) from an
+    #iterable of HTML chunks
+    parser = LinkExtractor(baseUrl)
+    for chunk in chunks:
+        for entry in parser.feedChunk(chunk):
+            yield entry
+    for entry in parser.end():
+        yield entry
+
+def responseChunks(response):
+    while True:
+        chunk = response.read(chunkSize)
+        if not chunk:
+            return
+        yield chunk
+
+def iterLinks(url, headers={}):
+    #Streams the listing at url. Stopping early closes the connection.
+    response = httpclient.sharedClient().open(url, headers=headers)
+    try:
+        for entry in extractLinks(responseChunks(response), baseUrl=url):
+            yield entry
+    finally:
+        response.close()
+
+def findLink(url, pattern):
+    #First entry whose href matches pattern (a regex), without reading the rest
+    regex = re.compile(pattern)
+    for entry in iterLinks(url):
+        if regex.match(entry["href"]):
+            return entry
+    return None
+
+class ListingIndex():
+    #Parsed listings on disk. A listing younger than maxAge is answered from
+    #the index, an older one is revalidated with its ETag/Last-Modified and
+    #only parsed again if it changed. A listing that isn't there (404) is
+    #remembered as empty for maxAge too.
+    def __init__(self, path, maxAge=3600):
+        self.path = path
+        self.maxAge = maxAge
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute("CREATE TABLE IF NOT EXISTS listings (url TEXT PRIMARY KEY, fetched REAL NOT NULL, "
+                        "etag TEXT, lastModified TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (listing TEXT NOT NULL, name TEXT NOT NULL, "
+                        "href TEXT NOT NULL, url TEXT NOT NULL, size TEXT, date TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_listing ON entries (listing, name)")
+        if "missing" not in [column[1] for column in self.db.execute("PRAGMA table_info(listings)")]:
+            self.db.execute("ALTER TABLE listings ADD COLUMN missing INTEGER NOT NULL DEFAULT 0")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def refresh(self, url):
+        #Make sure the index holds a current copy of the listing at url
+        self.lock.acquire()
+        try:
+            row = self.db.execute("SELECT fetched, etag, lastModified FROM listings WHERE url = ?", (url,)).fetchone()
+        finally:
+            self.lock.release()
+        if row != None and time.time() - row[0] < self.maxAge:
+            return
+
+        headers = {}
+        if row != None:
+            if row[1]:
+                headers["If-None-Match"] = row[1]
+            if row[2]:
+                headers["If-Modified-Since"] = row[2]
+        try:
+            response = httpclient.sharedClient().open(url, headers=headers)
+        except httpclient.HttpError, e:
+            if e.status != 404:
+                raise
+            self.store(url, [], None, None, missing=True)
+            return
+        try:
+            if response.status == 304 and row != None:
+                response.read()
+                self.lock.acquire()
+                try:
+                    self.db.execute("UPDATE listings SET fetched = ? WHERE url = ?", (time.time(), url))
+                    self.db.commit()
+                finally:
+                    self.lock.release()
+                return
+            entries = list(extractLinks(responseChunks(response), baseUrl=url))
+        finally:
+            response.close()
+        self.store(url, entries, response.getheader("ETag"), response.getheader("Last-Modified"))
+
+    def store(self, url, entries, etag, lastModified, missing=False):
+        self.lock.acquire()
+        try:
+            self.db.execute("DELETE FROM entries WHERE listing = ?", (url,))
+            self.db.executemany("INSERT INTO entries (listing, name, href, url, size, date) VALUES (?, ?, ?, ?, ?, ?)",
+                                [(url, entry["name"], entry["href"], entry["url"], entry["size"], entry["date"])
+                                 for entry in entries])
+            self.db.execute("INSERT OR REPLACE INTO listings (url, fetched, etag, lastModified, missing) "
+                            "VALUES (?, ?, ?, ?, ?)", (url, time.time(), etag, lastModified, int(missing)))
+            self.db.commit()
+        finally:
+            self.lock.release()
+
+    def entries(self, url, glob=None):
+        #Entries of the listing at url, optionally only names matching a glob
+        self.refresh(url)
+        query = "SELECT name, href, url, size, date FROM entries WHERE listing = ?"
+        params = [url]
+        if glob:
+            query += " AND name GLOB ?"
+            params.append(glob)
+        self.lock.acquire()
+        try:
+            rows = self.db.execute(query + " ORDER BY rowid", params).fetchall()
+        finally:
+            self.lock.release()
+        return [{"name": row[0], "href": row[1], "url": row[2], "size": row[3], "date": row[4]} for row in rows]
+
+    def names(self, url):
+        return [entry["name"] for entry in self.entries(url)]
+
+    def find(self, url, pattern):
+        #First entry whose name matches pattern (a regex)
+        regex = re.compile(pattern)
+        for entry in self.entries(url):
+            if regex.match(entry["name"]):
+                return entry
+        return None
+
+#The index everything shares, see configure()
+index = None
+
+def configure(path, maxAge=3600):
+    global index
+    if index != None:
+        index.close()
+    index = ListingIndex(path, maxAge=maxAge)
+    return index
+
+def sharedIndex():
+    return index
+
+def syntheticListing(entries):
+    #An Apache style listing of entries build directories and files
+    lines = ["<html><head><title>Index of /pub/firefox/tinderbox-builds/</title></head><body>",
+             "<h1>Index of /pub/firefox/tinderbox-builds/</h1><pre>",
+             '<a href="?C=N;O=D">Name</a>                    <a href="?C=M;O=A">Last modified</a>      <a href="?C=S;O=A">Size</a>',
+             "<hr>"]
+    for i in range(entries):
+        name = "firefox-%d.0a1.en-US.linux-x86_64.tar.bz2" % i
+        lines.append('<img src="/icons/compressed.gif" alt="[   ]"> <a href="%s">%s</a> %02d-Sep-2011 %02d:%02d   %dM' %
+                     (name, name, i % 28 + 1, i % 24, i % 60, 20 + i % 10))
+    lines.append("<hr></pre></body></html>")
+    return "\n".join(lines)
+
+def benchmark(entries=50000):
+    page = syntheticListing(entries)
+    chunks = [page[i:i + chunkSize] for i in range(0, len(page), chunkSize)]
+    target = "firefox-%d.0a1" % (entries // 2)
+    print "%d entries, %.1f MB" % (entries, len(page) / 1048576.0)
+
+    start = time.time()
+    count = len(list(extractLinks(chunks)))
+    print "%-26s %8.3fs (%d links)" % ("streaming, whole page", time.time() - start, count)
+
+    start = time.time()
+    for entry in extractLinks(chunks):
+        if entry["name"].startswith(target):
+            break
+    print "%-26s %8.3fs" % ("streaming, stop at middle", time.time() - start)
+
+    try:
+        from BeautifulSoup import BeautifulSoup
+    except ImportError:
+        print "%-26s %8s" % ("BeautifulSoup", "not installed")
+    else:
+        start = time.time()
+        count = len(BeautifulSoup(page).findAll("a"))
+        print "%-26s %8.3fs (%d links)" % ("BeautifulSoup", time.time() - start, count)
+
+    db = ListingIndex(":memory:")
+    db.db.executemany("INSERT INTO entries (listing, name, href, url, size, date) VALUES (?, ?, ?, ?, ?, ?)",
+                      [("bench", entry["name"], entry["href"], entry["url"], entry["size"], entry["date"])
+                       for entry in extractLinks(chunks)])
+    db.db.execute("INSERT INTO listings (url, fetched) VALUES (?, ?)", ("bench", time.time()))
+    start = time.time()
+    found = db.entries("bench", glob=target + "*")
+    print "%-26s %8.3fs (%d found)" % ("index lookup", time.time() - start, len(found))
+
+def selfCheck():
+    #Streams and indexes a synthetic listing served by a stand-in server.
+    #Returns the number of failures.
+    import BaseHTTPServer
+
+    page = {"etag": '"1"', "entries": 200}
+    seen = {"requests": 0, "304": 0}
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            seen["requests"] += 1
+            if self.path.startswith("/missing"):
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(304 if self.headers.get("If-None-Match") == page["etag"] else 200)
+            self.send_header("ETag", page["etag"])
+            if self.headers.get("If-None-Match") == page["etag"]:
+                seen["304"] += 1
+                self.end_headers()
+                return
+            body = syntheticListing(page["entries"])
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    failures = []
+    def check(what, got, expected):
+        if got != expected:
+            failures.append(what)
+            print "FAIL %s: got %r, expected %r" % (what, got, expected)
+        else:
+            print "ok   " + what
+
+    (server, baseUrl) = httpclient.checkServer(Handler)
+    url = baseUrl + "builds/"
+    db = ListingIndex(":memory:", maxAge=3600)
+    try:
+        links = [entry for entry in iterLinks(url) if not entry["href"].startswith("?")]
+        check("streamed links", len(links), 200)
+        check("entry fields", (links[7]["name"], links[7]["url"], links[7]["size"], links[7]["date"]),
+              ("firefox-7.0a1.en-US.linux-x86_64.tar.bz2", url + "firefox-7.0a1.en-US.linux-x86_64.tar.bz2",
+               "27M", "08-Sep-2011 07:07"))
+        check("findLink", findLink(url, r"firefox-150\.")["name"], "firefox-150.0a1.en-US.linux-x86_64.tar.bz2")
+
+        requests = seen["requests"]
+        check("index glob", [entry["name"] for entry in db.entries(url, glob="firefox-42.*")],
+              ["firefox-42.0a1.en-US.linux-x86_64.tar.bz2"])
+        check("index find", db.find(url, r"firefox-199\.")["size"], "29M")
+        check("fresh listing answered from the index", seen["requests"], requests + 1)
+
+        db.maxAge = 0
+        check("unchanged listing revalidated", (len(db.names(url)), seen["304"]), (203, 1))
+        page["etag"] = '"2"'
+        page["entries"] = 210
+        check("changed listing parsed again", len(db.names(url)), 213)
+
+        db.maxAge = 3600
+        requests = seen["requests"]
+        check("missing listing is empty", (db.names(baseUrl + "missing/"), db.names(baseUrl + "missing/")), ([], []))
+        check("missing listing remembered", seen["requests"], requests + 1)
+    finally:
+        db.close()
+        httpclient.sharedClient().close()
+        server.shutdown()
+    print "%d checks failed" % len(failures)
+    return len(failures)
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--check"]:
+        sys.exit(selfCheck() and 1 or 0)
+    entries = 50000
+    if len(sys.argv) > 1:
+        entries = int(sys.argv[1])
+    benchmark(entries)
@@ -43,7 +43,9 @@ import time
 import string
 import os
 import shutil
-import zipfile
+
+import extract
+import trash
 
 isDMG = re.compile(".*\.dmg")
 isTARBZ = re.compile(".*\.tar\.bz")
@@ -69,39 +71,13 @@ def getPlatform():
   else:
     return platform.system()
 
-# This code is lifted directly from the buildbot code. That we use here. I
-# can't call it in buildbot without importing a trillion other things.
-# Original Source: http://mxr.mozilla.org/mozilla/source/tools/buildbot/buildbot/slave/commands.py#59
+# Originally lifted from the buildbot code, which walked the tree in Python
+# making each entry writable before removing it. trash.removeTree does the
+# same with parallel walkers.
 def rmdirRecursive(dir):
   """This is a replacement for shutil.rmtree that works better under
-  windows. Thanks to Bear at the OSAF for the code."""
-  if not os.path.exists(dir):
-      return
-
-  if os.path.islink(dir):
-      os.remove(dir)
-      return
-
-  # Verify the directory is read/write/execute for the current user
-  os.chmod(dir, 0700)
-
-  for name in os.listdir(dir):
-      full_name = os.path.join(dir, name)
-      # on Windows, if we don't have write permission we can't remove
-      # the file/directory either, so turn that on
-      if os.name == 'nt':
-          if not os.access(full_name, os.W_OK):
-              # I think this is now redundant, but I don't have an NT
-              # machine to test on, so I'm going to leave it in place
-              # -warner
-              os.chmod(full_name, 0600)
-
-      if os.path.isdir(full_name):
-          rmdirRecursive(full_name)
-      else:
-          os.chmod(full_name, 0700)
-          os.remove(full_name)
-  os.rmdir(dir)
+  windows, read-only files and directories are made writable first."""
+  trash.removeTree(dir)
 
 class MozUninstaller:
   def __init__(self, **kwargs):
@@ -241,30 +217,21 @@ class MozInstaller:
   def installTarBz(self):
     # Ensure our destination directory exists
     self.dest = self.normalizePath(self.dest)
-    self.unTar("-jxf")
+    self.unTar()
 
   def installTarGz(self):
     # Ensure our destination directory exists
     self.dest = self.normalizePath(self.dest)
-    self.unTar("-zxf")
+    self.unTar()
 
-  def unTar(self, tarArgs):
-    args = "tar " + tarArgs + " " + self.src + " -C " + self.dest
-    proc = subprocess.Popen(args, shell=True)
-    proc.wait()
-    #TODO: throw stderr
+  def unTar(self):
+    # Streams the tarball, raises extract.ExtractError if it's broken
+    extract.extractTar(self.src, self.dest)
 
   def installZip(self):
     self.dest = self.normalizePath(self.dest)
-    #TODO: throw stderr
-    zipped = zipfile.ZipFile(self.src)
-    try:
-        zipped.extractall(self.dest)
-    except:
-        args = ["unzip", "-o", "-q", "-d", self.dest, self.src]
-        proc = subprocess.Popen(args)
-        proc.wait()
-        
+    extract.extractZip(self.src, self.dest)
+
   def installExe(self):
     debug("running installEXE")
     args = self.src + " "
@@ -0,0 +1,247 @@
+# pushlog.py
+#
+# Local SQLite copy of a repository's pushlog (json-pushes), so date and
+# push lookups don't need a request every time. The index only ever holds
+# one contiguous run of push IDs; it grows forward with pushes newer than
+# the last one stored, and backward when an older day is asked for.
+#
+# Check it against a stand-in pushlog server with:
+#     python pushlog.py --check
+
+import calendar
+import hashlib
+import os
+import simplejson
+import sqlite3
+import sys
+import urllib
+import urlparse
+
+import httpclient
+from utils import get_date, increment_day
+
+class PushlogIndex():
+    batchSize = 500
+
+    def __init__(self, path, pushlogURL):
+        self.path = path
+        self.pushlogURL = pushlogURL
+        parent = os.path.dirname(path)
+        if parent and not os.path.exists(parent):
+            os.makedirs(parent)
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS pushes (id INTEGER PRIMARY KEY, date INTEGER NOT NULL, user TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS pushes_date ON pushes (date)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS changesets (node TEXT PRIMARY KEY, pushid INTEGER NOT NULL, "
+                        "position INTEGER NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS changesets_push ON changesets (pushid, position)")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def fetch(self, **params):
+        #Returns {pushid: {"date":, "user":, "changesets": []}} from the server
+        url = self.pushlogURL + "?" + urllib.urlencode(params)
+        return simplejson.loads(httpclient.sharedClient().get(url))
+
+    def store(self, pushes):
+        #Returns the number of pushes added
+        for pushid, push in pushes.items():
+            pushid = int(pushid)
+            self.db.execute("INSERT OR REPLACE INTO pushes (id, date, user) VALUES (?, ?, ?)",
+                            (pushid, int(push["date"]), push.get("user")))
+            for position, node in enumerate(push.get("changesets", [])):
+                self.db.execute("INSERT OR REPLACE INTO changesets (node, pushid, position) VALUES (?, ?, ?)",
+                                (str(node), pushid, position))
+        self.db.commit()
+        return len(pushes)
+
+    def bounds(self):
+        #(min id, max id, min date, max date), all None when empty
+        return self.db.execute("SELECT MIN(id), MAX(id), MIN(date), MAX(date) FROM pushes").fetchone()
+
+    def update(self, untilDate=None):
+        #Fetch pushes newer than the newest one we have, all of them or only
+        #until we reach one from untilDate or later
+        (minId, maxId, minDate, maxDate) = self.bounds()
+        if maxId == None:
+            return 0
+        added = 0
+        while untilDate == None or maxDate < untilDate:
+            pushes = self.fetch(startID=maxId, endID=maxId + self.batchSize)
+            if not pushes:
+                break
+            added += self.store(pushes)
+            maxId = max(map(int, pushes.keys()))
+            maxDate = max([int(push["date"]) for push in pushes.values()])
+        return added
+
+    def backfill(self, untilDate):
+        #Fetch older pushes until we reach one from before untilDate
+        (minId, maxId, minDate, maxDate) = self.bounds()
+        while minId != None and minId > 1 and minDate >= untilDate:
+            startId = max(0, minId - 1 - self.batchSize)
+            pushes = self.fetch(startID=startId, endID=minId - 1)
+            if not pushes:
+                return
+            self.store(pushes)
+            (minId, maxId, minDate, maxDate) = self.bounds()
+
+    def dayRange(self, date):
+        #Unix time bounds [start, end) of a YYYY-MM-DD day, in UTC
+        day = get_date(date)
+        start = calendar.timegm(day.timetuple())
+        return (start, start + 24 * 60 * 60)
+
+    def ensureDay(self, date):
+        #Make sure every push of that day is in the index
+        (start, end) = self.dayRange(date)
+        (minId, maxId, minDate, maxDate) = self.bounds()
+        if maxId == None:
+            #Empty index, seed it with the pushes from around that day
+            self.store(self.fetch(startdate=date, enddate=increment_day(date)))
+            (minId, maxId, minDate, maxDate) = self.bounds()
+            if maxId == None:
+                return
+        if minDate >= start:
+            self.backfill(start)
+        if maxDate < end:
+            #Only as far as that day, not every push since
+            self.update(end)
+
+    def pushesOfDay(self, date, oldest=True):
+        (start, end) = self.dayRange(date)
+        order = "ASC" if oldest else "DESC"
+        row = self.db.execute("SELECT id FROM pushes WHERE date >= ? AND date < ? ORDER BY id " + order + " LIMIT 1",
+                              (start, end)).fetchone()
+        if row == None:
+            return None
+        return row[0]
+
+    def firstPushOfDay(self, date):
+        self.ensureDay(date)
+        return self.pushesOfDay(date, oldest=True)
+
+    def lastPushOfDay(self, date):
+        self.ensureDay(date)
+        return self.pushesOfDay(date, oldest=False)
+
+    def changesetsForPush(self, pushid):
+        return [str(row[0]) for row in
+                self.db.execute("SELECT node FROM changesets WHERE pushid = ? ORDER BY position", (pushid,))]
+
+    def pushForChangeset(self, changeset):
+        #Push ID of a full or abbreviated changeset hash, or None
+        changeset = str(changeset).lower()
+        #Hashes are hex, so everything starting with changeset sorts below changeset + "g"
+        row = self.db.execute("SELECT pushid FROM changesets WHERE node >= ? AND node < ? LIMIT 1",
+                              (changeset, changeset + "g")).fetchone()
+        if row == None:
+            return None
+        return row[0]
+
+    def changesetFromDay(self, date, oldest=True):
+        #First changeset of the first (or last) push of a day, or None
+        if oldest:
+            pushid = self.firstPushOfDay(date)
+        else:
+            pushid = self.lastPushOfDay(date)
+        if pushid == None:
+            return None
+        changesets = self.changesetsForPush(pushid)
+        if not changesets:
+            return None
+        return changesets[0]
+
+def selfCheck():
+    #Day lookups and updates against a stand-in json-pushes server with one
+    #push an hour from 2011-01-01. Returns the number of failures.
+    import BaseHTTPServer
+
+    base = calendar.timegm((2011, 1, 1, 0, 0, 0))
+    server = {"pushes": 3000}
+    requests = []
+
+    def node(pushid, position):
+        return hashlib.sha1("push%d-%d" % (pushid, position)).hexdigest()
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            #startID is exclusive and endID inclusive, like the real thing
+            params = dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query))
+            requests.append(params)
+            ids = range(1, server["pushes"] + 1)
+            if "startdate" in params:
+                (start, end) = [calendar.timegm(get_date(params[name]).timetuple())
+                                for name in ("startdate", "enddate")]
+                ids = [pushid for pushid in ids if start <= base + (pushid - 1) * 3600 < end]
+            else:
+                ids = [pushid for pushid in ids if int(params["startID"]) < pushid <= int(params["endID"])]
+            body = simplejson.dumps(dict([(str(pushid), {"date": base + (pushid - 1) * 3600, "user": "u%d" % pushid,
+                                                         "changesets": [node(pushid, 0), node(pushid, 1)]})
+                                          for pushid in ids]))
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    failures = []
+    def check(what, got, expected):
+        if got != expected:
+            failures.append(what)
+            print "FAIL %s: got %r, expected %r" % (what, got, expected)
+        else:
+            print "ok   " + what
+
+    def contiguous():
+        (count, minId, maxId) = index.db.execute("SELECT COUNT(*), MIN(id), MAX(id) FROM pushes").fetchone()
+        return count == maxId - minId + 1
+
+    (httpServer, baseUrl) = httpclient.checkServer(Handler)
+    index = PushlogIndex(":memory:", baseUrl + "json-pushes")
+    try:
+        #2011-02-01 is day 31, pushes 745 to 768
+        check("first changeset of an old day", index.changesetFromDay("2011-02-01"), node(745, 0))
+        check("seeded, backfilled and updated once", [sorted(params.keys()) for params in requests],
+              [["enddate", "startdate"], ["endID", "startID"], ["endID", "startID"]])
+        check("not paged forward to the newest push", index.bounds()[1], 768 + PushlogIndex.batchSize)
+        del requests[:]
+        check("last push of the day from the index", index.lastPushOfDay("2011-02-01"), 768)
+        check("stored day needs no requests", len(requests), 0)
+
+        #Day 90 is past what's stored, pages forward only until it's covered
+        check("later day", (index.firstPushOfDay("2011-04-01"), index.lastPushOfDay("2011-04-01")), (2161, 2184))
+        check("paged only as far as that day", (len(requests), index.bounds()[1]), (2, 2268))
+        check("index stays contiguous", contiguous(), True)
+
+        server["pushes"] = 3100
+        del requests[:]
+        check("incremental update adds every newer push", index.update(), 3100 - 2268)
+        check("update stops when the server runs out", len(requests), 3)
+        check("nothing new", index.update(), 0)
+        check("day without pushes", index.changesetFromDay("2012-01-01"), None)
+
+        (minId, maxId, minDate, maxDate) = index.bounds()
+        check("stored push rows", index.db.execute("SELECT COUNT(*), MIN(date), MAX(date) FROM pushes").fetchone(),
+              (maxId - minId + 1, base + (minId - 1) * 3600, base + (maxId - 1) * 3600))
+        check("stored changeset rows", index.db.execute("SELECT COUNT(*) FROM changesets").fetchone()[0],
+              2 * (maxId - minId + 1))
+        check("push row", index.db.execute("SELECT date, user FROM pushes WHERE id = 1000").fetchone(),
+              (base + 999 * 3600, "u1000"))
+        check("changesets in push order", index.changesetsForPush(1000), [node(1000, 0), node(1000, 1)])
+        check("push of an abbreviated changeset", index.pushForChangeset(node(1234, 1)[:12].upper()), 1234)
+        check("unknown changeset", index.pushForChangeset("0" * 12), None)
+    finally:
+        index.close()
+        httpclient.sharedClient().close()
+        httpServer.shutdown()
+    print "%d checks failed" % len(failures)
+    return len(failures)
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--check"]:
+        sys.exit(selfCheck() and 1 or 0)
+    print "usage: pushlog.py --check"
+    sys.exit(1)
@@ -0,0 +1,150 @@
+# testpackages.py
+#
+# Keeps downloaded test packages (tests.zip) in versioned directories, one per
+# package URL and server version, so a bisection reuses the last extraction
+# instead of downloading and unpacking everything again. Only the parts a
+# condition asks for are extracted, more can be added later.
+#
+# A condition script declares what it needs with a module level list of path
+# prefixes inside the package, e.g.
+#     testPackages = ["mochitest/", "bin/", "certs/", "modules/"]
+# Without one the whole package is extracted.
+
+import hashlib
+import os
+import shutil
+import simplejson
+import threading
+import time
+import zipfile
+
+import download
+import extract
+import httpclient
+import trash
+
+class TestPackageStore():
+    def __init__(self, root, keep=3):
+        #keep: how many versions of each package URL to hold on to
+        self.root = root
+        self.keep = keep
+        self.statePath = os.path.join(root, "packages.json")
+        self.lock = threading.Lock()
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def loadState(self):
+        #{key: {"url":, "fetched":, "extracted": [prefixes]}}
+        try:
+            f = open(self.statePath)
+            try:
+                return simplejson.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return {}
+
+    def saveState(self, state):
+        tmpPath = self.statePath + ".tmp"
+        f = open(tmpPath, "w")
+        simplejson.dump(state, f, indent=2)
+        f.close()
+        if os.name == "nt" and os.path.exists(self.statePath):
+            os.remove(self.statePath)
+        os.rename(tmpPath, self.statePath)
+
+    def versionKey(self, url):
+        #Key of the package the server has at url right now, None if we can't ask
+        if os.path.exists(url):
+            stat = os.stat(url)
+            version = str(stat.st_size) + ":" + str(stat.st_mtime)
+        else:
+            try:
+                response = httpclient.sharedClient().open(url, method="HEAD")
+            except (httpclient.HttpError, IOError), e:
+                print "Couldn't check " + url + " for a new test package: " + str(e)
+                return None
+            try:
+                response.read()
+                version = "|".join([str(response.getheader(header)) for header in
+                                    ("ETag", "Last-Modified", "Content-Length")])
+            finally:
+                response.close()
+        return hashlib.sha1(url + "|" + version).hexdigest()[:16]
+
+    def newestKey(self, url, state):
+        #url None: newest of any url
+        keys = [key for key, entry in state.items() if url in (None, entry["url"]) and
+                os.path.exists(self.packagePath(key))]
+        if not keys:
+            return None
+        return max(keys, key=lambda key: state[key]["fetched"])
+
+    def packagePath(self, key):
+        return os.path.join(self.root, key, "package.zip")
+
+    def testsDir(self, key):
+        return os.path.join(self.root, key, "tests")
+
+    def get(self, url, prefixes=None):
+        #Directory with (at least) the given prefixes of the package at url
+        #extracted. None means the whole package. Without a url (nothing found
+        #online) the newest package in the store is used.
+        self.lock.acquire()
+        try:
+            state = self.loadState()
+            key = url and self.versionKey(url)
+            if not key:
+                #Offline, make do with the newest version we have
+                key = self.newestKey(url or None, state)
+                if key == None:
+                    raise IOError("No test package from " + str(url) + " available")
+                url = state[key]["url"]
+            if key not in state or not os.path.exists(self.packagePath(key)):
+                self.fetch(url, key)
+                state[key] = {"url": url, "fetched": time.time(), "extracted": []}
+                self.saveState(state)
+                self.prune(url, state)
+            else:
+                print "Reusing test package " + key + " from " + url
+            self.extract(key, prefixes, state)
+            return self.testsDir(key)
+        finally:
+            self.lock.release()
+
+    def fetch(self, url, key):
+        path = self.packagePath(key)
+        if os.path.exists(url):
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            shutil.copyfile(url, path)
+        else:
+            download.download(url, path)
+
+    def extract(self, key, prefixes, state):
+        #Extract what's missing of prefixes (None: everything) and remember it
+        extracted = state[key]["extracted"]
+        if "" in extracted:
+            return
+        wanted = [""] if prefixes == None else [prefix for prefix in prefixes if prefix not in extracted]
+        if not wanted:
+            return
+        print "Extracting " + (", ".join(wanted) if wanted != [""] else "all") + " from the test package..."
+        zipped = zipfile.ZipFile(self.packagePath(key))
+        try:
+            members = [name for name in zipped.namelist()
+                       if any([name.startswith(prefix) for prefix in wanted])]
+        finally:
+            zipped.close()
+        extract.extractZip(self.packagePath(key), self.testsDir(key), members=members)
+        state[key]["extracted"] = extracted + wanted
+        self.saveState(state)
+
+    def prune(self, url, state):
+        #Drop all but the newest self.keep versions of url
+        keys = sorted([key for key, entry in state.items() if entry["url"] == url],
+                      key=lambda key: state[key]["fetched"], reverse=True)
+        for key in keys[self.keep:]:
+            trash.discard(os.path.join(self.root, key))
+            del state[key]
+        self.saveState(state)
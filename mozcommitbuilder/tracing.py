@@ -0,0 +1,98 @@
+# tracing.py
+#
+# Timing spans around build and bisection phases. Spans are kept for a
+# summary table and optionally written to a file as JSON lines or in the
+# Chrome trace-event format (load it in chrome://tracing).
+
+import os
+import simplejson
+import threading
+import time
+from contextlib import contextmanager
+
+traceFormats = ["json", "chrome"]
+
+class Tracer():
+    def __init__(self, path=None, format="json"):
+        if format not in traceFormats:
+            raise Exception("Unknown trace format " + str(format) + ", use one of " + ", ".join(traceFormats))
+        self.path = path
+        self.format = format
+        self.spans = []
+        self.lock = threading.Lock()
+        self.origin = time.time()
+        self.out = None
+        if path:
+            self.out = open(path, "w")
+            if format == "chrome":
+                self.out.write("[\n")
+        self.first = True
+
+    @contextmanager
+    def span(self, name, **args):
+        #with tracer.span("make", changeset=node): ...
+        start = time.time()
+        failed = False
+        try:
+            yield
+        except:
+            failed = True
+            raise
+        finally:
+            if failed:
+                args["failed"] = True
+            self.record(name, start, time.time() - start, args)
+
+    def record(self, name, start, duration, args={}):
+        self.lock.acquire()
+        try:
+            self.spans.append((name, duration))
+            if self.out:
+                self.write(name, start, duration, args)
+        finally:
+            self.lock.release()
+
+    def write(self, name, start, duration, args):
+        if self.format == "chrome":
+            event = {"name": name,
+                     "ph": "X",
+                     "ts": int((start - self.origin) * 1000000),
+                     "dur": int(duration * 1000000),
+                     "pid": os.getpid(),
+                     "tid": threading.currentThread().getName(),
+                     "args": args}
+            if not self.first:
+                self.out.write(",\n")
+            self.out.write(simplejson.dumps(event))
+        else:
+            self.out.write(simplejson.dumps({"name": name,
+                                             "start": start,
+                                             "duration": duration,
+                                             "thread": threading.currentThread().getName(),
+                                             "args": args}) + "\n")
+        self.first = False
+        self.out.flush()
+
+    def summary(self):
+        #Print time spent per phase, most expensive first
+        if not self.spans:
+            return
+        totals = {}
+        for name, duration in self.spans:
+            entry = totals.setdefault(name, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += duration
+            entry[2] = max(entry[2], duration)
+
+        print ""
+        print "%-20s %6s %10s %10s %10s" % ("Phase", "Count", "Total(s)", "Mean(s)", "Max(s)")
+        for name, (count, total, longest) in sorted(totals.items(), key=lambda item: -item[1][1]):
+            print "%-20s %6d %10.1f %10.1f %10.1f" % (name, count, total, total / count, longest)
+        print ""
+
+    def close(self):
+        if self.out:
+            if self.format == "chrome":
+                self.out.write("\n]\n")
+            self.out.close()
+            self.out = None
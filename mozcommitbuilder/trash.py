@@ -0,0 +1,264 @@
+# trash.py
+#
+# Deletes big trees (objdirs, old trunks, stale installs) without waiting for
+# them: discard() renames the tree into a trash directory, which is instant,
+# and a background thread removes it with a pool of walkers. Trash left over
+# by a process that exited early is removed at the next start. Entries are
+# named <name>-<pid>-<microseconds>, so trash that another running process
+# is still removing is left to it.
+#
+# Benchmark on a synthetic tree with:
+#     python trash.py [files]
+
+import errno
+import os
+import Queue
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+from utils import pidAlive
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+def listEntries(path):
+    #[(path, is a directory)] of path's entries, symlinks count as files.
+    #Whatever vanishes meanwhile (someone else removed it) is left out.
+    try:
+        if scandir != None:
+            entries = []
+            for entry in scandir(path):
+                try:
+                    entries.append((entry.path, entry.is_dir(follow_symlinks=False)))
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+            return entries
+        entries = []
+        for name in os.listdir(path):
+            child = os.path.join(path, name)
+            try:
+                entries.append((child, stat.S_ISDIR(os.lstat(child).st_mode)))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return entries
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return []
+        raise
+
+def makeWritable(path):
+    #Read-only files can't be removed on Windows, read-only directories
+    #can't be emptied anywhere
+    try:
+        os.chmod(path, stat.S_IMODE(os.lstat(path).st_mode) | stat.S_IRWXU)
+    except OSError:
+        pass
+
+def retry(function, path):
+    try:
+        function(path)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return
+        if e.errno not in (errno.EACCES, errno.EPERM):
+            raise
+        makeWritable(os.path.dirname(path))
+        if not os.path.islink(path):
+            makeWritable(path)
+        function(path)
+
+def removeTree(path, jobs=8):
+    #Remove path and everything under it. Worker threads empty directories
+    #in parallel (unlink doesn't hold the GIL), then the directories are
+    #removed deepest first.
+    if not os.path.lexists(path):
+        return
+    if os.path.islink(path) or not os.path.isdir(path):
+        retry(os.remove, path)
+        return
+    directories = []
+    errors = []
+    queue = Queue.Queue()
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            directory = queue.get()
+            if directory == None:
+                queue.task_done()
+                return
+            try:
+                try:
+                    entries = listEntries(directory)
+                except OSError, e:
+                    if e.errno not in (errno.EACCES, errno.EPERM):
+                        raise
+                    makeWritable(directory)
+                    entries = listEntries(directory)
+                for (child, isDir) in entries:
+                    if isDir:
+                        lock.acquire()
+                        directories.append(child)
+                        lock.release()
+                        queue.put(child)
+                    else:
+                        retry(os.remove, child)
+            except Exception, e:
+                errors.append(e)
+            queue.task_done()
+
+    directories.append(path)
+    queue.put(path)
+    workers = [threading.Thread(target=work) for i in range(max(1, jobs))]
+    for worker in workers:
+        worker.start()
+    queue.join()
+    for worker in workers:
+        queue.put(None)
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0]
+    for directory in sorted(directories, key=lambda directory: directory.count(os.sep), reverse=True):
+        retry(os.rmdir, directory)
+
+class Trash():
+    def __init__(self, root, jobs=8):
+        self.root = root
+        self.jobs = jobs
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def discard(self, path):
+        #Move path out of the way and remove it in the background. Paths
+        #that can't be renamed into the trash (another filesystem) are
+        #removed right away.
+        if not os.path.lexists(path):
+            return
+        if os.path.islink(path) or not os.path.isdir(path):
+            retry(os.remove, path)
+            return
+        target = os.path.join(self.root, os.path.basename(path.rstrip(os.sep)) + "-" +
+                              str(os.getpid()) + "-" + str(int(time.time() * 1000000)))
+        try:
+            os.rename(path, target)
+        except OSError, e:
+            if e.errno not in (errno.EXDEV, errno.EACCES, errno.EPERM):
+                raise
+            removeTree(path, self.jobs)
+            return
+        self.schedule(target)
+
+    def collect(self):
+        #Remove whatever earlier runs left in the trash
+        for name in os.listdir(self.root):
+            if not ownerAlive(name):
+                self.schedule(os.path.join(self.root, name))
+
+    def schedule(self, path):
+        self.queue.put(path)
+        self.lock.acquire()
+        try:
+            if self.thread == None or not self.thread.isAlive():
+                #Daemon, so a big tree never holds up exit. What's left is
+                #collected next time.
+                self.thread = threading.Thread(target=self.empty)
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+
+    def empty(self):
+        while True:
+            path = self.queue.get()
+            try:
+                removeTree(path, self.jobs)
+            except Exception, e:
+                print "Couldn't remove " + path + " from the trash: " + str(e)
+            self.queue.task_done()
+
+    def wait(self):
+        #Block until everything discarded so far is gone
+        self.queue.join()
+
+def ownerAlive(name):
+    #Whether the process that put name into the trash is still running (and
+    #removing it). Processes can't be probed on Windows, a second remover
+    #there only runs into files that are gone already.
+    parts = name.rsplit("-", 2)
+    if len(parts) != 3 or not parts[1].isdigit():
+        return False
+    pid = int(parts[1])
+    if pid == os.getpid():
+        return True
+    if os.name != "posix":
+        return False
+    return pidAlive(pid)
+
+#The trash everything shares, see configure()
+trash = None
+
+def configure(root, jobs=8):
+    global trash
+    trash = Trash(root, jobs=jobs)
+    trash.collect()
+    return trash
+
+def discard(path):
+    #Through the shared trash, or removed right away if there isn't one
+    if trash == None:
+        removeTree(path)
+    else:
+        trash.discard(path)
+
+def syntheticTree(root, files):
+    for i in range(files):
+        directory = os.path.join(root, "d%d" % (i % 50), "e%d" % (i % 7))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        f = open(os.path.join(directory, "f%d" % i), "w")
+        f.write("x" * (i % 100))
+        f.close()
+
+def benchmark(files=50000):
+    work = tempfile.mkdtemp(prefix="trashbench")
+    try:
+        print "%d files, %s" % (files, "scandir" if scandir != None else "listdir")
+        for (label, function) in (("shutil.rmtree", shutil.rmtree),
+                                  ("removeTree, 1 thread", lambda path: removeTree(path, 1)),
+                                  ("removeTree, 8 threads", lambda path: removeTree(path, 8))):
+            tree = os.path.join(work, "tree")
+            syntheticTree(tree, files)
+            start = time.time()
+            function(tree)
+            print "%-26s %7.2fs" % (label, time.time() - start)
+        tree = os.path.join(work, "tree")
+        syntheticTree(tree, files)
+        trashBin = Trash(os.path.join(work, "trash"))
+        start = time.time()
+        trashBin.discard(tree)
+        print "%-26s %7.4fs" % ("discard, returns after", time.time() - start)
+        trashBin.wait()
+        print "%-26s %7.2fs" % ("discard, gone after", time.time() - start)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+if __name__ == "__main__":
+    files = 50000
+    if len(sys.argv) > 1:
+        files = int(sys.argv[1])
+    benchmark(files)
@@ -36,14 +36,18 @@
 #
 # ***** END LICENSE BLOCK *****
 import re
-import httplib2
 import datetime
+import errno
 import platform
 import os
+import signal
 import subprocess
 import multiprocessing
-from BeautifulSoup import BeautifulSoup
-import zipfile
+import collections
+import download
+import extract
+import httpclient
+import listing
 
 def cpuCount():
     try:
@@ -51,6 +55,14 @@ def cpuCount():
     except NotImplementedError:
         return 1
 
+def pidAlive(pid):
+    #Whether process pid is running (ours to signal or not)
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
 def increment_day(date):
     #TODO: MOVE TO UTILS. Increments a date string.
     s = date.split("-")
@@ -97,6 +109,121 @@ def captureStdout(cmd, ignoreStderr=False, combineStderr=False, ignoreExitCode=F
 #            print stderr
     return stdout.rstrip()
 
+#Output lines that mean a build is doomed, no matter how long make keeps going
+fatalBuildErrors = [
+    re.compile(r'^\S+:\d+(:\d+)?: (fatal )?error: '),     # gcc/clang
+    re.compile(r'^(\S+: )?fatal error: '),
+    re.compile(r'undefined reference to '),                 # GNU ld
+    re.compile(r'^(collect2|clang|ld)(: error|: fatal)'),
+    re.compile(r'^ld: .*error'),                            # Apple ld
+    re.compile(r': (fatal )?error C\d+: '),                 # MSVC
+    re.compile(r'fatal error LNK\d+'),
+]
+
+class BuildError(Exception):
+    #A command run by streamCommand failed. tail holds its last lines of output.
+    def __init__(self, message, tail="", returncode=None, matched=None):
+        Exception.__init__(self, message)
+        self.tail = tail
+        self.returncode = returncode
+        self.matched = matched
+
+class RotatingLog():
+    #Append-only log that rolls over to path.1, path.2, ... at maxBytes
+    def __init__(self, path, maxBytes=50*1024*1024, backups=3):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.backups = backups
+        parent = os.path.dirname(path)
+        if parent and not os.path.exists(parent):
+            os.makedirs(parent)
+        self.rotate()
+
+    def rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            older = self.path + "." + str(i)
+            if os.path.exists(older):
+                os.rename(older, self.path + "." + str(i + 1))
+        if self.backups > 0 and os.path.exists(self.path):
+            os.rename(self.path, self.path + ".1")
+        self.out = open(self.path, "w")
+        self.written = 0
+
+    def write(self, data):
+        if self.written + len(data) > self.maxBytes:
+            self.out.close()
+            self.rotate()
+        self.out.write(data)
+        self.written += len(data)
+
+    def close(self):
+        self.out.close()
+
+def killProcessTree(p):
+    #make leaves a lot of compiler children around, take the whole group down
+    try:
+        if os.name == "posix":
+            os.killpg(p.pid, signal.SIGTERM)
+        else:
+            p.terminate()
+    except OSError:
+        pass
+
+def streamCommand(cmd, currWorkingDir=None, logPath=None, tailLines=200, errorPatterns=fatalBuildErrors,
+                  abortOnError=False, echo=False):
+    #Runs cmd, teeing combined stdout/stderr to a rotating log at logPath while
+    #keeping only the last tailLines lines in memory. Lines are checked against
+    #errorPatterns as they arrive; with abortOnError the command is killed on
+    #the first match. Returns the tail, raises BuildError on failure.
+    log = None
+    if logPath:
+        log = RotatingLog(logPath)
+    tail = collections.deque(maxlen=tailLines)
+    matched = None
+
+    kwargs = {}
+    if os.name == "posix":
+        kwargs["preexec_fn"] = os.setsid
+    p = subprocess.Popen(cmd,
+        stdin = subprocess.PIPE,
+        stdout = subprocess.PIPE,
+        stderr = subprocess.STDOUT,
+        cwd=currWorkingDir,
+        **kwargs)
+    p.stdin.close()
+
+    try:
+        for line in iter(p.stdout.readline, ''):
+            if log:
+                log.write(line)
+            if echo:
+                print line,
+            tail.append(line)
+            if matched == None:
+                for pattern in errorPatterns or []:
+                    if pattern.search(line):
+                        matched = line.rstrip()
+                        break
+                if matched != None and abortOnError:
+                    print "Fatal build error, aborting: " + matched
+                    killProcessTree(p)
+                    break
+        p.stdout.close()
+        p.wait()
+    except:
+        killProcessTree(p)
+        raise
+    finally:
+        if log:
+            log.close()
+
+    tailText = "".join(tail)
+    if matched != None and abortOnError:
+        raise BuildError("Aborted " + repr(cmd) + " after a fatal error", tailText, p.returncode, matched)
+    if p.returncode != 0:
+        raise BuildError("Nonzero exit code from " + repr(cmd), tailText, p.returncode, matched)
+    return tailText
+
 def get_platform():
     uname = platform.uname()
     name = uname[0]
@@ -133,18 +260,11 @@ def strsplit(string, sep):
       return []
     return strlist
 
-def download_url(url, dest=None):
-    print "Downloading "+ url+"..."
-    h = httplib2.Http()
-    resp, content = h.request(url, "GET")
+def download_url(url, dest=None, size=None, checksum=None, segments=4):
+    #Streams url to disk, resuming a partial download. See download.py.
     if dest == None:
         dest = os.path.basename(url)
-
-    local = open(dest, 'wb')
-    local.write(content)
-    local.close()
-    print "Downloaded!"
-    return dest
+    return download.download(url, dest, segments=segments, size=size, checksum=checksum)
 
 def get_date(dateString):
     p = re.compile('(\d{4})\-(\d{1,2})\-(\d{1,2})')
@@ -156,17 +276,12 @@ def get_date(dateString):
 
 
 def urlLinks(url):
-    res = [] # do not return a generator but an array, so we can store it for later use
-
-    h = httplib2.Http();
-    resp, content = h.request(url, "GET")
-    if resp.status != 200:
-        return res
-
-    soup = BeautifulSoup(content)
-    for link in soup.findAll('a'):
-        res.append(link)
-    return res
+    #Links of a directory listing as dicts with href, name, url, size and date.
+    #Use listing.iterLinks or listing.findLink to stop reading at a match.
+    try:
+        return list(listing.iterLinks(url)) # an array, so we can store it for later use
+    except httpclient.HttpError:
+        return []
 
 def getTestUrl():
     platform=get_platform()
@@ -187,22 +302,18 @@ def getTestUrl():
 
 
     url = "http://ftp.mozilla.org/pub/mozilla.org/firefox/nightly/latest-trunk/"
-    for link in urlLinks(url):
-        href = link.get("href")
-        if re.match(buildRegex, href):
-            return url + href
+    try:
+        link = listing.findLink(url, buildRegex)
+    except httpclient.HttpError:
+        link = None
+    if link:
+        return url + link["href"]
 
     return False
 
-def unzip(dest, src):
-    zipped = zipfile.ZipFile(src)
+def unzip(dest, src, store=None):
     print "Unzipping file..."
-    try:
-        zipped.extractall(dest)
-    except:
-        args = ["unzip", "-o", "-q", "-d", dest, src]
-        proc = subprocess.Popen(args)
-        proc.wait()
+    extract.extractZip(src, dest, store=store)
     print "Successfully unzipped file!"
 
 def url_base(url):
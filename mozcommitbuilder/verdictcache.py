@@ -0,0 +1,91 @@
+# verdictcache.py
+#
+# Remembers condition script verdicts, keyed by the full changeset node, a
+# hash of the condition script's source, its arguments and the mozconfig
+# fingerprint, so overlapping bisections don't build and test again.
+
+import hashlib
+import os
+import simplejson
+import sqlite3
+import threading
+import time
+
+def fileHash(path):
+    sha = hashlib.sha1()
+    f = open(path, "rb")
+    try:
+        for chunk in iter(lambda: f.read(65536), ""):
+            sha.update(chunk)
+    finally:
+        f.close()
+    return sha.hexdigest()
+
+def scriptHash(testcondition):
+    #Hash of a condition script's source, given the imported module or a path
+    path = getattr(testcondition, "__file__", testcondition)
+    if path.endswith(".pyc") or path.endswith(".pyo"):
+        path = path[:-1]
+    return fileHash(path)
+
+def argsHash(args):
+    return hashlib.sha1(simplejson.dumps([str(arg) for arg in args])).hexdigest()
+
+class VerdictCache():
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        parent = os.path.dirname(path)
+        if parent and not os.path.exists(parent):
+            os.makedirs(parent)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS verdicts (node TEXT NOT NULL, script TEXT NOT NULL, "
+                        "args TEXT NOT NULL, mozconfig TEXT NOT NULL, verdict TEXT NOT NULL, time REAL, "
+                        "PRIMARY KEY (node, script, args, mozconfig))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS verdicts_script ON verdicts (script)")
+        self.db.commit()
+
+    def get(self, node, script, args, mozconfig, count=True):
+        #Cached verdict or None. Counts hits and misses unless count is False.
+        self.lock.acquire()
+        try:
+            row = self.db.execute("SELECT verdict FROM verdicts WHERE node = ? AND script = ? AND args = ? "
+                                  "AND mozconfig = ?", (node, script, args, mozconfig)).fetchone()
+        finally:
+            self.lock.release()
+        if row == None:
+            if count:
+                self.misses += 1
+            return None
+        if count:
+            self.hits += 1
+        return str(row[0])
+
+    def put(self, node, script, args, mozconfig, verdict):
+        self.lock.acquire()
+        try:
+            self.db.execute("INSERT OR REPLACE INTO verdicts (node, script, args, mozconfig, verdict, time) "
+                            "VALUES (?, ?, ?, ?, ?, ?)", (node, script, args, mozconfig, verdict, time.time()))
+            self.db.commit()
+        finally:
+            self.lock.release()
+
+    def forget(self, script):
+        #Drop every verdict of a script (full hash or a prefix). Returns how many.
+        self.lock.acquire()
+        try:
+            cursor = self.db.execute("DELETE FROM verdicts WHERE script >= ? AND script < ?",
+                                     (script, script + "g"))
+            self.db.commit()
+            return cursor.rowcount
+        finally:
+            self.lock.release()
+
+    def report(self):
+        if self.hits or self.misses:
+            print "Verdict cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses"
+
+    def close(self):
+        self.db.close()
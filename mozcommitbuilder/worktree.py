@@ -0,0 +1,212 @@
+# worktree.py
+#
+# Extra working copies of the cached trunk, made with "hg share" so they all
+# use the one store and each gets its own objdir.
+
+import errno
+import os
+import subprocess
+import simplejson
+import threading
+import time
+
+from utils import captureStdout, pidAlive
+
+#Seconds after which a lock breaker left by a crashed process is ignored
+breakerTimeout = 60
+
+def shareWorktree(repoPath, path):
+    #Create (if needed) a shared working copy of repoPath at path
+    if os.path.exists(os.path.join(path, ".hg")):
+        return path
+    parent = os.path.dirname(path)
+    if parent and not os.path.exists(parent):
+        os.makedirs(parent)
+    retval = subprocess.call(["hg", "--config", "extensions.share=", "share", "-U", repoPath, path])
+    if retval != 0:
+        raise Exception("Couldn't create shared working copy at " + path)
+    return path
+
+class WorktreeLease():
+    #A working copy handed out by WorktreePool. Give it back with release().
+    def __init__(self, pool, name, path):
+        self.pool = pool
+        self.name = name
+        self.path = path
+        self.objdir = os.path.join(path, "obj-ff-dbg")
+
+    def release(self, node=None):
+        self.pool.release(self, node=node)
+
+class WorktreePool():
+    #A fixed number of shared working copies. Leases are tracked with lock
+    #files so several mozcommitbuilder processes can use one pool, and each
+    #working copy remembers the last revision built in it so we can hand out
+    #the one that needs the smallest rebuild.
+    def __init__(self, repoPath, root, size=1):
+        self.repoPath = repoPath
+        self.root = root
+        self.size = max(1, int(size))
+        self.statePath = os.path.join(root, "pool.json")
+        self.cv = threading.Condition()
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def names(self):
+        return ["wt" + str(i) for i in range(self.size)]
+
+    def lockPath(self, name):
+        return os.path.join(self.root, name + ".lock")
+
+    def tryLock(self, name):
+        #Take the lease lock for name. Stale locks from dead processes are broken.
+        path = self.lockPath(name)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            pid = self.lockOwner(name)
+            if pid and pid != os.getpid() and not pidAlive(pid):
+                return self.breakLock(name, pid) and self.tryLock(name)
+            return False
+        os.write(fd, str(os.getpid()))
+        os.close(fd)
+        return True
+
+    def lockOwner(self, name):
+        #pid in name's lock file, None if there isn't one or it's being written
+        try:
+            f = open(self.lockPath(name))
+            try:
+                return int(f.read().strip() or 0) or None
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return None
+
+    def breakLock(self, name, pid):
+        #Remove name's lock if it still belongs to the dead process pid. Only
+        #the process holding the breaker file may do that, so two of them
+        #can't both break it and then one remove the other's fresh lock.
+        path = self.lockPath(name)
+        breaker = path + ".break"
+        try:
+            fd = os.open(breaker, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            #Someone else is breaking it, or crashed doing so a while ago
+            try:
+                if time.time() - os.path.getmtime(breaker) > breakerTimeout:
+                    os.remove(breaker)
+            except OSError:
+                pass
+            return False
+        os.close(fd)
+        try:
+            if self.lockOwner(name) != pid:
+                return False
+            print "Breaking stale worktree lock " + path
+            os.remove(path)
+            return True
+        finally:
+            os.remove(breaker)
+
+    def unlock(self, name):
+        try:
+            os.remove(self.lockPath(name))
+        except OSError:
+            pass
+
+    def loadState(self):
+        try:
+            f = open(self.statePath)
+            state = simplejson.load(f)
+            f.close()
+            return state
+        except (IOError, ValueError):
+            return {}
+
+    def saveState(self, state):
+        tmpPath = self.statePath + "." + str(os.getpid()) + ".tmp"
+        f = open(tmpPath, "w")
+        simplejson.dump(state, f, indent=2)
+        f.close()
+        if os.name == "nt" and os.path.exists(self.statePath):
+            os.remove(self.statePath)
+        os.rename(tmpPath, self.statePath)
+
+    def revNumber(self, changeset):
+        #Local revision number of changeset, or None if hg doesn't know it
+        rev = captureStdout(["hg", "-R", self.repoPath, "log", "-r", str(changeset), "--template", "{rev}"],
+                            ignoreExitCode=True, ignoreStderr=True)
+        try:
+            return int(rev)
+        except ValueError:
+            return None
+
+    def rank(self, names, target):
+        #Closest last built revision first, least recently used breaks ties
+        state = self.loadState()
+        def key(name):
+            entry = state.get(name, {})
+            distance = 0
+            if target != None:
+                rev = entry.get("rev")
+                distance = abs(rev - target) if rev != None else float("inf")
+            return (distance, entry.get("lastUsed", 0))
+        return sorted(names, key=key)
+
+    def lease(self, changeset=None, block=True, pollInterval=5):
+        #Lease the free working copy closest to changeset (LRU if changeset is None)
+        target = None
+        if changeset != None:
+            target = self.revNumber(changeset)
+
+        leased = None
+        self.cv.acquire()
+        try:
+            while leased == None:
+                for name in self.rank(self.names(), target):
+                    if self.tryLock(name):
+                        leased = name
+                        break
+                else:
+                    if not block:
+                        return None
+                    #Other threads notify us; other processes are polled for
+                    self.cv.wait(pollInterval)
+        finally:
+            self.cv.release()
+
+        #The lock file is ours, so creating the working copy (slow the first
+        #time) can happen without holding up other leases
+        path = os.path.join(self.root, leased)
+        try:
+            shareWorktree(self.repoPath, path)
+        except:
+            self.cv.acquire()
+            try:
+                self.unlock(leased)
+                self.cv.notifyAll()
+            finally:
+                self.cv.release()
+            raise
+        return WorktreeLease(self, leased, path)
+
+    def release(self, lease, node=None):
+        #Give a working copy back, remembering what was last built in it
+        self.cv.acquire()
+        try:
+            state = self.loadState()
+            entry = state.setdefault(lease.name, {})
+            entry["lastUsed"] = time.time()
+            if node != None:
+                entry["node"] = node
+                entry["rev"] = self.revNumber(node)
+            self.saveState(state)
+            self.unlock(lease.name)
+            self.cv.notifyAll()
+        finally:
+            self.cv.release()
@@ -2,7 +2,6 @@ from setuptools import setup, find_packages
 
 deps = ['pulsebuildmonitor',
         'mozrunner >= 2.5.4',
-        'httplib2 >= 0.6.0',
         'simplejson']
 
 setup(name='mozcommitbuilder',